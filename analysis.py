@@ -13,11 +13,37 @@ __all__ = [
     'UDPAnalysis',
 ]
 
+# capinfos shortens large counts unless given -M
+CAPINFOS_UNITS = {
+    '' : 1,
+    'k' : 1000,
+    'M' : 1000000,
+}
+
+#sub class needs to provide
+# compose_commands(self), returns dict of name -> command
+# internal_analysis(self, result)
 class BaseAnalysis:
     def __init__(self, env):
         self.env = env
+        self.commands = None
+        
+    def prepare(self, batch):
+        # put commands into a batch shared with other analyses,
+        # analyze() must be called after the batch is executed
+        if self.commands is not None:
+            # already prepared
+            return
+        self.commands = self.compose_commands()
+        for command in self.commands.values():
+            batch.add(command)
         
     def analyze(self):
+        if self.commands is None:
+            batch = CommandBatch()
+            self.prepare(batch)
+            batch.execute()
+        
         result = dict()
         
         self.internal_analysis(result)
@@ -28,20 +54,55 @@ class BaseAnalysis:
 
     def get_analysis_result(self):
         return copy.copy(self.result)
+        
+    def get_output(self, name):
+        return self.commands[name].get_parsed_output()
+
+    def add_window_commands(self, commands):
+        # only a time window of the connection is in the file, its
+        # packets are counted by capinfos
+        if self.env.get('window') is not None:
+            params = {
+                'filename' : self.env['filename']
+            }
+            commands['capinfos'] = CapInfos(params)
+
+    def get_frames(self):
+        # packets of the connection in the file analyzed
+        conn = self.env['conn']
+        if 'capinfos' not in self.commands:
+            return long(conn['tframes'])
+        text = self.get_output('capinfos').get('Number of packets', '')
+        match = re.match(r'(?P<n>\d+)\s*(?P<unit>[kM]?)$', text.replace(',', ''))
+        if not match:
+            # unknown format, the whole connection's count is the best left
+            return long(conn['tframes'])
+        return long(match.group('n')) * CAPINFOS_UNITS[match.group('unit')]
+
+    def get_duration(self):
+        # seconds of the connection in the file analyzed: the window
+        # clipped to the connection if there is one
+        conn = self.env['conn']
+        if self.env.get('window') is None:
+            return conn['duration_f']
+        start = float(conn['start'])
+        (window_start, window_end) = self.env['window']
+        return (min(window_end, start + conn['duration_f']) - 
+            max(window_start, start))
 
 class GeneralAnalysis(BaseAnalysis):
-    def internal_analysis(self, result):
-    
+    def compose_commands(self):
+        commands = dict()
+        
         # 1. capinfos
+        # run it now, interval of flow depends on the duration
         params = {
             'filename' : self.env['filename']
         }
-        value = CapInfos(params).execute()
-        
-        result['capinfos'] = value
+        self.capinfos = CapInfos(params).execute()
         
         # 2. flow
-        duration_text = value['Capture duration']
+        duration_text = self.capinfos['Capture duration']
         
         match = re.match(r'(?P<t>\d+) seconds', duration_text)
         
@@ -54,8 +115,16 @@ class GeneralAnalysis(BaseAnalysis):
             'duration' : duration
             }
             
-            value = FlowInfo(params).execute()
-            result['flowinfo'] = value  
+            commands['flowinfo'] = FlowInfo(params)
+            
+        return commands
+        
+    def internal_analysis(self, result):
+    
+        result['capinfos'] = self.capinfos
+        
+        if 'flowinfo' in self.commands:
+            result['flowinfo'] = self.get_output('flowinfo')
         else:    
             result['flowinfo'] = None
         
@@ -64,16 +133,15 @@ class GeneralAnalysis(BaseAnalysis):
         
 
 class iSCSIAnalysis(BaseAnalysis):
-    def internal_analysis(self, result):
-    
+    def compose_commands(self):
+        commands = dict()
+        
         # 1. SRT
         params = {
             'filename' : self.env['filename']
         }
         
-        value = iSCSISRTInfo(params).execute()
-        
-        result['srt'] = value
+        commands['srt'] = iSCSISRTInfo(params)
 
         # 2. IO Size
         # Read
@@ -81,24 +149,27 @@ class iSCSIAnalysis(BaseAnalysis):
             'filename' : self.env['filename']
         }
         
-        value = iSCSIReadSize(params).execute()
-        
-        result['read'] = value
+        commands['read'] = iSCSIReadSize(params)
         
         # Write
         params = {
             'filename' : self.env['filename']
         }
         
-        value = iSCSIWriteSize(params).execute()
+        commands['write'] = iSCSIWriteSize(params)
         
-        result['write'] = value
+        return commands
         
-    
-class TCPAnalysis(BaseAnalysis):
     def internal_analysis(self, result):
+    
+        result['srt'] = self.get_output('srt')
+        result['read'] = self.get_output('read')
+        result['write'] = self.get_output('write')
         
-        conn = self.env['conn']
+    
+class TCPAnalysis(BaseAnalysis):
+    def compose_commands(self):
+        commands = dict()
         
         # 1. Retrans
         params = {
@@ -106,26 +177,13 @@ class TCPAnalysis(BaseAnalysis):
             'src_ip' : self.env['conn']['src_ip'],
             'dest_ip' : self.env['conn']['dest_ip']
         }
-        value = TCPRetrans(params).execute()
-        
-        result['retrans'] = value
-        
-        result['tframes'] = long(conn['tframes'])
-        
-        trate = float(value['tf']) / float(result['tframes'])
-        value['trate_f'] = trate
-        
-        # convert to string with three digits after "."
-        value['trate_s'] = "%.3f" % (trate * 100.0,)
+        commands['retrans'] = TCPRetrans(params)
        
         # 2. SACK
         params = {
             'filename' : self.env['filename']
         }
-        value = TCPSACK(params).execute()
-        
-        result['sack'] = value
-        
+        commands['sack'] = TCPSACK(params)
         
         # 3. TCP Zero Window 
         params = {
@@ -133,9 +191,7 @@ class TCPAnalysis(BaseAnalysis):
             'src_ip' : self.env['conn']['src_ip'],
             'dest_ip' : self.env['conn']['dest_ip']
         }
-        value = TCPZeroWin(params).execute()
-        
-        result['zerowin'] = value
+        commands['zerowin'] = TCPZeroWin(params)
         
         # 4. Delay ACK
         params = {
@@ -143,147 +199,205 @@ class TCPAnalysis(BaseAnalysis):
             'src_ip' : self.env['conn']['src_ip'],
             'dest_ip' : self.env['conn']['dest_ip']
         }
-        value = TCPDelayACK(params).execute()
+        commands['delayack'] = TCPDelayACK(params)
+        
+        self.add_window_commands(commands)
+        
+        return commands
+        
+    def internal_analysis(self, result):
+        
+        # 1. Retrans
+        value = self.get_output('retrans')
+        
+        result['retrans'] = value
+        
+        result['tframes'] = self.get_frames()
+        
+        trate = 0.0
+        if result['tframes'] > 0:
+            trate = float(value['tf']) / float(result['tframes'])
+        value['trate_f'] = trate
+        
+        # convert to string with three digits after "."
+        value['trate_s'] = "%.3f" % (trate * 100.0,)
+       
+        # 2. SACK
+        result['sack'] = self.get_output('sack')
+        
+        # 3. TCP Zero Window 
+        result['zerowin'] = self.get_output('zerowin')
+        
+        # 4. Delay ACK
+        value = self.get_output('delayack')
         
         result['delayack'] = value
         
         # calculate factor
         value['delayack_waste'] = 0.2 * (
             value['sf_i'] + value['df_i']) 
-        factor =  value['delayack_waste'] / conn['duration_f']
+        duration = self.get_duration()
+        factor = 0.0
+        if duration > 0:
+            factor = value['delayack_waste'] / duration
 
         value['delayack_factor'] = factor
         
 class SMBAnalysis(BaseAnalysis):
-    def internal_analysis(self, result):
+    def compose_commands(self):
+        commands = dict()
     
         # 1. General SRT
         params = {
             'filename' : self.env['filename'],
         }
-        value = SMBSRTInfo(params).execute()
-        result['srt'] = value
+        commands['srt'] = SMBSRTInfo(params)
         
         # 2. Read
         params = {
             'filename' : self.env['filename']
         }
-        value = SMBReadSize(params).execute()
-        
-        result['read'] = value
-        
+        commands['read'] = SMBReadSize(params)
         
         # 3. Write
         params = {
             'filename' : self.env['filename'],
         }
-        value = SMBWriteSize(params).execute()
+        commands['write'] = SMBWriteSize(params)
+        
+        return commands
         
-        result['write'] = value
+    def internal_analysis(self, result):
+    
+        result['srt'] = self.get_output('srt')
+        result['read'] = self.get_output('read')
+        result['write'] = self.get_output('write')
     
 
 class SMB2Analysis(BaseAnalysis):
-    def internal_analysis(self, result):
+    def compose_commands(self):
+        commands = dict()
+        
         # 1. General 
         # Read SRT
         params = {
             'filename' : self.env['filename'],
         }
-        value = SMB2ReadSRTInfo(params).execute()
-        result['readsrt'] = value
+        commands['readsrt'] = SMB2ReadSRTInfo(params)
     
         # Write SRT
         params = {
             'filename' : self.env['filename'],
         }
-        value = SMB2WriteSRTInfo(params).execute()
-        result['writesrt'] = value
+        commands['writesrt'] = SMB2WriteSRTInfo(params)
     
         # 2. IO Size
         # Read
         params = {
             'filename' : self.env['filename'],
         }
-        value = SMB2ReadSize(params).execute()
-        result['read'] = value
+        commands['read'] = SMB2ReadSize(params)
         
         # Write
         params = {
             'filename' : self.env['filename'],
         }
-        value = SMB2WriteSize(params).execute()
-        result['write'] = value
+        commands['write'] = SMB2WriteSize(params)
+        
+        return commands
+        
+    def internal_analysis(self, result):
+    
+        result['readsrt'] = self.get_output('readsrt')
+        result['writesrt'] = self.get_output('writesrt')
+        result['read'] = self.get_output('read')
+        result['write'] = self.get_output('write')
 
 class NFSV3Analysis(BaseAnalysis):
-    def internal_analysis(self, result):
+    def compose_commands(self):
+        commands = dict()
     
         # 1. General SRT
         params = {
             'filename' : self.env['filename'],
         }
-        value = NFSV3SRTInfo(params).execute()
-        result['srt'] = value
+        commands['srt'] = NFSV3SRTInfo(params)
         
         # 2. Read
         params = {
             'filename' : self.env['filename']
         }
-        value = NFSV3ReadSize(params).execute()
-        
-        result['read'] = value
-        
+        commands['read'] = NFSV3ReadSize(params)
         
         # 3. Write
         params = {
             'filename' : self.env['filename'],
         }
-        value = NFSV3WriteSize(params).execute()
+        commands['write'] = NFSV3WriteSize(params)
         
-        result['write'] = value
+        return commands
         
-class NFSV4Analysis(BaseAnalysis):
     def internal_analysis(self, result):
     
+        result['srt'] = self.get_output('srt')
+        result['read'] = self.get_output('read')
+        result['write'] = self.get_output('write')
+        
+class NFSV4Analysis(BaseAnalysis):
+    def compose_commands(self):
+        commands = dict()
+    
         # 1. SRT
         # Read SRT
         params = {
             'filename' : self.env['filename'],
         }
-        value = NFSV4ReadSRTInfo(params).execute()
-        result['readsrt'] = value
+        commands['readsrt'] = NFSV4ReadSRTInfo(params)
         
-        # Read SRT
+        # Write SRT
         params = {
             'filename' : self.env['filename'],
         }
-        value = NFSV4WriteSRTInfo(params).execute()
-        result['writesrt'] = value
+        commands['writesrt'] = NFSV4WriteSRTInfo(params)
         
         # 2. Read
         params = {
             'filename' : self.env['filename']
         }
-        value = NFSV4ReadSize(params).execute()
-        
-        result['read'] = value
-        
+        commands['read'] = NFSV4ReadSize(params)
         
         # 3. Write
         params = {
             'filename' : self.env['filename'],
         }
-        value = NFSV4WriteSize(params).execute()
+        commands['write'] = NFSV4WriteSize(params)
+        
+        return commands
         
-        result['write'] = value        
+    def internal_analysis(self, result):
+    
+        result['readsrt'] = self.get_output('readsrt')
+        result['writesrt'] = self.get_output('writesrt')
+        result['read'] = self.get_output('read')
+        result['write'] = self.get_output('write')        
 
 class UDPAnalysis(BaseAnalysis):
-    def internal_analysis(self, result):
+    def compose_commands(self):
+        commands = dict()
     
         # TTL exceeded 
         params = {
             'filename' : self.env['filename'],
         }
-        value = UDPTTLExceeded(params).execute()
-        result['ttlexceeded'] = value
+        commands['ttlexceeded'] = UDPTTLExceeded(params)
+        
+        self.add_window_commands(commands)
+        
+        return commands
+        
+    def internal_analysis(self, result):
+    
+        result['ttlexceeded'] = self.get_output('ttlexceeded')
+        result['tframes'] = self.get_frames()
         
-          
\ No newline at end of file
+          
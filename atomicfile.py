@@ -0,0 +1,50 @@
+import os
+import tempfile
+
+__all__ = [
+    'write_file',
+]
+
+# Files of results are written under a unique temporary name next to
+# them, then renamed. Readers never see a partial file, and requests
+# writing the same file at the same time don't get in each other's
+# way. Only for files having the same content whoever writes them:
+# when another writer got there first, its file is kept.
+
+def write_file(filename, write):
+    # write(f) puts the content into the file object f
+    (fd, tmpname) = tempfile.mkstemp(
+        prefix=os.path.basename(filename) + ".", suffix=".part",
+        dir=os.path.dirname(filename) or ".")
+    try:
+        f = os.fdopen(fd, "wb")
+        try:
+            write(f)
+        finally:
+            f.close()
+        replace_file(tmpname, filename)
+    except:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+def replace_file(tmpname, filename):
+    if os.name != 'nt':
+        # replaces filename at once
+        os.rename(tmpname, filename)
+        return
+
+    # Windows does not replace, the old file is removed first, unless
+    # another request has it open
+    if os.path.exists(filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+    try:
+        os.rename(tmpname, filename)
+    except OSError:
+        if not os.path.exists(filename):
+            raise
+        # written by another request meanwhile
+        os.remove(tmpname)
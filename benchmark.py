@@ -0,0 +1,867 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# End to end benchmark of the capture pipeline.
+#
+#   python benchmark.py run [options]
+#       generate a capture, run extraction, split and analysis tasks
+#       on it, print and save the timings
+#   python benchmark.py generate FILE [options]
+#       only write a synthetic capture
+#   python benchmark.py compare OLD.json NEW.json
+#       compare two saved runs
+#
+# By default tshark and capinfos are replaced by this script
+# (fake-tshark, fake-capinfos), which computes deterministic outputs
+# from the capture itself, or replays outputs recorded from a real
+# tshark, after a configurable delay. Use --real-tshark/--real-capinfos
+# to measure with Wireshark.
+
+import argparse
+import array
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+import config
+from pcapreader import CaptureReader, ExtractConversations, SplitConversations, \
+    PCAP_MAGIC_US, IPPROTO_TCP, IPPROTO_UDP
+
+__all__ = [
+    'GenerateCapture',
+    'RunBenchmark',
+    'CompareResults',
+]
+
+PROTOCOLS = ['iscsi', 'smb', 'smb2', 'nfs3', 'nfs4', 'tcp', 'udp']
+
+DEFAULT_MIX = "iscsi=1,smb=1,smb2=1,nfs3=1,nfs4=1,tcp=2,udp=1"
+
+# server port of each protocol
+PROTOCOL_PORTS = {
+    'iscsi' : 3260,
+    'smb' : 139,
+    'smb2' : 445,
+    'nfs3' : 2049,
+    'nfs4' : 2049,
+    'tcp' : 80,
+    'udp' : 5000,
+}
+
+# packet kinds found back by the fake tshark from the payload
+KIND_OTHER = 0
+KIND_ISCSI = 1
+KIND_SMB = 2
+KIND_SMB2 = 3
+KIND_NFS3 = 4
+KIND_NFS4 = 5
+
+PROTOCOL_KINDS = {
+    'iscsi' : KIND_ISCSI,
+    'smb' : KIND_SMB,
+    'smb2' : KIND_SMB2,
+    'nfs3' : KIND_NFS3,
+    'nfs4' : KIND_NFS4,
+}
+
+NFS_PROGRAM = 100003
+
+def parse_mix(text):
+    # "iscsi=1,tcp=2" -> list of (protocol, weight)
+    mix = list()
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        (name, weight) = item.split('=')
+        name = name.strip()
+        if name not in PROTOCOLS:
+            raise ValueError("Unknown protocol: %s" % name)
+        mix.append((name, float(weight)))
+    return mix
+
+#
+# Synthetic capture
+#
+
+def protocol_payload(protocol, size, rnd):
+    # payload starting like the real protocol, so it can be told apart
+    if protocol == 'iscsi':
+        # basic header segment, SCSI data-in
+        head = struct.pack(">BBHI", 0x25, 0x80, 0, size) + "\0" * 40
+    elif protocol == 'smb':
+        # NetBIOS session + SMB1 header
+        head = struct.pack(">I", size) + "\xffSMB" + "\x2e" + "\0" * 27
+    elif protocol == 'smb2':
+        head = struct.pack(">I", size) + "\xfeSMB" + struct.pack("<HH", 64, 0) + "\0" * 56
+    elif protocol in ('nfs3', 'nfs4'):
+        # RPC record marker + call header
+        version = 3 if protocol == 'nfs3' else 4
+        head = struct.pack(">IIIIIII", 0x80000000 | size, rnd.randrange(1 << 32),
+            0, 2, NFS_PROGRAM, version, 6)
+    else:
+        head = ""
+    if size <= len(head):
+        return head[:size]
+    return head + "x" * (size - len(head))
+
+def packet_bytes(src_ip, dest_ip, src_port, dest_port, proto, payload):
+    # Ethernet + IPv4 + TCP/UDP
+    if proto == IPPROTO_TCP:
+        l4 = struct.pack(">HHIIBBHHH", src_port, dest_port, 0, 0, 0x50, 0x18,
+            65535, 0, 0)
+    else:
+        l4 = struct.pack(">HHHH", src_port, dest_port, 8 + len(payload), 0)
+    ip = struct.pack(">BBHHHBBH4s4s", 0x45, 0, 20 + len(l4) + len(payload),
+        0, 0x4000, 64, proto, 0, src_ip, dest_ip)
+    return "\0\1\2\3\4\5\6\7\x08\x09\x0a\x0b\x08\x00" + ip + l4 + payload
+
+# Write a pcap of about size_mb (or exactly packets packets) with
+# conversations conversations, protocols picked by the weights of mix.
+# Returns a dict describing the capture.
+def GenerateCapture(filename, size_mb=None, packets=None, conversations=100,
+    mix=DEFAULT_MIX, seed=1, duration=60.0):
+    rnd = random.Random(seed)
+    mix = parse_mix(mix)
+    total_weight = sum([w for (n, w) in mix])
+
+    convs = list()
+    for i in range(conversations):
+        # protocol by weight
+        r = rnd.random() * total_weight
+        for (protocol, weight) in mix:
+            r -= weight
+            if r < 0:
+                break
+        client = socket.inet_aton("10.%d.%d.%d" % (1 + i // 65536, (i // 256) % 256, i % 256))
+        server = socket.inet_aton("10.200.0.%d" % (1 + i % 16))
+        if protocol == 'udp':
+            proto = IPPROTO_UDP
+        else:
+            proto = IPPROTO_TCP
+        # a few conversations carry most of the traffic
+        weight = 1.0 / (1 + i) + 0.01
+        convs.append((protocol, proto, client, 1024 + i, server,
+            PROTOCOL_PORTS[protocol], weight))
+
+    cumulative = list()
+    acc = 0.0
+    for conv in convs:
+        acc += conv[6]
+        cumulative.append(acc)
+
+    if size_mb is None and packets is None:
+        size_mb = 10
+    size_limit = None
+    if size_mb is not None:
+        size_limit = long(size_mb * 1024 * 1024)
+    if packets is not None:
+        # spread time over the packets
+        step = duration / max(packets, 1)
+    else:
+        step = duration / max(size_limit // 700, 1)
+
+    f = open(filename, "wb", 1024 * 1024)
+    count = 0
+    written = 24
+    ts = 1500000000.0
+    try:
+        f.write(struct.pack("<IHHiIII", PCAP_MAGIC_US, 2, 4, 0, 0, 65535, 1))
+        while True:
+            if packets is not None and count >= packets:
+                break
+            if size_limit is not None and written >= size_limit:
+                break
+
+            # conversation by weight, binary search
+            r = rnd.random() * acc
+            lo = 0
+            hi = len(cumulative) - 1
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if cumulative[mid] < r:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            (protocol, proto, client, cport, server, sport, w) = convs[lo]
+
+            size = rnd.choice((0, 64, 512, 1024, 1400))
+            payload = protocol_payload(protocol, size, rnd)
+            if rnd.random() < 0.5:
+                data = packet_bytes(client, server, cport, sport, proto, payload)
+            else:
+                data = packet_bytes(server, client, sport, cport, proto, payload)
+
+            ts += step * (0.5 + rnd.random())
+            sec = int(ts)
+            f.write(struct.pack("<IIII", sec, int((ts - sec) * 1e6), len(data), len(data)))
+            f.write(data)
+            written += 16 + len(data)
+            count += 1
+    finally:
+        f.close()
+
+    return {
+        'filename' : filename,
+        'size_mb' : written / 1024.0 / 1024.0,
+        'packets' : count,
+        'conversations' : conversations,
+        'mix' : dict(mix),
+    }
+
+#
+# tshark/capinfos stand-in
+#
+
+def payload_kind(reader, linktype, offset, caplen):
+    ip = reader.ipv4_offset(linktype, offset, caplen)
+    if ip is None:
+        return KIND_OTHER
+    buf = reader.buf
+    end = offset + caplen
+    (ver_ihl, proto) = struct.unpack_from(">B8xB", buf, ip)
+    l4 = ip + (ver_ihl & 0x0f) * 4
+    if proto == IPPROTO_TCP:
+        if l4 + 20 > end:
+            return KIND_OTHER
+        (flags,) = struct.unpack_from(">B", buf, l4 + 12)
+        data = l4 + (flags >> 4) * 4
+    else:
+        data = l4 + 8
+    head = buf[data:min(data + 28, end)]
+    if len(head) >= 8 and head[4:8] == "\xffSMB":
+        return KIND_SMB
+    if len(head) >= 8 and head[4:8] == "\xfeSMB":
+        return KIND_SMB2
+    if len(head) >= 28:
+        (msg_type, rpcvers, program, version) = struct.unpack(">IIII", head[8:24])
+        if msg_type == 0 and rpcvers == 2 and program == NFS_PROGRAM:
+            if version == 3:
+                return KIND_NFS3
+            if version == 4:
+                return KIND_NFS4
+    if len(head) >= 1 and ord(head[0]) == 0x25 and proto == IPPROTO_TCP:
+        return KIND_ISCSI
+    return KIND_OTHER
+
+class CaptureSummary:
+    # packets of a capture as (ts, length, kind), read once
+    def __init__(self, filename):
+        self.ts = array.array('d')
+        self.length = array.array('L')
+        self.kind = array.array('B')
+        reader = CaptureReader(filename)
+        try:
+            for (ts, wirelen, linktype, data_offset, caplen, rec_offset, rec_end) in reader.records():
+                self.ts.append(ts)
+                self.length.append(wirelen)
+                self.kind.append(payload_kind(reader, linktype, data_offset, caplen))
+        finally:
+            reader.close()
+        if len(self.ts) > 0:
+            self.first = self.ts[0]
+            self.duration = self.ts[-1] - self.ts[0]
+        else:
+            self.first = 0.0
+            self.duration = 0.0
+
+    def select(self, expression):
+        # packets matching a display filter, guessed from its text:
+        # protocol names are looked up in the payload, anything else
+        # matches a fixed share of the packets
+        text = expression.lower()
+        if 'programversion==3' in text or 'nfs.count3' in text:
+            kinds = (KIND_NFS3,)
+        elif 'programversion==4' in text or 'nfs.' in text:
+            kinds = (KIND_NFS4,)
+        elif 'smb2' in text:
+            kinds = (KIND_SMB2,)
+        elif 'smb' in text:
+            kinds = (KIND_SMB,)
+        elif 'iscsi' in text or 'scsi' in text:
+            kinds = (KIND_ISCSI,)
+        elif 'icmp' in text:
+            return lambda i: False
+        else:
+            share = 5 + zlib.crc32(expression) % 40
+            return lambda i: i % share == 0
+        kind = self.kind
+        return lambda i: kind[i] in kinds
+
+def stable_number(text, low, high):
+    # same number for the same text on every run
+    return low + (zlib.crc32(text) & 0xffffffff) % (high - low + 1)
+
+def format_block(lines):
+    bar = "=" * 67
+    return "\n".join([bar] + lines + [bar])
+
+def fake_io_stat(summary, tap):
+    # io,stat,<interval>[,<column>...]
+    fields = tap.split(',')
+    interval = float(fields[2]) if len(fields) > 2 and fields[2] else 0.0
+    columns = fields[3:]
+    if len(columns) == 0:
+        columns = ['']
+
+    if interval <= 0 or summary.duration <= 0:
+        interval = max(summary.duration, 0.001)
+        buckets = 1
+    else:
+        buckets = int(summary.duration / interval) + 1
+
+    # per bucket and column: [frames, bytes]
+    counts = [[[0, 0] for c in columns] for b in range(buckets)]
+    selectors = list()
+    for column in columns:
+        match = re.match(r'(AVG|MAX|MIN|SUM)\((?P<field>[^)]*)\)(?P<filter>.*)', column)
+        if match:
+            selectors.append(summary.select(match.group('filter')))
+        elif column:
+            selectors.append(summary.select(column))
+        else:
+            selectors.append(lambda i: True)
+
+    ts = summary.ts
+    length = summary.length
+    first = summary.first
+    for i in xrange(len(ts)):
+        b = min(int((ts[i] - first) / interval), buckets - 1)
+        row = counts[b]
+        for c in xrange(len(selectors)):
+            if selectors[c](i):
+                row[c][0] += 1
+                row[c][1] += length[i]
+
+    lines = ["| IO Statistics", "|", "| Interval size: %.3f secs" % interval]
+    for (c, column) in enumerate(columns):
+        lines.append("| Col %d: %s" % (c + 1, column or "Frames and bytes"))
+    lines.append("|" + "-" * 60)
+    for b in range(buckets):
+        cells = list()
+        for (c, column) in enumerate(columns):
+            (frames, nbytes) = counts[b][c]
+            match = re.match(r'(AVG|MAX|MIN|SUM)\((?P<field>[^)]*)\)', column)
+            if match:
+                field = match.group('field')
+                if frames == 0:
+                    value = 0
+                else:
+                    value = stable_number(column, 512, 65536)
+                if 'time' in field:
+                    cells.append("%.6f" % (value / 1e6,))
+                elif match.group(1) == 'SUM':
+                    cells.append("%d" % (value * frames,))
+                else:
+                    cells.append("%d" % (value,))
+            else:
+                cells.append("%d | %d" % (frames, nbytes))
+        start = b * interval
+        end = min((b + 1) * interval, max(summary.duration, start))
+        lines.append("| %.3f <> %.3f | %s |" % (start, end, " | ".join(cells)))
+    return format_block(lines)
+
+def fake_srt(summary, tap):
+    # scsi,srt / smb,srt / rpc,srt: one line per procedure
+    if tap.startswith('scsi'):
+        kind = KIND_ISCSI
+        procs = ['READ(10)', 'WRITE(10)', 'INQUIRY']
+        title = "SCSI SRT Statistics"
+    elif tap.startswith('smb'):
+        kind = KIND_SMB
+        procs = ['Read AndX', 'Write AndX', 'Close']
+        title = "SMB SRT Statistics"
+    else:
+        if ',4' in tap:
+            kind = KIND_NFS4
+            procs = ['COMPOUND']
+        else:
+            kind = KIND_NFS3
+            procs = ['READ', 'WRITE', 'GETATTR']
+        title = "RPC SRT Statistics"
+
+    calls = summary.kind.count(kind) // 2
+    lines = [title + ":", "Filter: " + tap.replace(',', ' '), ""]
+    if tap.startswith('smb'):
+        lines.append("SMB Commands                   Calls    Min SRT    Max SRT    Avg SRT")
+    else:
+        lines.append("Procedure        Calls    Min SRT    Max SRT    Avg SRT    Total")
+    for proc in procs:
+        n = calls // len(procs)
+        low = stable_number(proc, 50, 500) / 1e6
+        high = stable_number(proc + tap, 1000, 90000) / 1e6
+        avg = (low + high) / 3
+        line = "%-16s %8d %10.6f %10.6f %10.6f" % (proc, n, low, high, avg)
+        if not tap.startswith('smb'):
+            line += " %10.6f" % (avg * n,)
+        lines.append(line)
+    return format_block(lines)
+
+def fake_conv(filename, tap):
+    (tcps, udps) = ExtractConversations(filename)
+    if tap.startswith('conv,tcp'):
+        convs = tcps
+        title = "TCP Conversations"
+    else:
+        convs = udps
+        title = "UDP Conversations"
+    items = tap.split(',', 2)
+    if len(items) > 2:
+        tap_filter = items[2]
+    else:
+        tap_filter = "<No Filter>"
+    lines = [title, "Filter:" + tap_filter,
+        "                                               |       <-      | |       ->      | |     Total     |    Relative    |   Duration   |",
+        "                                               | Frames  Bytes | | Frames  Bytes | | Frames  Bytes |      Start     |              |"]
+    for c in convs:
+        lines.append("%s:%s <-> %s:%s %6s %8s %6s %8s %6s %8s %s %s" % (
+            c['src_ip'], c['src_port'], c['dest_ip'], c['dest_port'],
+            c['dframes'], c['dbytes'], c['uframes'], c['ubytes'],
+            c['tframes'], c['tbytes'], c['start'], c['duration']))
+    return format_block(lines)
+
+def replay_name(tap):
+    # file of a recorded tap output
+    name = re.sub(r'[^\w.=-]+', '_', tap)[:80]
+    return "%s-%08x.txt" % (name, zlib.crc32(tap) & 0xffffffff)
+
+def capture_delay(filename, delay, delay_per_mb):
+    size_mb = os.path.getsize(filename) / 1024.0 / 1024.0
+    time.sleep(delay + delay_per_mb * size_mb)
+
+def FakeTShark(argv):
+    parser = argparse.ArgumentParser(prog="fake-tshark")
+    parser.add_argument('--delay', type=float, default=0.0)
+    parser.add_argument('--delay-per-mb', type=float, default=0.0)
+    parser.add_argument('--replay', default=None)
+    parser.add_argument('--record', default=None)
+    parser.add_argument('--real', default=None)
+    parser.add_argument('-n', action='store_true')
+    parser.add_argument('-q', action='store_true')
+    parser.add_argument('-r', dest='filename')
+    parser.add_argument('-z', dest='taps', action='append', default=[])
+    parser.add_argument('-Y', dest='filter')
+    parser.add_argument('-w', dest='outfilename')
+    args = parser.parse_args(argv)
+
+    capture_delay(args.filename, args.delay, args.delay_per_mb)
+
+    if args.outfilename:
+        # write the packets of one conversation
+        match = re.search(r'ip.addr==([\d.]+) && (tcp|udp).port==(\d+) '
+            r'&& ip.addr==([\d.]+) && (?:tcp|udp).port==(\d+)', args.filter)
+        conn = {
+            'src_ip' : match.group(1),
+            'type' : match.group(2).upper(),
+            'src_port' : match.group(3),
+            'dest_ip' : match.group(4),
+            'dest_port' : match.group(5),
+        }
+        SplitConversations(args.filename, {args.outfilename : conn})
+        return 0
+
+    summary = None
+    blocks = list()
+    for tap in args.taps:
+        if args.record:
+            # run the real one and keep its output
+            cmd = [args.real, '-n', '-q', '-r', args.filename, '-z', tap]
+            block = subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
+            f = open(os.path.join(args.record, replay_name(tap)), "wb")
+            try:
+                f.write(block)
+            finally:
+                f.close()
+            blocks.append(block.strip("\r\n"))
+            continue
+
+        if args.replay:
+            name = os.path.join(args.replay, replay_name(tap))
+            if os.path.exists(name):
+                f = open(name, "rb")
+                try:
+                    blocks.append(f.read().strip("\r\n"))
+                finally:
+                    f.close()
+                continue
+
+        if tap.startswith('conv,'):
+            blocks.append(fake_conv(args.filename, tap))
+            continue
+        if summary is None:
+            summary = CaptureSummary(args.filename)
+        if tap.startswith('io,stat'):
+            blocks.append(fake_io_stat(summary, tap))
+        else:
+            blocks.append(fake_srt(summary, tap))
+
+    # tshark does not print the taps in the order of the options,
+    # mixed here so that the batch has to tell them apart
+    order = sorted(range(len(blocks)), 
+        key=lambda i: zlib.crc32(args.taps[i]) & 0xffffffff)
+    blocks = [blocks[i] for i in order]
+    sys.stdout.write("\n".join(blocks) + "\n")
+    return 0
+
+def FakeCapInfos(argv):
+    parser = argparse.ArgumentParser(prog="fake-capinfos")
+    parser.add_argument('--delay', type=float, default=0.0)
+    parser.add_argument('--delay-per-mb', type=float, default=0.0)
+    parser.add_argument('filename')
+    args = parser.parse_args(argv)
+
+    capture_delay(args.filename, args.delay, args.delay_per_mb)
+
+    summary = CaptureSummary(args.filename)
+    nbytes = sum(summary.length)
+    duration = max(summary.duration, 0.000001)
+    print "File name:           %s" % (args.filename,)
+    print "File type:           Wireshark/tcpdump/... - pcap"
+    print "File encapsulation:  Ethernet"
+    print "Number of packets:   %d" % (len(summary.ts),)
+    print "File size:           %d bytes" % (os.path.getsize(args.filename),)
+    print "Data size:           %d bytes" % (nbytes,)
+    print "Capture duration:    %d seconds" % (int(summary.duration),)
+    print "Data byte rate:      %.2f bytes/sec" % (nbytes / duration,)
+    print "Average packet rate: %.2f packets/sec" % (len(summary.ts) / duration,)
+    return 0
+
+#
+# Measurements
+#
+
+def current_rss():
+    # resident set size of this process in bytes, None if unknown
+    try:
+        f = open("/proc/self/statm", "rb")
+    except IOError:
+        return None
+    try:
+        pages = int(f.read().split()[1])
+    finally:
+        f.close()
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+def peak_rss(who):
+    # biggest resident set size in bytes, of this process 
+    # (RUSAGE_SELF) or of the waited child processes (RUSAGE_CHILDREN)
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+class Stage:
+    # wall and cpu time of a block, peak RSS sampled meanwhile
+    def __init__(self, name, size_mb):
+        self.name = name
+        self.size_mb = size_mb
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self.running = True
+        self.sampler = threading.Thread(target=self.sample)
+        self.sampler.daemon = True
+        self.sampler.start()
+        self.times = os.times()
+        self.start = time.time()
+        return self
+
+    def sample(self):
+        while self.running:
+            rss = current_rss()
+            if rss is not None and rss > self.peak:
+                self.peak = rss
+            time.sleep(0.02)
+
+    def __exit__(self, *args):
+        self.wall = time.time() - self.start
+        end = os.times()
+        self.running = False
+        self.sampler.join()
+        # own and children cpu time
+        self.cpu = sum(end[0:4]) - sum(self.times[0:4])
+
+    def result(self):
+        r = {
+            'wall_s' : round(self.wall, 4),
+            'cpu_s' : round(self.cpu, 4),
+            'mb_per_s' : None,
+            'peak_rss_mb' : None,
+        }
+        if self.wall > 0:
+            r['mb_per_s'] = round(self.size_mb / self.wall, 2)
+        if self.peak is not None:
+            r['peak_rss_mb'] = round(self.peak / 1024.0 / 1024.0, 1)
+        return r
+
+def git_revision():
+    try:
+        p = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return p.communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def quote(arg):
+    return '"%s"' % (arg,)
+
+def pick_connections(store, count):
+    # the biggest connection of each protocol port, then the biggest
+    # ones, count in total
+    tbytes = store.get_column('tbytes')
+    indexes = sorted(range(len(store)), key=lambda i: tbytes[i], reverse=True)
+    picked = list()
+    ports = set()
+    for i in indexes:
+        conn = store[i]
+        port = (conn['type'], min(int(conn['src_port']), int(conn['dest_port'])))
+        if port not in ports:
+            ports.add(port)
+            picked.append(i)
+    for i in indexes:
+        if i not in picked:
+            picked.append(i)
+    return picked[:count]
+
+def RunBenchmark(args):
+    results = {
+        'time' : time.strftime("%Y-%m-%d %H:%M:%S"),
+        'revision' : git_revision(),
+        'params' : vars(args).copy(),
+        'stages' : dict(),
+    }
+
+    work_dir = tempfile.mkdtemp(prefix="npa-bench-")
+    try:
+        # the capture directory as laid out by the upload
+        save_dir = work_dir + os.sep
+        uuid = "00000000-0000-0000-0000-000000000000"
+        os.mkdir(save_dir + uuid)
+        main_cap = save_dir + uuid + "\\main.cap"
+
+        if args.capture:
+            shutil.copyfile(args.capture, main_cap)
+            capture = {'filename' : args.capture}
+        else:
+            capture = GenerateCapture(main_cap, args.size_mb, args.packets,
+                args.conversations, args.mix, args.seed)
+            capture['filename'] = None
+        size_mb = os.path.getsize(main_cap) / 1024.0 / 1024.0
+        capture['size_mb'] = round(size_mb, 2)
+        results['capture'] = capture
+
+        script = quote(sys.executable) + " " + quote(os.path.abspath(__file__))
+        delays = "--delay %s --delay-per-mb %s" % (args.tshark_delay,
+            args.tshark_delay_per_mb)
+        if args.real_tshark:
+            tshark = quote(args.real_tshark)
+        else:
+            tshark = "%s fake-tshark %s" % (script, delays)
+            if args.replay:
+                tshark += " --replay " + quote(os.path.abspath(args.replay))
+        if args.real_capinfos:
+            capinfos = quote(args.real_capinfos)
+        else:
+            capinfos = "%s fake-capinfos %s" % (script, delays)
+
+        # modules read the configuration when imported
+        config.default_config.update({
+            'save_dir' : save_dir,
+            'tshark' : tshark,
+            'capinfos' : capinfos,
+            'native_extract' : not args.no_native,
+            'tshark_batch' : not args.no_batch,
+            'split_top_n' : args.split_top_n,
+        })
+        from task import TaskExtractCapture, TaskSplitCapture, \
+            TaskAnalyzeConnection, FAILED
+        from connstore import OpenConnectionStore
+
+        def run_task(task):
+            task.run()
+            # done tasks are told OK by their files, only failure is kept
+            status = task.get_status()
+            if status['status'] == FAILED:
+                raise RuntimeError("%s: %s" % (task.get_key(), status))
+
+        stage = Stage('extract', size_mb)
+        with stage:
+            run_task(TaskExtractCapture(uuid))
+        results['stages']['extract'] = stage.result()
+
+        if args.split_top_n >= 0:
+            stage = Stage('split', size_mb)
+            with stage:
+                run_task(TaskSplitCapture(uuid))
+            results['stages']['split'] = stage.result()
+
+        store = OpenConnectionStore(save_dir + uuid + "\\main.conns",
+            save_dir + uuid + "\\main.bin")
+        try:
+            capture['connections'] = len(store)
+            indexes = pick_connections(store, args.analyze)
+        finally:
+            store.close()
+
+        stage = Stage('analyze', size_mb)
+        with stage:
+            for index in indexes:
+                run_task(TaskAnalyzeConnection(uuid, index))
+        results['stages']['analyze'] = stage.result()
+        results['stages']['analyze']['connections'] = len(indexes)
+
+        results['peak_rss_mb'] = None
+        results['children_peak_rss_mb'] = None
+        if resource is not None:
+            results['peak_rss_mb'] = round(
+                peak_rss(resource.RUSAGE_SELF) / 1024.0 / 1024.0, 1)
+            results['children_peak_rss_mb'] = round(
+                peak_rss(resource.RUSAGE_CHILDREN) / 1024.0 / 1024.0, 1)
+    finally:
+        if args.keep:
+            print "Kept %s" % (work_dir,)
+        else:
+            shutil.rmtree(work_dir, True)
+
+    return results
+
+def print_results(results):
+    capture = results['capture']
+    print "Capture: %.2f MB, %s connections" % (capture['size_mb'],
+        capture.get('connections'))
+    print "%-10s %10s %10s %10s %12s" % ('stage', 'wall s', 'cpu s', 'MB/s', 'peak RSS MB')
+    for name in ('extract', 'split', 'analyze'):
+        stage = results['stages'].get(name)
+        if stage is None:
+            continue
+        print "%-10s %10.3f %10.3f %10s %12s" % (name, stage['wall_s'],
+            stage['cpu_s'], stage['mb_per_s'], stage['peak_rss_mb'])
+    print "Peak RSS MB: self %s, children %s" % (results.get('peak_rss_mb'),
+        results.get('children_peak_rss_mb'))
+
+def CompareResults(old, new):
+    # returns lines comparing the stages of two runs
+    lines = ["%-10s %10s %10s %8s" % ('stage', 'old s', 'new s', 'change')]
+    for name in ('extract', 'split', 'analyze'):
+        a = old['stages'].get(name)
+        b = new['stages'].get(name)
+        if a is None or b is None:
+            continue
+        change = ""
+        if a['wall_s'] > 0:
+            change = "%+.1f%%" % ((b['wall_s'] - a['wall_s']) * 100.0 / a['wall_s'],)
+        lines.append("%-10s %10.3f %10.3f %8s" % (name, a['wall_s'], b['wall_s'], change))
+    return lines
+
+def load_results(filename):
+    f = open(filename, "rb")
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def add_capture_options(parser):
+    parser.add_argument('--size-mb', type=float, default=None,
+        help="size of the generated capture (default 10)")
+    parser.add_argument('--packets', type=int, default=None,
+        help="number of packets instead of a size")
+    parser.add_argument('--conversations', type=int, default=100)
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+        help="protocol weights, protocols: " + ", ".join(PROTOCOLS))
+    parser.add_argument('--seed', type=int, default=1)
+
+def main(argv):
+    if len(argv) > 0 and argv[0] == 'fake-tshark':
+        return FakeTShark(argv[1:])
+    if len(argv) > 0 and argv[0] == 'fake-capinfos':
+        return FakeCapInfos(argv[1:])
+
+    parser = argparse.ArgumentParser(description="NPA benchmark")
+    commands = parser.add_subparsers(dest='command')
+
+    run = commands.add_parser('run', help="run the pipeline on a capture")
+    add_capture_options(run)
+    run.add_argument('--capture', default=None,
+        help="use this capture instead of a generated one")
+    run.add_argument('--analyze', type=int, default=5,
+        help="number of connections to analyze")
+    run.add_argument('--tshark-delay', type=float, default=0.0,
+        help="seconds added to each fake tshark/capinfos run")
+    run.add_argument('--tshark-delay-per-mb', type=float, default=0.0,
+        help="seconds per MB of capture added to each fake run")
+    run.add_argument('--replay', default=None,
+        help="directory of recorded tshark outputs")
+    run.add_argument('--real-tshark', default=None)
+    run.add_argument('--real-capinfos', default=None)
+    run.add_argument('--no-native', action='store_true',
+        help="extract connections with tshark")
+    run.add_argument('--no-batch', action='store_true',
+        help="one tshark run per statistic")
+    run.add_argument('--split-top-n', type=int, default=32)
+    run.add_argument('--output', default=None,
+        help="json file of the results (default benchmark-<time>.json)")
+    run.add_argument('--compare', default=None,
+        help="json file of a previous run")
+    run.add_argument('--keep', action='store_true',
+        help="keep the working directory")
+
+    generate = commands.add_parser('generate', help="write a capture")
+    generate.add_argument('filename')
+    add_capture_options(generate)
+
+    compare = commands.add_parser('compare', help="compare two runs")
+    compare.add_argument('old')
+    compare.add_argument('new')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        capture = GenerateCapture(args.filename, args.size_mb, args.packets,
+            args.conversations, args.mix, args.seed)
+        print "%s: %.2f MB, %d packets" % (args.filename, capture['size_mb'],
+            capture['packets'])
+        return 0
+
+    if args.command == 'compare':
+        for line in CompareResults(load_results(args.old), load_results(args.new)):
+            print line
+        return 0
+
+    results = RunBenchmark(args)
+    print_results(results)
+
+    output = args.output
+    if output is None:
+        output = "benchmark-%s.json" % (time.strftime("%Y%m%d-%H%M%S"),)
+    f = open(output, "wb")
+    try:
+        json.dump(results, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+    print "Saved %s" % (output,)
+
+    if args.compare:
+        for line in CompareResults(load_results(args.compare), results):
+            print line
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
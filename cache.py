@@ -0,0 +1,116 @@
+import threading
+import os
+import gzip
+import cPickle
+
+from collections import OrderedDict
+from cStringIO import StringIO
+
+from atomicfile import write_file
+from config import GlobalConfig
+
+__all__ = [
+    'get_pickle_cache',
+    'load_rendered_page',
+    'save_rendered_page',
+    'gunzip_page',
+]
+
+conf = GlobalConfig()
+
+pickle_cache = None
+
+def get_pickle_cache():
+    global pickle_cache
+    return pickle_cache
+
+# LRU of unpickled files (main.bin, <index>.bin) shared by all
+# request threads. An entry is used only while its file keeps the
+# same mtime and size, and is weighted by the file size.
+# Loaded objects are shared, callers must not change them.
+class PickleCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # filename -> ((mtime, size), object), oldest first
+        self.entries = OrderedDict()
+        self.total_bytes = 0L
+
+    def load(self, filename):
+        # raises os.error if the file does not exist
+        stat = os.stat(filename)
+        signature = (stat.st_mtime, stat.st_size)
+
+        with self.lock:
+            entry = self.entries.pop(filename, None)
+            if entry is not None:
+                if entry[0] == signature:
+                    # hit, move it to the newest end
+                    self.entries[filename] = entry
+                    return entry[1]
+                # file changed
+                self.total_bytes -= entry[0][1]
+
+        f = open(filename, "rb")
+        try:
+            obj = cPickle.load(f)
+        finally:
+            f.close()
+
+        with self.lock:
+            old = self.entries.pop(filename, None)
+            if old is not None:
+                self.total_bytes -= old[0][1]
+            self.entries[filename] = (signature, obj)
+            self.total_bytes += signature[1]
+
+            # evict the oldest ones, always keep the newest
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                (name, (sig, o)) = self.entries.popitem(last=False)
+                self.total_bytes -= sig[1]
+
+        return obj
+
+    def invalidate(self, filename):
+        with self.lock:
+            entry = self.entries.pop(filename, None)
+            if entry is not None:
+                self.total_bytes -= entry[0][1]
+
+pickle_cache = PickleCache(conf.get('pickle_cache_in_mb') * 1024L * 1024L)
+
+# Rendered pages of finished results are kept gzipped on disk, next
+# to the result. The name of the file holds the key (result file and
+# template version), a page is never changed, only replaced.
+def load_rendered_page(filename):
+    # gzipped page, or None if not there
+    try:
+        f = open(filename, "rb")
+    except IOError:
+        return None
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def save_rendered_page(filename, html):
+    # returns the gzipped page
+    buf = StringIO()
+    z = gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=9)
+    try:
+        z.write(html.encode('utf-8'))
+    finally:
+        z.close()
+    data = buf.getvalue()
+
+    # first views of a page can come at the same time
+    write_file(filename, lambda f: f.write(data))
+    return data
+
+def gunzip_page(data):
+    # for clients not taking gzip
+    z = gzip.GzipFile(fileobj=StringIO(data), mode="rb")
+    try:
+        return z.read()
+    finally:
+        z.close()
@@ -1,11 +1,20 @@
 from config import GlobalConfig
+from metrics import *
 from subprocess import *
+import threading
+import errno
+import time
+import sys
+import os
 import re
 import copy
+import shlex
+import tempfile
 
 __all__ = [
     'GetAllTCPConns',
     'GetAllUDPConns',
+    'TCPConvCount',
     'FilterTCPConn',
     'FilterUDPConn',
     'CapInfos',
@@ -34,12 +43,181 @@ __all__ = [
     'NFSV4WriteSize',
     'SMBType',
     'NFSType',
+    'CommandBatch',
+    'run_parallel',
 ]
 
+# don't leak pipes of one command into another one running 
+# at the same time (not supported with pipes on Windows)
+close_fds = (os.name != 'nt')
+
+# Windows takes the command line as it is, elsewhere it is split
+# like a shell would. Backslashes are part of the names (save_dir).
+def command_args(cmd):
+    if os.name == 'nt':
+        return cmd
+    lex = shlex.shlex(cmd, posix=True)
+    lex.whitespace_split = True
+    lex.escape = ''
+    return list(lex)
+
+# Metrics of the command runs, labelled by command class and protocol
+COMMAND_BUCKETS = [0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800]
+command_runs = Counter('npa_command_runs_total',
+    'Commands run', ('command', 'protocol', 'exit_code'))
+command_seconds = Histogram('npa_command_seconds',
+    'Wall time of commands', ('command', 'protocol'), COMMAND_BUCKETS)
+# CPU time and peak size are told by os.wait4, POSIX only: there
+# are no such metrics on Windows
+command_cpu_seconds = None
+command_peak_rss = None
+if hasattr(os, 'wait4'):
+    command_cpu_seconds = Counter('npa_command_cpu_seconds_total',
+        'User and system time of commands', ('command', 'protocol'))
+    command_peak_rss = Gauge('npa_command_peak_rss_bytes',
+        'Largest peak resident size of a command', ('command', 'protocol'))
+command_stdout_bytes = Counter('npa_command_stdout_bytes_total',
+    'Output read from commands', ('command', 'protocol'))
+command_input_bytes = Counter('npa_command_input_bytes_total',
+    'Size of the capture files given to commands', ('command', 'protocol'))
+
+# (class name prefix, protocol), the first match wins
+COMMAND_PROTOCOLS = [
+    ('SMB2', 'smb2'),
+    ('SMB', 'smb'),
+    ('NFSV3', 'nfsv3'),
+    ('NFSV4', 'nfsv4'),
+    ('NFS', 'nfs'),
+    ('iSCSI', 'iscsi'),
+    ('TCP', 'tcp'),
+    ('UDP', 'udp'),
+    ('GetAllTCP', 'tcp'),
+    ('GetAllUDP', 'udp'),
+    ('FilterTCP', 'tcp'),
+    ('FilterUDP', 'udp'),
+]
+
+def command_protocol(name):
+    for (prefix, protocol) in COMMAND_PROTOCOLS:
+        if name.startswith(prefix):
+            return protocol
+    return 'general'
+
+def start_command(cmd, bufsize=0):
+    # stderr goes to a temporary file, it can't fill up a pipe
+    # nobody reads
+    err = tempfile.TemporaryFile()
+    try:
+        p = Popen(command_args(cmd), bufsize=bufsize, stdout=PIPE, stderr=err, 
+            close_fds=close_fds)
+    except:
+        err.close()
+        raise
+    p.errfile = err
+    p.started = time.time()
+    return p
+
+def wait_command(p):
+    # wait for the exit, returns (cpu seconds, peak rss bytes) of
+    # the command, None where the system doesn't tell (Windows).
+    # p.returncode stays None if the exit code is lost
+    if not hasattr(os, 'wait4'):
+        p.wait()
+        return (None, None)
+    while True:
+        try:
+            (pid, status, usage) = os.wait4(p.pid, 0)
+            break
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                # already reaped elsewhere, its status is gone
+                return (None, None)
+            raise
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    # kilobytes, bytes on Mac OS
+    rss = usage.ru_maxrss
+    if sys.platform != 'darwin':
+        rss *= 1024
+    return (usage.ru_utime + usage.ru_stime, rss)
+
+def finish_command(p, labels, input_size, output_size):
+    # wait for a command of start_command, record its metrics.
+    # labels is the labels of the command, or a list of them for a
+    # merged run: each member is recorded as run once with an equal
+    # share of the time and sizes, the peak size is the whole run's
+    p.stdout.close()
+    try:
+        (cpu, rss) = wait_command(p)
+    finally:
+        p.errfile.close()
+
+    if p.returncode is None:
+        exit_code = 'unknown'
+    else:
+        exit_code = str(p.returncode)
+    if isinstance(labels, tuple):
+        labels = [labels]
+    share = 1.0 / len(labels)
+    wall = time.time() - p.started
+    for member in labels:
+        command_runs.inc(member + (exit_code,))
+        command_seconds.observe(member, wall * share)
+        command_stdout_bytes.inc(member, output_size * share)
+        if input_size is not None:
+            command_input_bytes.inc(member, input_size * share)
+        if cpu is not None:
+            command_cpu_seconds.inc(member, cpu * share)
+            command_peak_rss.set_max(member, rss)
+
+# Run each job (a callable) in a thread, at most limit at the same time.
+# The first exception raised by a job is raised again once all 
+# started jobs are done.
+def run_parallel(jobs, limit):
+    jobs = list(jobs)
+    if limit <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            job()
+        return
+        
+    lock = threading.Lock()
+    errors = list()
+    
+    def worker():
+        while True:
+            with lock:
+                if len(jobs) == 0 or len(errors) > 0:
+                    return
+                job = jobs.pop(0)
+            try:
+                job()
+            except:
+                with lock:
+                    errors.append(sys.exc_info())
+                    
+    threads = [threading.Thread(target=worker) for i in range(min(limit, len(jobs)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+        
+    if len(errors) > 0:
+        (t, v, tb) = errors[0]
+        raise t, v, tb
+
 #sub class needs to provide
 # compose_command(self)
 # parse_command(self)
+# or instead of parse_command, for outputs with one row per line
+# parse_line(self, line), returns the row or None. The output is then
+# parsed while it is read, and never kept as a whole.
 class BaseCommand:
+    parse_line = None
+    
     def __init__(self, params):
         self.config = GlobalConfig()
         self.params = params
@@ -48,27 +226,276 @@ class BaseCommand:
         self.parsed_output = dict()
         
     def execute(self):
+        if self.parse_line is not None:
+            self.parsed_output = list(self.rows())
+            return copy.copy(self.parsed_output)
+            
         # execute
         # print "### Execute %s in class %s" % (self.command, self.__class__.__name__)
-        (raw_output, e) = Popen(self.command , stdout=PIPE, stderr=PIPE).communicate()
-        self.raw_output = raw_output
+        p = start_command(self.command)
+        raw_output = ''
+        try:
+            raw_output = p.stdout.read()
+        finally:
+            finish_command(p, self.get_metric_labels(), self.get_input_size(), 
+                len(raw_output))
         # print "### Raw output %s" % raw_output
-        self.parsed_output = self.parse_command()
+        self.put_raw_output(raw_output)
         # print "### Raw output Done"
         return copy.copy(self.parsed_output)
         
+    def put_raw_output(self, raw_output):
+        self.raw_output = raw_output
+        self.parsed_output = self.parse_command()
+        
+    def parse_command(self):
+        # for line parsers given the whole output (batch)
+        result = list()
+        for line in self.raw_output.split('\n'):
+            row = self.parse_line(line)
+            if row is not None:
+                result.append(row)
+        return result
+        
+    def lines(self):
+        # run the command, yield the lines of stdout as they come.
+        # Stopping early kills the command.
+        # buffered, unbuffered pipes read a byte at a time
+        p = start_command(self.command, bufsize=-1)
+        size = 0
+        done = False
+        try:
+            for line in iter(p.stdout.readline, ''):
+                size += len(line)
+                yield line
+            done = True
+        finally:
+            if not done:
+                try:
+                    p.kill()
+                except OSError:
+                    # just exited
+                    pass
+            finish_command(p, self.get_metric_labels(), self.get_input_size(), size)
+            
+    def rows(self):
+        # run the command, yield rows of parse_line as they come
+        for line in self.lines():
+            row = self.parse_line(line)
+            if row is not None:
+                yield row
+        
     def get_command(self):
         return self.command
         
+    def get_metric_labels(self):
+        name = self.__class__.__name__
+        return (name, command_protocol(name))
+        
+    def get_input_size(self):
+        # size of the capture file read, None if there is none
+        if 'filename' not in self.params:
+            return None
+        try:
+            return os.path.getsize(self.params['filename'])
+        except os.error:
+            return None
+        
     def get_raw_output(self):
         return self.raw_output
     
     def get_parsed_output(self):
         return copy.copy(self.parsed_output)
         
+    def get_stat_prefix(self):
+        # every "-z" statistic command starts with this prefix,
+        # commands with the same prefix can share one tshark run
+        if 'filename' not in self.params:
+            return None
+        return "{tshark} -n -q -r {filename}".format(
+            tshark=self.config.get('tshark'),
+            filename=self.params['filename'])
+        
+    def get_stat_args(self):
+        # return the "-z ..." part of the command, or None if 
+        # the command can't be merged with others
+        prefix = self.get_stat_prefix()
+        if prefix is None or not self.command.startswith(prefix + " "):
+            return None
+        args = self.command[len(prefix):].strip()
+        if not args.startswith("-z "):
+            return None
+        return args
+        
 
+# Collect commands and execute them together. In batch mode all 
+# statistic commands reading the same file are merged into a single 
+# tshark run with several "-z", so the file is dissected only once.
+# The combined output is split back and given to each command's 
+# parse_command, each block to the command whose statistic it shows
+# (tshark does not keep the order of the "-z"). 
+# Independent runs are executed concurrently, at most 
+# 'analysis_parallelism' at the same time.
+class CommandBatch:
+    def __init__(self):
+        self.config = GlobalConfig()
+        self.commands = list()
+        
+    def add(self, command):
+        self.commands.append(command)
+        return command
+        
+    def execute(self):
+        jobs = list()
+        
+        if not self.config.get('tshark_batch'):
+            for command in self.commands:
+                jobs.append(command.execute)
+        else:
+            # group by prefix, keep the order of commands
+            groups = dict()
+            prefixes = list()
+            for command in self.commands:
+                if command.get_stat_args() is None:
+                    jobs.append(command.execute)
+                    continue
+                prefix = command.get_stat_prefix()
+                if prefix not in groups:
+                    groups[prefix] = list()
+                    prefixes.append(prefix)
+                groups[prefix].append(command)
+                
+            for prefix in prefixes:
+                group = groups[prefix]
+                if len(group) == 1:
+                    jobs.append(group[0].execute)
+                else:
+                    jobs.append(lambda prefix=prefix, group=group: 
+                        self.execute_merged(prefix, group))
+                
+        run_parallel(jobs, self.config.get('analysis_parallelism'))
+                
+    def execute_merged(self, prefix, group):
+        args = [command.get_stat_args() for command in group]
+        cmd = prefix + " " + " ".join(args)
+        
+        labels = [command.get_metric_labels() for command in group]
+        p = start_command(cmd)
+        raw_output = ''
+        try:
+            raw_output = p.stdout.read()
+        finally:
+            finish_command(p, labels, group[0].get_input_size(), len(raw_output))
+        
+        blocks = self.match_blocks(group, self.split_output(raw_output))
+        if blocks is None:
+            # can't tell which block belongs to which command,
+            # fall back to one run per command
+            self.execute_each(group)
+            return
+        
+        try:
+            for (command, block) in zip(group, blocks):
+                command.put_raw_output(block)
+        except:
+            # output does not match the parser, fall back
+            self.execute_each(group)
+            
+    def execute_each(self, group):
+        # one run per command, concurrently
+        run_parallel([command.execute for command in group], 
+            self.config.get('analysis_parallelism'))
+                
+    @staticmethod
+    def normalize_text(text):
+        # tshark pads and wraps the texts it shows in a block
+        return re.sub(r'[\s|"]+', '', text).lower()
+        
+    @staticmethod
+    def block_texts(args):
+        # texts found in the output block of the statistic "-z tap", 
+        # normalized: the kind of statistic and its filters
+        tap = shlex.split(args)[1]
+        items = tap.split(',')
+        if items[0] == 'io':
+            # io,stat,interval,column...: "Col N: <column>" lines
+            texts = ['IO Statistics'] + items[3:]
+        else:
+            # conv,tcp[,filter], smb,srt[,filter], rpc,srt,program,
+            # version[,filter], ...: a title and a "Filter:" line
+            texts = [items[0]] + [item for item in items[1:] 
+                if re.search(r'[.=<>]', item)]
+            if items[0] == 'conv':
+                texts.append(items[1])
+        return [CommandBatch.normalize_text(text) for text in texts if text]
+        
+    @staticmethod
+    def match_blocks(group, blocks):
+        # blocks in the order of the commands of group, or None if 
+        # they can't be told apart: a command takes the block with all
+        # its texts, io,stat blocks go to io,stat commands only, and 
+        # there must be exactly one way to give a block to every one
+        if len(blocks) != len(group):
+            return None
+        io_texts = CommandBatch.normalize_text('IO Statistics')
+        blocks_text = [CommandBatch.normalize_text(block) for block in blocks]
+        fits = list()
+        for command in group:
+            texts = CommandBatch.block_texts(command.get_stat_args())
+            is_io = io_texts in texts
+            fits.append([j for (j, text) in enumerate(blocks_text)
+                if (io_texts in text) == is_io and 
+                    all([t in text for t in texts])])
+        
+        found = list()
+        def search(i, chosen):
+            if len(found) > 1:
+                return
+            if i == len(group):
+                found.append(list(chosen))
+                return
+            for j in fits[i]:
+                if j not in chosen:
+                    chosen.append(j)
+                    search(i + 1, chosen)
+                    chosen.pop()
+        search(0, list())
+        
+        if len(found) != 1:
+            return None
+        return [blocks[j] for j in found[0]]
+        
+    @staticmethod
+    def split_output(raw_output):
+        # each statistic is printed between two "=====" lines
+        pat = re.compile(r'^=+\s*$')
+        
+        blocks = list()
+        cur_lines = None
+        lines = raw_output.split('\n')
+        
+        for line in lines:
+            if pat.match(line):
+                if cur_lines is None:
+                    # begin of a block
+                    cur_lines = [line]
+                else:
+                    # end of a block
+                    cur_lines.append(line)
+                    blocks.append('\n'.join(cur_lines))
+                    cur_lines = None
+            elif cur_lines is not None:
+                cur_lines.append(line)
+                
+        return blocks
+        
 # Input parameters: filename        
 class GetAllTCPConns(BaseCommand):
+    pat = re.compile(("(?P<src_ip>[\d\.]+):(?P<src_port>\d+)\s*<->\s*"
+        "(?P<dest_ip>[\d\.]+):(?P<dest_port>\d+)\s+(?P<dframes>\d+)\s+"
+        "(?P<dbytes>\d+)\s+(?P<uframes>\d+)\s+(?P<ubytes>\d+)\s+"
+        "(?P<tframes>\d+)\s+(?P<tbytes>\d+)\s+(?P<start>[\d\.]+)\s+(?P<duration>[\d\.]+)"))
+        
     def compose_command(self):
         newdict = dict(self.params)
         newdict['tshark'] = self.config.get('tshark')
@@ -76,69 +503,85 @@ class GetAllTCPConns(BaseCommand):
         
         return cmd
     
-    def parse_command(self):
-        pat = re.compile(("(?P<src_ip>[\d\.]+):(?P<src_port>\d+)\s*<->\s*"
-            "(?P<dest_ip>[\d\.]+):(?P<dest_port>\d+)\s+(?P<dframes>\d+)\s+"
-            "(?P<dbytes>\d+)\s+(?P<uframes>\d+)\s+(?P<ubytes>\d+)\s+"
-            "(?P<tframes>\d+)\s+(?P<tbytes>\d+)\s+(?P<start>[\d\.]+)\s+(?P<duration>[\d\.]+)"))
-            
-        result = list()
-        lines = self.raw_output.split('\n')
-        
-        for line in lines:
-            match = pat.match(line)
-            if match:
-                d = match.groupdict()
-                d['type'] = 'TCP'
-                d['duration_f'] = float(d['duration'])
-                result.append(d)
-        return result;
+    def parse_line(self, line):
+        match = self.pat.match(line)
+        if match:
+            d = match.groupdict()
+            d['type'] = 'TCP'
+            d['duration_f'] = float(d['duration'])
+            return d
+        return None
         
 
 class GetAllUDPConns(BaseCommand):
+    pat = GetAllTCPConns.pat
+    
     def compose_command(self):
         newdict = dict(self.params)
         newdict['tshark'] = self.config.get('tshark')
         cmd = "{tshark} -n -q -r {filename} -z \"conv,udp\"".format(**newdict)
         return cmd
         
-    def parse_command(self):
-        pat = re.compile(("(?P<src_ip>[\d\.]+):(?P<src_port>\d+)\s*<->\s*"
-            "(?P<dest_ip>[\d\.]+):(?P<dest_port>\d+)\s+(?P<dframes>\d+)\s+"
-            "(?P<dbytes>\d+)\s+(?P<uframes>\d+)\s+(?P<ubytes>\d+)\s+"
-            "(?P<tframes>\d+)\s+(?P<tbytes>\d+)\s+(?P<start>[\d\.]+)\s+(?P<duration>[\d\.]+)"))
-            
-        result = list()
-        lines = self.raw_output.split('\n')
+    def parse_line(self, line):
+        match = self.pat.match(line)
+        if match:
+            d = match.groupdict()
+            d['type'] = 'UDP'
+            d['duration_f'] = float(d['duration'])
+            return d
+        return None
+
+# Input parameters: filename, filter
+# TCP conversations of the packets matching filter, tframes is the
+# number of matching packets of each one. Several filters over one
+# file are merged into one tshark run by CommandBatch.
+class TCPConvCount(BaseCommand):
+    pat = GetAllTCPConns.pat
+    
+    def compose_command(self):
+        newdict = dict(self.params)
+        newdict['tshark'] = self.config.get('tshark')
+        cmd = "{tshark} -n -q -r {filename} -z \"conv,tcp,{filter}\"".format(**newdict)
+        return cmd
         
-        for line in lines:
-            match = pat.match(line)
-            if match:
-                d = match.groupdict()
-                d['type'] = 'UDP'
-                d['duration_f'] = float(d['duration'])
-                result.append(d)
-        return result;
+    def parse_line(self, line):
+        match = self.pat.match(line)
+        if match:
+            return match.groupdict()
+        return None
+
+def time_filter(params):
+    # display filter part for the optional window_start and window_end
+    # parameters, in seconds from the first packet. Not start, the
+    # parameters of a connection have its own start.
+    if 'window_start' not in params:
+        return ""
+    return " && frame.time_relative >= %.3f && frame.time_relative <= %.3f" % (
+        params['window_start'], params['window_end'])
 
 # Input parameters: filename, src_ip, src_port, dest_ip, dest_port, outfilename
+# optional window_start, window_end
 class FilterTCPConn(BaseCommand):
     def compose_command(self):
         newdict = dict(self.params)
         newdict['tshark'] = self.config.get('tshark')
+        newdict['time_filter'] = time_filter(self.params)
         cmd = ("{tshark} -r {filename} -Y \"(ip.addr=={src_ip} && tcp.port=={src_port} " \
-            "&& ip.addr=={dest_ip} && tcp.port=={dest_port})\"  -w {outfilename}").format(**newdict)
+            "&& ip.addr=={dest_ip} && tcp.port=={dest_port}){time_filter}\"  -w {outfilename}").format(**newdict)
         return cmd
                 
     def parse_command(self):
         return None
           
 # Input parameters: filename, src_ip, src_port, dest_ip, dest_port, outfilename
+# optional window_start, window_end
 class FilterUDPConn(BaseCommand):
     def compose_command(self):
         newdict = dict(self.params)
         newdict['tshark'] = self.config.get('tshark')
+        newdict['time_filter'] = time_filter(self.params)
         cmd = ("{tshark} -r {filename} -Y \"(ip.addr=={src_ip} && udp.port=={src_port} " \
-            "&& ip.addr=={dest_ip} && udp.port=={dest_port})\"  -w {outfilename}").format(**newdict)
+            "&& ip.addr=={dest_ip} && udp.port=={dest_port}){time_filter}\"  -w {outfilename}").format(**newdict)
         return cmd
                 
     def parse_command(self):
@@ -22,6 +22,70 @@ default_config = {
     # check interval
     # 5 min
     'check_internal_in_second' : 5 * 60,
+    # when the space used (with room reserved for uploads) goes over
+    # the high watermark, captures are deleted down to the low one.
+    # In percent of max_space_in_mb
+    'space_high_watermark' : 90,
+    'space_low_watermark' : 75,
+    
+    # merge the statistics of one analysis into a single tshark run
+    'tshark_batch' : True,
+    # commands of one analysis task running at the same time
+    'analysis_parallelism' : 4,
+    
+    # read pcap/pcapng headers directly to extract connections,
+    # tshark is used for other formats
+    'native_extract' : True,
+    
+    # after extraction, write the files of the N biggest connections 
+    # in one pass over main.cap, 0 means all, -1 disables it
+    'split_top_n' : 32,
+    
+    # count retransmissions, zero windows, ... of all connections in
+    # one pass over main.cap, the table can then be sorted by them
+    'triage' : True,
+    
+    # then analyze ahead the N biggest connections by 'bytes' or 
+    # 'frames', and the N biggest on storage ports, 0 disables it
+    'prefetch_top_n' : 8,
+    'prefetch_sort' : 'bytes',
+    'prefetch_ports' : [3260, 445, 139, 2049],
+    # runners taken by prefetch tasks at most, 0 means half of them
+    'prefetch_workers' : 0,
+    
+    # number of tasks running at the same time, 0 means one per core
+    'task_workers' : 0,
+    # tasks are weighted by the size of the capture they read
+    'task_memory_budget_in_mb' : 8 * 1024,
+    # a task waiting that long for room in the budget is not passed
+    # any more by smaller ones
+    'task_max_wait_in_second' : 60,
+    
+    # unpickled main.bin/<index>.bin kept in memory by the web pages
+    'pickle_cache_in_mb' : 256,
+    # share runners fairly per 'capture' or per 'client' address
+    'task_fair_share' : 'capture',
+    
+    # connections per page of the connection table
+    'conn_page_size' : 100,
+    # most connections returned by one query of the connection API
+    'conn_page_limit' : 1000,
+    
+    # chunk size of resumable uploads
+    'upload_chunk_in_mb' : 8,
+    # largest capture a resumable upload can open, it takes its full
+    # size on disk from the start
+    'upload_max_size_in_mb' : 4 * 1024,
+    # an upload that did not write for that long is taken as broken
+    # (server stopped during the upload), its extraction fails
+    'upload_stale_in_second' : 10 * 60,
+    
+    # longest wait of a status request for a change (long-poll and
+    # events), clients ask again after it
+    'status_wait_in_second' : 25,
+    # browsers keep the pages and data of finished results this long,
+    # then ask again (answered with 304 if nothing changed)
+    'result_max_age_in_second' : 24 * 60 * 60,
     
 }
 
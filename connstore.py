@@ -0,0 +1,403 @@
+import mmap
+import os
+import socket
+import struct
+import threading
+import cPickle
+
+from atomicfile import write_file
+
+__all__ = [
+    'SORT_KEYS',
+    'TRIAGE_COUNTERS',
+    'TRIAGE_SORT_KEYS',
+    'ConnectionStore',
+    'WriteConnectionStore',
+    'OpenConnectionStore',
+    'WriteTriage',
+]
+
+# File layout
+#   header: magic, version, number of connections
+#   one column after the other, each value has a fixed width
+#   one sort order per key of SORT_KEYS, indexes in ascending order
+#   one lookup order per column of LOOKUP_COLUMNS, same
+# Reading connection i only touches the i-th value of each column,
+# reading a whole column (to sort, to filter) touches one region.
+STORE_MAGIC = "NPACONNS"
+STORE_VERSION = 2
+HEADER = struct.Struct("<8sII")
+
+# (name, struct code)
+COLUMNS = [
+    ('src_ip', '4s'),
+    ('src_port', 'H'),
+    ('dest_ip', '4s'),
+    ('dest_port', 'H'),
+    ('dframes', 'Q'),
+    ('dbytes', 'Q'),
+    ('uframes', 'Q'),
+    ('ubytes', 'Q'),
+    ('tframes', 'Q'),
+    ('tbytes', 'Q'),
+    ('start', 'd'),
+    ('duration', 'd'),
+    ('type', 'B'),
+]
+
+# sort key -> column
+SORT_KEYS = {
+    'bytes' : 'tbytes',
+    'frames' : 'tframes',
+    'start' : 'start',
+    'duration' : 'duration',
+}
+
+# TCP analysis counters of each connection (packets), counted over
+# the whole capture after extraction, see WriteTriage
+TRIAGE_COUNTERS = ['retrans', 'zerowin', 'sack', 'delayack']
+
+# triage sort key -> field, usable once the triage is attached
+TRIAGE_SORT_KEYS = {
+    'retrans_rate' : 'retrans_rate',
+    'zerowin' : 'zerowin',
+}
+TRIAGE_VERSION = 1
+
+# columns with a lookup order, to find connections by value
+LOOKUP_COLUMNS = ['src_ip', 'dest_ip', 'src_port', 'dest_port', 'type']
+
+ORDER_CODE = 'I'
+
+TYPE_CODES = {
+    'TCP' : 6,
+    'UDP' : 17,
+}
+TYPE_NAMES = dict([(v, k) for (k, v) in TYPE_CODES.items()])
+
+def column_format(code, count):
+    # struct format of a whole column
+    if code.endswith('s'):
+        # "20s" would be one string of 20 bytes
+        return "<" + code * count
+    return "<%d%s" % (count, code)
+
+def column_layout(count):
+    # returns dict of name -> (offset, struct code, size)
+    layout = dict()
+    offset = HEADER.size
+    for (name, code) in COLUMNS:
+        size = struct.calcsize("<" + code)
+        layout[name] = (offset, code, size)
+        offset += size * count
+    size = struct.calcsize("<" + ORDER_CODE)
+    for name in order_names():
+        layout[name] = (offset, ORDER_CODE, size)
+        offset += size * count
+    return layout
+
+def order_names():
+    names = ['order_' + key for key in sorted(SORT_KEYS.keys())]
+    names.extend(['lookup_' + name for name in LOOKUP_COLUMNS])
+    return names
+    
+def order_column(name):
+    if name.startswith('order_'):
+        return SORT_KEYS[name[len('order_'):]]
+    return name[len('lookup_'):]
+
+# Write the connection list (items as given by ExtractConversations
+# or GetAllTCPConns/GetAllUDPConns) into filename.
+def WriteConnectionStore(filename, conn_list):
+    count = len(conn_list)
+
+    values = dict()
+    values['src_ip'] = [socket.inet_aton(c['src_ip']) for c in conn_list]
+    values['dest_ip'] = [socket.inet_aton(c['dest_ip']) for c in conn_list]
+    values['type'] = [TYPE_CODES[c['type']] for c in conn_list]
+    for name in ('src_port', 'dest_port', 'dframes', 'dbytes', 'uframes',
+        'ubytes', 'tframes', 'tbytes'):
+        values[name] = [long(c[name]) for c in conn_list]
+    for name in ('start', 'duration'):
+        values[name] = [float(c[name]) for c in conn_list]
+
+    def write(f):
+        f.write(HEADER.pack(STORE_MAGIC, STORE_VERSION, count))
+        for (name, code) in COLUMNS:
+            f.write(struct.pack(column_format(code, count), *values[name]))
+        for name in order_names():
+            column = values[order_column(name)]
+            order = sorted(range(count), key=column.__getitem__)
+            f.write(struct.pack(column_format(ORDER_CODE, count), *order))
+            
+    write_file(filename, write)
+
+def endpoints_key(src_ip, src_port, dest_ip, dest_port):
+    # same key for both directions of a connection, addresses
+    # packed as in the store
+    a = (src_ip, int(src_port))
+    b = (dest_ip, int(dest_port))
+    return (min(a, b), max(a, b))
+
+# Write the triage of the connections of store into filename.
+# counts: counter of TRIAGE_COUNTERS -> conversation rows (as given by
+# TCPConvCount) of the packets matching it. Rows are matched to TCP 
+# connections by their endpoints.
+# The triage is a dict of
+#   counter -> value per connection index
+#   'retrans_rate' -> retransmitted packets / packets per index
+#   'order_<key>' -> indexes in ascending order, for TRIAGE_SORT_KEYS
+def WriteTriage(filename, store, counts):
+    count = len(store)
+    
+    keys = dict()
+    columns = [store.get_column(name) for name in 
+        ('src_ip', 'src_port', 'dest_ip', 'dest_port', 'type')]
+    for (i, (src_ip, src_port, dest_ip, dest_port, kind)) in enumerate(zip(*columns)):
+        if kind == TYPE_CODES['TCP']:
+            # a 4-tuple used again counts for the first connection
+            keys.setdefault(endpoints_key(src_ip, src_port, 
+                dest_ip, dest_port), i)
+    
+    triage = dict(version=TRIAGE_VERSION, count=count)
+    for name in TRIAGE_COUNTERS:
+        values = [0L] * count
+        for row in counts.get(name, []):
+            i = keys.get(endpoints_key(socket.inet_aton(row['src_ip']), 
+                row['src_port'], socket.inet_aton(row['dest_ip']), 
+                row['dest_port']))
+            if i is not None:
+                values[i] += long(row['tframes'])
+        triage[name] = values
+        
+    tframes = store.get_column('tframes')
+    triage['retrans_rate'] = [float(n) / f if f > 0 else 0.0
+        for (n, f) in zip(triage['retrans'], tframes)]
+    for (key, name) in TRIAGE_SORT_KEYS.items():
+        triage['order_' + key] = sorted(range(count), 
+            key=triage[name].__getitem__)
+    
+    write_file(filename, 
+        lambda f: cPickle.dump(triage, f, cPickle.HIGHEST_PROTOCOL))
+
+def is_current_store(filename):
+    try:
+        f = open(filename, "rb")
+    except IOError:
+        return False
+    try:
+        data = f.read(HEADER.size)
+    finally:
+        f.close()
+    if len(data) < HEADER.size:
+        return False
+    (magic, version, count) = HEADER.unpack(data)
+    return magic == STORE_MAGIC and version == STORE_VERSION
+
+# conns_file -> lock, one build of a store at a time
+build_locks = dict()
+build_locks_lock = threading.Lock()
+
+# Open main.conns, build it from main.bin first if it is not there
+# or has an older layout (captures extracted before). Requests on
+# the same capture wait for the one building it.
+def OpenConnectionStore(conns_file, bin_file):
+    if not is_current_store(conns_file):
+        with build_locks_lock:
+            lock = build_locks.setdefault(conns_file, threading.Lock())
+        with lock:
+            if not is_current_store(conns_file):
+                f = open(bin_file, "rb")
+                try:
+                    conns = cPickle.load(f)
+                finally:
+                    f.close()
+                WriteConnectionStore(conns_file, conns['conn_list'])
+        with build_locks_lock:
+            build_locks.pop(conns_file, None)
+    return ConnectionStore(conns_file)
+
+# Random access to the connection list through mmap, without
+# loading it. Items are the same dicts as in main.bin, with the
+# counters of the triage once attached.
+# Must be closed after use, the mapping keeps the file open.
+class ConnectionStore:
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename, "rb")
+        try:
+            self.buf = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self.f.close()
+            raise
+
+        (magic, version, count) = HEADER.unpack_from(self.buf, 0)
+        if magic != STORE_MAGIC or version != STORE_VERSION:
+            self.close()
+            raise ValueError("Not a connection store: %s" % filename)
+
+        self.count = count
+        self.layout = column_layout(count)
+        self.triage = None
+
+    def set_triage(self, triage):
+        # triage as written by WriteTriage (shared, not changed),
+        # adds the TRIAGE_SORT_KEYS
+        if triage.get('version') != TRIAGE_VERSION or triage['count'] != self.count:
+            raise ValueError("Triage does not match: %s" % self.filename)
+        self.triage = triage
+
+    def close(self):
+        if self.buf is not None:
+            self.buf.close()
+            self.buf = None
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def get_value(self, name, index):
+        (offset, code, size) = self.layout[name]
+        (value,) = struct.unpack_from("<" + code, self.buf, offset + size * index)
+        return value
+
+    def get_column(self, name, start=0, count=None):
+        # values of a column from start, all by default, as a tuple
+        (offset, code, size) = self.layout[name]
+        if count is None:
+            count = self.count - start
+        return struct.unpack_from(column_format(code, count), self.buf, 
+            offset + size * start)
+
+    def get_order(self, sort, start=0, count=None):
+        # indexes in ascending order of the sort key, from start
+        if sort in SORT_KEYS:
+            return self.get_column('order_' + sort, start, count)
+        if count is None:
+            count = self.count - start
+        return self.triage['order_' + sort][start:start + count]
+
+    def get_sort_value(self, sort, index):
+        if sort in SORT_KEYS:
+            return self.get_value(SORT_KEYS[sort], index)
+        return self.triage[TRIAGE_SORT_KEYS[sort]][index]
+
+    def __getitem__(self, index):
+        if index < 0 or index >= self.count:
+            raise IndexError(index)
+
+        v = dict()
+        for (name, code) in COLUMNS:
+            v[name] = self.get_value(name, index)
+
+        d = {
+            'src_ip' : socket.inet_ntoa(v['src_ip']),
+            'dest_ip' : socket.inet_ntoa(v['dest_ip']),
+            'start' : "%.9f" % (v['start'],),
+            'duration' : "%.4f" % (v['duration'],),
+            'type' : TYPE_NAMES[v['type']],
+        }
+        for name in ('src_port', 'dest_port', 'dframes', 'dbytes', 'uframes',
+            'ubytes', 'tframes', 'tbytes'):
+            d[name] = str(v[name])
+        d['duration_f'] = float(d['duration'])
+        
+        if self.triage is not None:
+            for name in TRIAGE_COUNTERS:
+                d[name] = self.triage[name][index]
+            d['retrans_rate'] = self.triage['retrans_rate'][index]
+
+        return d
+
+    def query(self, offset, limit, sort='bytes', descending=True,
+        ip=None, port=None, proto=None, window=None):
+        # One page of connections, sorted by a key of SORT_KEYS (or
+        # TRIAGE_SORT_KEYS with the triage) and filtered by address, 
+        # port, type ('TCP'/'UDP') and time window (start, end).
+        # Returns (number of matching connections, [(index, item)])
+        if ip is None and port is None and proto is None and window is None:
+            # read only the part of the order for the page
+            total = self.count
+            start = min(offset, total)
+            end = min(offset + limit, total)
+            if descending:
+                indexes = self.get_order(sort, total - end, end - start)
+                indexes = reversed(indexes)
+            else:
+                indexes = self.get_order(sort, start, end - start)
+            return (total, [(index, self[index]) for index in indexes])
+            
+        match = self.filter(ip, port, proto, window)
+        total = len(match)
+        
+        if total * 8 < self.count:
+            # few matches, sort them by value
+            indexes = [(self.get_sort_value(sort, i), i) for i in match]
+            indexes.sort()
+            indexes = [i for (v, i) in indexes]
+        else:
+            # many matches, pick them from the sort order
+            mask = bytearray(self.count)
+            for i in match:
+                mask[i] = 1
+            indexes = [i for i in self.get_order(sort) if mask[i]]
+            
+        if descending:
+            indexes.reverse()
+        indexes = indexes[offset:offset + limit]
+
+        return (total, [(index, self[index]) for index in indexes])
+
+    def lookup(self, column, value):
+        # indexes of connections having the value in column,
+        # binary search in the lookup order
+        name = 'lookup_' + column
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_value(column, self.get_value(name, mid)) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        start = lo
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_value(column, self.get_value(name, mid)) <= value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self.get_column(name, start, lo - start)
+
+    def filter(self, ip, port, proto, window=None):
+        # returns the set of matching indexes, window is (start, end)
+        # in seconds from the first packet, connections with packets
+        # in it match
+        sets = list()
+        if ip is not None:
+            addr = socket.inet_aton(ip)
+            sets.append(set(self.lookup('src_ip', addr)) | 
+                set(self.lookup('dest_ip', addr)))
+        if port is not None:
+            sets.append(set(self.lookup('src_port', port)) | 
+                set(self.lookup('dest_port', port)))
+        if proto is not None:
+            sets.append(set(self.lookup('type', TYPE_CODES.get(proto, 0))))
+        if window is not None:
+            (start, end) = window
+            sets.append(set([i for (i, (s, d)) in enumerate(zip(
+                self.get_column('start'), self.get_column('duration')))
+                if s <= end and s + d >= start]))
+            
+        sets.sort(key=len)
+        match = sets[0]
+        for other in sets[1:]:
+            match = match & other
+        return match
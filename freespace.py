@@ -1,10 +1,12 @@
 import threading
 import time
-import glob
 import os
 import shutil
 
 from config import GlobalConfig
+from task import get_task_manager
+from uploads import forget_capture_hash
+from usage import get_usage_index
 
 
 __all__ = [
@@ -19,8 +21,18 @@ class SpaceMonitor:
         self.max_space_in_bytes = conf.get('max_space_in_mb') * 1024L * 1024L
         self.max_keep_time_in_seconds = conf.get('max_keep_time_in_minute') * 60.0
         self.check_internal_in_second = conf.get('check_internal_in_second')
+        self.high_watermark_in_bytes = (self.max_space_in_bytes * 
+            conf.get('space_high_watermark') / 100)
+        self.low_watermark_in_bytes = (self.max_space_in_bytes * 
+            conf.get('space_low_watermark') / 100)
+        self.upload_stale_in_second = conf.get('upload_stale_in_second')
+        # set to sweep before the interval is over
+        self.wakeup = threading.Event()
+        # one sweep at a time
+        self.sweep_lock = threading.Lock()
         
     def start(self):
+        get_usage_index().set_listener(self.onUsageGrown)
         t = threading.Thread(target=self.monitor)
         self.monitor = t
         t.start()
@@ -36,98 +48,155 @@ class SpaceMonitor:
             print "SpaceMonitor runner thread died, restart thread again"
     
     def runner(self):
-        # this is long long ago, so it would trigger
-        # sweep the first time
-        last_sweep_time = 0.0
-        
         # Wait for other thread to be stabilized
         time.sleep(2)
         
+        # catch up with the captures changed while stopped
+        get_usage_index().load()
+        
         while True:
-            # Do sweep first
-            cur = time.time()
-           
-            if cur - last_sweep_time > self.check_internal_in_second:
-                # wait long enough, do sweep job
-                self.doSweep()
-
-                # update recorded time
-                last_sweep_time = cur
-            else:
-                # sleep for a while
-                time.sleep(self.check_internal_in_second)
-    
-    @staticmethod
-    def collectInfo(dir):
-        # input dir name
-        # output dict of
-        #   dir
-        #   size
-        #   mtime       
+            self.doSweep()
+            # sleep until the interval is over or usage is too high
+            self.wakeup.wait(self.check_internal_in_second)
+            self.wakeup.clear()
             
-        res = {}
-        
-        # dir
-        res['dir'] = dir
-        
-        # mtime
-        stat = os.stat(dir)
-        res['mtime'] = stat.st_mtime
-        
-        # size
-        fsize = 0;
-        try:
-            stat = os.stat(dir + "\\main.cap")
-        except:
-            pass
+    def onUsageGrown(self, wait):
+        # called by the usage index after a write or a reservation,
+        # with wait the caller needs the room now
+        if get_usage_index().get_used() <= self.high_watermark_in_bytes:
+            return
+        if wait:
+            self.doSweep()
         else:
-            fsize = stat.st_size
-        res['size'] = fsize
-
-        return res
-        
-    @staticmethod
-    def compareItem(a, b):
-        # sort according to 
-        #   mtime: older < newer
-        #   size: smaller < bigger
-        mtimecmp = cmp(a['mtime'], b['mtime'])
-        if mtimecmp != 0:
-            return mtimecmp
-        
-        return cmp(a['size'], b['size'])
+            self.wakeup.set()
     
     def doSweep(self):
-        # Find all dirs and collect information
-        # 29f33cd3-c1a9-4d12-a336-0f6d76ca100e
+        # Delete, in the order of the usage index
+        #   1. expired captures
+        #   2. over the high watermark, derived files (<index>.cap, 
+        #      rendered pages) least recently used first, until the 
+        #      usage is down to the low watermark. They are made 
+        #      again when needed, the results (.bin) stay.
+        #   3. then whole captures
+        #       mtime: older first
+        #       size: smaller first
+        # Captures being written (reserved space) or having a running
+        # task stay. The files left are brought down to the low 
+        # watermark, or lower if the reserved space would not fit in
+        # the max space, unless the captures that stay are already 
+        # over it: deleting the others would not do.
+        with self.sweep_lock:
+            index = get_usage_index()
+            self.settleStaleUploads()
+            
+            target = None
+            if index.get_used() > self.high_watermark_in_bytes:
+                reserved = sum([nbytes for (uuid, nbytes) in index.get_reserved()])
+                target = min(self.low_watermark_in_bytes, 
+                    self.max_space_in_bytes - reserved)
+                if self.getBusyBytes() > target:
+                    target = None
+            
+            now = time.time()
+            self.evictCaptures(
+                lambda mtime: now - mtime > self.max_keep_time_in_seconds)
+            if target is not None:
+                self.evictDerived(target)
+                self.evictCaptures(lambda mtime: index.get_total() > target)
+                
+            index.save()
+            
+    def settleStaleUploads(self):
+        # resumable uploads left by their client, no chunk for a while,
+        # can go the same way as other captures
         save_dir = conf.get('save_dir')
-        pat = save_dir + "%s-%s-%s-%s-%s" % (
-            '?' * 8, '?' * 4, '?' * 4, '?' * 4, '?' * 12)
-        dirs = glob.glob(pat)
-        
-        infoList = map(self.collectInfo, dirs)
+        index = get_usage_index()
+        now = time.time()
+        for (uuid, nbytes) in index.get_reserved():
+            try:
+                mtime = os.stat(save_dir + uuid + "\\main.chunks").st_mtime
+            except os.error:
+                # not a resumable upload
+                continue
+            if now - mtime > self.upload_stale_in_second:
+                index.settle(uuid)
+                
+    @staticmethod
+    def getBusyBytes():
+        # bytes of the captures that can't be deleted now
+        index = get_usage_index()
+        busy = get_task_manager().busy_captures()
+        busy.update([uuid for (uuid, nbytes) in index.get_reserved()])
+        return sum([index.get_size(uuid) for uuid in busy])
+            
+    @staticmethod
+    def isBusy(uuid):
+        return get_usage_index().is_reserved(uuid) or get_task_manager().is_busy(uuid)
+            
+    def evictDerived(self, target):
+        save_dir = conf.get('save_dir')
+        index = get_usage_index()
         
-        # Sort according to deletion order
-        infoList = sorted(infoList, self.compareItem)
+        skipped = list()
+        while index.get_total() > target:
+            item = index.take_oldest_derived()
+            if item is None:
+                break
+            (uuid, name, size, mtime) = item
+            if self.isBusy(uuid):
+                skipped.append(item)
+                continue
+                
+            # the directory keeps its place in the deletion order
+            directory = save_dir + uuid
+            try:
+                stat = os.stat(directory)
+                os.remove(directory + "\\" + name)
+                os.utime(directory, (stat.st_atime, stat.st_mtime))
+            except os.error:
+                # in use or gone
+                skipped.append(item)
+                continue
+            index.remove_derived(uuid, name)
+            
+        index.put_back_derived(skipped)
         
-        # Do deletion
-        # Collect total size
-        sizeTotal = 0L
-        for item in infoList:
-            sizeTotal += item['size']
+    def evictCaptures(self, should_delete):
+        # delete the oldest captures while should_delete(mtime)
+        save_dir = conf.get('save_dir')
+        index = get_usage_index()
         
-        #print "Total size %d" % sizeTotal
-        now = time.time()
-        for item in infoList:
-            # if item expires or size total is larger then config'ed
-            # need to delete
+        skipped = list()
+        # captures only partly deleted by this sweep
+        left = set()
+        while True:
+            item = index.take_oldest()
+            if item is None:
+                break
+            (uuid, size, mtime) = item
+            if not should_delete(mtime):
+                skipped.append(item)
+                break
+            if self.isBusy(uuid) or uuid in left:
+                skipped.append(item)
+                continue
+                
+            #print "Delete %s" % uuid
+            forget_capture_hash(save_dir, uuid)
+            # drop cached status of its tasks, not found as done 
+            # while its files go away
+            get_task_manager().forget_capture(uuid)
+            # a file still open stays, the rest is gone anyway
+            shutil.rmtree(save_dir + uuid, True)
+            if os.path.exists(save_dir + uuid):
+                # count what is left, it goes with a next sweep
+                index.update(uuid)
+                left.add(uuid)
+            else:
+                index.remove(uuid)
+            get_task_manager().forget_capture(uuid)
             
-            if ((now - item['mtime'] > self.max_keep_time_in_seconds)
-                or (sizeTotal >= self.max_space_in_bytes)):
-                #print "Delete %s" % item['dir']
-                # delete it and update size
-                shutil.rmtree(item['dir'])
-                sizeTotal -= item['size']
+        index.put_back(skipped)
 
 theSpaceMonitor = None
             
@@ -0,0 +1,141 @@
+import bisect
+import threading
+
+__all__ = [
+    'Counter',
+    'Gauge',
+    'Histogram',
+    'get_metrics',
+]
+
+metrics = None
+
+def get_metrics():
+    global metrics
+    return metrics
+
+# Metrics of the process, rendered in the Prometheus text format.
+# Each metric has a fixed list of label names, values are given as
+# a tuple in the same order.
+class MetricRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = list()
+
+    def register(self, metric):
+        with self.lock:
+            self.items.append(metric)
+        return metric
+
+    def render(self):
+        with self.lock:
+            items = list(self.items)
+        lines = list()
+        for metric in items:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+def format_labels(names, values, extra=None):
+    pairs = list()
+    for (name, value) in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('%s="%s"' % (name, value))
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value))
+
+class Metric:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        # labels -> value
+        self.values = dict()
+        get_metrics().register(self)
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return ["%s%s %s" % (self.name, format_labels(self.labelnames, labels),
+            format_value(value)) for (labels, value) in values]
+
+# collect: optional callable returning a list of (labels, value),
+# called at each render instead of keeping values
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames=(), collect=None):
+        Metric.__init__(self, name, help, labelnames)
+        self.collect = collect
+
+    def set(self, labels, value):
+        with self.lock:
+            self.values[labels] = value
+
+    def set_max(self, labels, value):
+        with self.lock:
+            if value > self.values.get(labels, value - 1):
+                self.values[labels] = value
+
+    def render(self):
+        if self.collect is not None:
+            values = sorted(self.collect())
+        else:
+            with self.lock:
+                values = sorted(self.values.items())
+        return ["%s%s %s" % (self.name, format_labels(self.labelnames, labels),
+            format_value(value)) for (labels, value) in values]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=()):
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = sorted(buckets)
+
+    def observe(self, labels, value):
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                # [count per bucket (last one is +Inf), sum]
+                entry = [[0] * (len(self.buckets) + 1), 0.0]
+                self.values[labels] = entry
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    def render(self):
+        with self.lock:
+            values = sorted([(labels, (list(counts), total))
+                for (labels, (counts, total)) in self.values.items()])
+        lines = list()
+        for (labels, (counts, total)) in values:
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + [float('inf')], counts):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (self.name,
+                    format_labels(self.labelnames, labels, ('le', format_value(bound))),
+                    cumulative))
+            lines.append("%s_sum%s %s" % (self.name,
+                format_labels(self.labelnames, labels), format_value(total)))
+            lines.append("%s_count%s %d" % (self.name,
+                format_labels(self.labelnames, labels), cumulative))
+        return lines
+
+metrics = MetricRegistry()
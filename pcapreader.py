@@ -0,0 +1,659 @@
+import bisect
+import cPickle
+import collections
+import mmap
+import os
+import socket
+import struct
+import time
+
+from atomicfile import write_file
+
+__all__ = [
+    'CaptureReader',
+    'CaptureFormatError',
+    'ExtractConversations',
+    'SplitConversations',
+    'WriteTimeIndex',
+    'LoadTimeIndex',
+]
+
+# pcap magic numbers, as read in little endian
+PCAP_MAGIC_US = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+PCAP_MAGIC_US_SWAPPED = 0xd4c3b2a1
+PCAP_MAGIC_NS_SWAPPED = 0x4d3cb2a1
+
+# pcapng block types
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_IDB = 0x00000001
+PCAPNG_PB = 0x00000002
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+
+# link types
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW_BSD = 12
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_LINUX_SLL2 = 276
+
+# link types read by ipv4_offset, a capture with another one (802.11,
+# PPP, ...) raises CaptureFormatError and is left to tshark
+LINKTYPES = (LINKTYPE_NULL, LINKTYPE_ETHERNET, LINKTYPE_RAW_BSD, 
+    LINKTYPE_RAW, LINKTYPE_LINUX_SLL, LINKTYPE_IPV4, LINKTYPE_LINUX_SLL2)
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = (0x8100, 0x88a8, 0x9100)
+
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+
+# seconds between two checks of a file that is still written
+GROW_POLL_INTERVAL = 0.5
+
+# files of SplitConversations open at the same time (the C runtime
+# on Windows allows about 512), each one has a 1 MB buffer
+SPLIT_OPEN_FILES = 64
+
+# packets between two entries of the time index
+TIME_INDEX_INTERVAL = 1024
+TIME_INDEX_VERSION = 1
+
+class CaptureFormatError(Exception):
+    pass
+
+# Read pcap and pcapng files through mmap, only record headers
+# are decoded, packet data is left in the file.
+#
+# records() yields a tuple for each packet
+#   (ts, wirelen, linktype, data_offset, caplen, rec_offset, rec_end)
+#   ts: timestamp in seconds (float)
+#   wirelen: length of the packet on the wire
+#   data_offset, caplen: where the captured bytes are
+#   rec_offset, rec_end: the whole record (header included)
+# It can start at the record at offset, with headers the header 
+# blocks of its section for pcapng (as in header_blocks).
+#
+# growing: optional callable, returns True while the file is still
+# written (upload in progress). Records are then read as they arrive
+# and the reader stops only at the end of the complete file. It can
+# raise to stop the reading, the exception goes to the caller.
+class CaptureReader:
+    def __init__(self, filename, growing=None):
+        self.filename = filename
+        self.growing = growing
+        self.f = open(filename, "rb")
+        self.buf = None
+        self.size = 0
+
+        try:
+            self.refresh()
+            while self.size < 24:
+                if not self.wait_for_data():
+                    raise CaptureFormatError("File too small: %s" % filename)
+        except:
+            self.close()
+            raise
+
+        # pcapng only: blocks (offset, end) that describe the current
+        # section (SHB and IDBs), section counts the SHBs seen
+        self.header_blocks = list()
+        self.section = 0
+
+        (magic,) = struct.unpack_from("<I", self.buf, 0)
+        if magic in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+            self.format = 'pcap'
+            self.endian = '<'
+        elif magic in (PCAP_MAGIC_US_SWAPPED, PCAP_MAGIC_NS_SWAPPED):
+            self.format = 'pcap'
+            self.endian = '>'
+        elif magic == PCAPNG_SHB:
+            self.format = 'pcapng'
+            self.endian = None
+        else:
+            self.close()
+            raise CaptureFormatError("Unknown capture format: %s" % filename)
+
+        if self.format == 'pcap':
+            (magic, major, minor, zone, sigfigs, snaplen, linktype) = \
+                struct.unpack_from(self.endian + "IHHiIII", self.buf, 0)
+            # upper bits tell about the FCS
+            linktype &= 0xffff
+            if linktype not in LINKTYPES:
+                self.close()
+                raise CaptureFormatError("Unsupported link type %d: %s" % (
+                    linktype, filename))
+            self.linktype = linktype
+            if magic in (PCAP_MAGIC_NS, PCAP_MAGIC_NS_SWAPPED):
+                self.ts_scale = 1e-9
+            else:
+                self.ts_scale = 1e-6
+            self.header_end = 24
+
+    def close(self):
+        if self.buf is not None:
+            self.buf.close()
+            self.buf = None
+        self.f.close()
+
+    def refresh(self):
+        # map the file again if it got bigger, returns True if so
+        size = os.fstat(self.f.fileno()).st_size
+        if size <= self.size:
+            return False
+        if self.buf is not None:
+            self.buf.close()
+        self.buf = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = size
+        return True
+
+    def wait_for_data(self):
+        # wait until the file grows, returns False if it is complete
+        while self.growing is not None:
+            # ask first, the last write comes before the end is told
+            growing = self.growing()
+            if self.refresh():
+                return True
+            if not growing:
+                break
+            time.sleep(GROW_POLL_INTERVAL)
+        return False
+
+    def records(self, offset=None, headers=()):
+        if self.format == 'pcap':
+            return self.pcap_records(offset)
+        else:
+            return self.pcapng_records(offset, headers)
+
+    def pcap_records(self, offset=None):
+        buf = self.buf
+        size = self.size
+        linktype = self.linktype
+        ts_scale = self.ts_scale
+        rec_header = struct.Struct(self.endian + "IIII")
+
+        if offset is None:
+            offset = self.header_end
+        while True:
+            if offset + 16 <= size:
+                (ts_sec, ts_frac, caplen, wirelen) = rec_header.unpack_from(buf, offset)
+                rec_end = offset + 16 + caplen
+                if rec_end <= size:
+                    yield (ts_sec + ts_frac * ts_scale, wirelen, linktype,
+                        offset + 16, caplen, offset, rec_end)
+                    offset = rec_end
+                    continue
+            # truncated record at the end of file, unless more comes
+            if not self.wait_for_data():
+                break
+            buf = self.buf
+            size = self.size
+
+    def pcapng_records(self, offset=None, headers=()):
+        buf = self.buf
+        size = self.size
+        endian = '<'
+        interfaces = list()
+        ts = 0.0
+
+        # read the header blocks first, then go on from offset
+        pending = [b for (b, e) in headers]
+        pending.append(offset or 0)
+        offset = pending.pop(0)
+        while True:
+            if offset + 12 > size:
+                if not self.wait_for_data():
+                    break
+                buf = self.buf
+                size = self.size
+                continue
+
+            (block_type,) = struct.unpack_from(endian + "I", buf, offset)
+
+            block_endian = endian
+            if block_type == PCAPNG_SHB:
+                # new section, byte order may change
+                (bom,) = struct.unpack_from("<I", buf, offset + 8)
+                if bom == PCAPNG_BYTE_ORDER_MAGIC:
+                    block_endian = '<'
+                else:
+                    block_endian = '>'
+
+            (block_len,) = struct.unpack_from(block_endian + "I", buf, offset + 4)
+            if block_len < 12:
+                break
+            if offset + block_len > size:
+                # truncated block at the end of file, unless more comes
+                if not self.wait_for_data():
+                    break
+                buf = self.buf
+                size = self.size
+                continue
+            block_end = offset + block_len
+
+            if block_type == PCAPNG_SHB:
+                # interfaces are described again in each section
+                endian = block_endian
+                interfaces = list()
+                self.header_blocks = [(offset, block_end)]
+                self.section += 1
+
+            elif block_type == PCAPNG_IDB:
+                interfaces.append(self.pcapng_interface(endian, offset, block_end))
+                self.header_blocks.append((offset, block_end))
+
+            elif block_type == PCAPNG_EPB:
+                (if_id, ts_high, ts_low, caplen, wirelen) = \
+                    struct.unpack_from(endian + "IIIII", buf, offset + 8)
+                if if_id < len(interfaces):
+                    (linktype, ts_scale, ts_offset) = interfaces[if_id]
+                    ts = ((ts_high << 32) | ts_low) * ts_scale + ts_offset
+                    yield (ts, wirelen, linktype, offset + 28, caplen,
+                        offset, block_end)
+
+            elif block_type == PCAPNG_SPB:
+                # simple packet has no timestamp, keep the last one
+                (wirelen,) = struct.unpack_from(endian + "I", buf, offset + 8)
+                if len(interfaces) > 0:
+                    caplen = min(wirelen, block_len - 16)
+                    yield (ts, wirelen, interfaces[0][0], offset + 12, caplen,
+                        offset, block_end)
+
+            elif block_type == PCAPNG_PB:
+                # obsolete packet block
+                (if_id, drops, ts_high, ts_low, caplen, wirelen) = \
+                    struct.unpack_from(endian + "HHIIII", buf, offset + 8)
+                if if_id < len(interfaces):
+                    (linktype, ts_scale, ts_offset) = interfaces[if_id]
+                    ts = ((ts_high << 32) | ts_low) * ts_scale + ts_offset
+                    yield (ts, wirelen, linktype, offset + 28, caplen,
+                        offset, block_end)
+
+            offset = block_end
+            if len(pending) > 0:
+                offset = pending.pop(0)
+
+    def pcapng_interface(self, endian, offset, block_end):
+        # returns (linktype, ts_scale, ts_offset)
+        buf = self.buf
+        (linktype,) = struct.unpack_from(endian + "H", buf, offset + 8)
+        if linktype not in LINKTYPES:
+            raise CaptureFormatError("Unsupported link type %d: %s" % (
+                linktype, self.filename))
+        ts_scale = 1e-6
+        ts_offset = 0
+
+        # walk the options
+        opt = offset + 16
+        while opt + 4 <= block_end - 4:
+            (code, length) = struct.unpack_from(endian + "HH", buf, opt)
+            if code == 0:
+                break
+            if code == 9 and length >= 1:
+                # if_tsresol
+                (resol,) = struct.unpack_from("B", buf, opt + 4)
+                if resol & 0x80:
+                    ts_scale = 2.0 ** -(resol & 0x7f)
+                else:
+                    ts_scale = 10.0 ** -resol
+            elif code == 14 and length >= 8:
+                # if_tsoffset
+                (ts_offset,) = struct.unpack_from(endian + "q", buf, opt + 4)
+            opt += 4 + ((length + 3) & ~3)
+
+        return (linktype, ts_scale, ts_offset)
+
+    def ipv4_offset(self, linktype, offset, caplen):
+        # returns offset of IPv4 header in the packet or None
+        buf = self.buf
+        if linktype == LINKTYPE_ETHERNET:
+            if caplen < 14:
+                return None
+            (ethertype,) = struct.unpack_from(">H", buf, offset + 12)
+            l3 = 14
+            while ethertype in ETHERTYPE_VLAN and l3 + 4 <= caplen:
+                (ethertype,) = struct.unpack_from(">H", buf, offset + l3 + 2)
+                l3 += 4
+            if ethertype != ETHERTYPE_IPV4:
+                return None
+            return offset + l3
+        elif linktype == LINKTYPE_LINUX_SLL:
+            if caplen < 16:
+                return None
+            (proto,) = struct.unpack_from(">H", buf, offset + 14)
+            if proto != ETHERTYPE_IPV4:
+                return None
+            return offset + 16
+        elif linktype == LINKTYPE_LINUX_SLL2:
+            if caplen < 20:
+                return None
+            (proto,) = struct.unpack_from(">H", buf, offset)
+            if proto != ETHERTYPE_IPV4:
+                return None
+            return offset + 20
+        elif linktype == LINKTYPE_NULL:
+            if caplen < 4:
+                return None
+            # family is in host byte order of the capturing machine
+            (family,) = struct.unpack_from("<I", buf, offset)
+            if family != socket.AF_INET and family != 0x02000000:
+                return None
+            return offset + 4
+        elif linktype in (LINKTYPE_RAW, LINKTYPE_RAW_BSD, LINKTYPE_IPV4):
+            return offset
+        return None
+
+    def five_tuple(self, linktype, offset, caplen):
+        # returns (proto, src_ip, src_port, dest_ip, dest_port)
+        # addresses are 4 bytes strings, or None if it is not
+        # a TCP/UDP packet over IPv4
+        ip = self.ipv4_offset(linktype, offset, caplen)
+        if ip is None:
+            return None
+        end = offset + caplen
+        if ip + 20 > end:
+            return None
+
+        buf = self.buf
+        (ver_ihl, frag, proto) = struct.unpack_from(">B5xH1xB", buf, ip)
+        if (ver_ihl >> 4) != 4:
+            return None
+        if proto != IPPROTO_TCP and proto != IPPROTO_UDP:
+            return None
+        if frag & 0x1fff:
+            # not the first fragment, no transport header
+            return None
+        l4 = ip + (ver_ihl & 0x0f) * 4
+        if l4 + 4 > end:
+            return None
+
+        (src_port, dest_port) = struct.unpack_from(">HH", buf, l4)
+        return (proto, buf[ip + 12:ip + 16], src_port, buf[ip + 16:ip + 20], dest_port)
+
+    def get_file_header(self):
+        # bytes to put in front of copied records to make a valid file
+        if self.format == 'pcap':
+            return self.buf[0:self.header_end]
+        else:
+            return "".join([self.buf[b:e] for (b, e) in self.header_blocks])
+
+    @staticmethod
+    def conversation_key(tuple5):
+        # same key for both directions of a conversation
+        (proto, src_ip, src_port, dest_ip, dest_port) = tuple5
+        a = (src_ip, src_port)
+        b = (dest_ip, dest_port)
+        if a <= b:
+            return (proto, a, b)
+        else:
+            return (proto, b, a)
+
+# Build the TCP and UDP conversation lists in one pass over the file.
+# Each item has the same fields as GetAllTCPConns/GetAllUDPConns.
+# Like "tshark -z conv", address A is the source of the first packet
+# and the list is ordered by total frames.
+# Only IPv4 is handled, same as the tshark output parsers.
+# growing: see CaptureReader
+# time_index: optional list, gets an entry every TIME_INDEX_INTERVAL
+# packets, see WriteTimeIndex
+def ExtractConversations(filename, growing=None, time_index=None):
+    reader = CaptureReader(filename, growing)
+
+    # key -> [tuple5 of first packet, frames A->B, bytes A->B,
+    #         frames B->A, bytes B->A, first ts, last ts, order]
+    convs = dict()
+    first_ts = None
+    count = 0
+    headers = None
+    section = None
+
+    try:
+        for (ts, wirelen, linktype, data_offset, caplen, rec_offset, rec_end) in reader.records():
+            if first_ts is None:
+                first_ts = ts
+                
+            if time_index is not None and count % TIME_INDEX_INTERVAL == 0:
+                # the same headers are shared by the entries
+                if section != reader.section or len(headers) != len(reader.header_blocks):
+                    headers = tuple(reader.header_blocks)
+                    section = reader.section
+                time_index.append((ts, rec_offset, headers))
+            count += 1
+
+            tuple5 = reader.five_tuple(linktype, data_offset, caplen)
+            if tuple5 is None:
+                continue
+
+            key = reader.conversation_key(tuple5)
+            conv = convs.get(key)
+            if conv is None:
+                conv = [tuple5, 0, 0, 0, 0, ts, ts, len(convs)]
+                convs[key] = conv
+
+            if tuple5[1] == conv[0][1] and tuple5[2] == conv[0][2]:
+                conv[1] += 1
+                conv[2] += wirelen
+            else:
+                conv[3] += 1
+                conv[4] += wirelen
+            conv[6] = ts
+    finally:
+        reader.close()
+
+    tcps = list()
+    udps = list()
+
+    convs = convs.values()
+    convs.sort(key=lambda c: (-(c[1] + c[3]), c[7]))
+
+    for conv in convs:
+        (proto, src_ip, src_port, dest_ip, dest_port) = conv[0]
+        duration = conv[6] - conv[5]
+        d = {
+            'src_ip' : socket.inet_ntoa(src_ip),
+            'src_port' : str(src_port),
+            'dest_ip' : socket.inet_ntoa(dest_ip),
+            'dest_port' : str(dest_port),
+            'dframes' : str(conv[3]),
+            'dbytes' : str(conv[4]),
+            'uframes' : str(conv[1]),
+            'ubytes' : str(conv[2]),
+            'tframes' : str(conv[1] + conv[3]),
+            'tbytes' : str(conv[2] + conv[4]),
+            'start' : "%.9f" % (conv[5] - first_ts,),
+            'duration' : "%.4f" % (duration,),
+        }
+        d['duration_f'] = float(d['duration'])
+
+        if proto == IPPROTO_TCP:
+            d['type'] = 'TCP'
+            tcps.append(d)
+        else:
+            d['type'] = 'UDP'
+            udps.append(d)
+
+    return (tcps, udps)
+
+# Output file of SplitConversations, records are copied as they are
+# from the source file. Data is written to "<outfilename>.part" and
+# renamed when done, so a reader never sees a partial file.
+# The file can be closed by suspend() between two writes, the next
+# write opens it again to append.
+class SplitWriter:
+    def __init__(self, reader, outfilename):
+        self.reader = reader
+        self.outfilename = outfilename
+        self.f = None
+        self.started = False
+        self.section = None
+        self.header_count = 0
+
+    def write(self, rec_offset, rec_end):
+        reader = self.reader
+        if self.f is None:
+            if self.started:
+                mode = "ab"
+            else:
+                mode = "wb"
+            self.f = open(self.outfilename + ".part", mode, 1024 * 1024)
+            self.started = True
+
+        if reader.format == 'pcap':
+            if self.section is None:
+                self.f.write(reader.get_file_header())
+                self.section = 0
+        elif self.section != reader.section:
+            # first packet of a new section, put the section header
+            self.f.write(reader.get_file_header())
+            self.section = reader.section
+            self.header_count = len(reader.header_blocks)
+        elif self.header_count < len(reader.header_blocks):
+            # more interfaces are described after the first packets
+            for (b, e) in reader.header_blocks[self.header_count:]:
+                self.f.write(reader.buf[b:e])
+            self.header_count = len(reader.header_blocks)
+
+        self.f.write(reader.buf[rec_offset:rec_end])
+
+    def suspend(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def abort(self):
+        # the split failed, drop the partial file
+        self.suspend()
+        try:
+            os.remove(self.outfilename + ".part")
+        except os.error:
+            # closed already, or never started
+            pass
+
+    def close(self):
+        if not self.started:
+            # no packet at all, still give an empty capture
+            self.f = open(self.outfilename + ".part", "wb")
+            self.f.write(self.reader.get_file_header())
+            self.started = True
+        self.suspend()
+        if os.path.exists(self.outfilename):
+            # made by another task meanwhile, keep that one
+            os.remove(self.outfilename + ".part")
+        else:
+            os.rename(self.outfilename + ".part", self.outfilename)
+
+# Sparse index of a capture, packet timestamp -> record offset, so
+# a time window is read without going through the packets before.
+# Entries are (ts, rec_offset, headers) of every TIME_INDEX_INTERVAL
+# packets from the first one, headers are the header blocks of the
+# section for pcapng.
+def WriteTimeIndex(filename, entries):
+    index = dict(version=TIME_INDEX_VERSION, entries=entries)
+    write_file(filename, 
+        lambda f: cPickle.dump(index, f, cPickle.HIGHEST_PROTOCOL))
+    
+def LoadTimeIndex(filename):
+    # entries, or None if there is no index (not a pcap/pcapng file, 
+    # extracted before)
+    try:
+        f = open(filename, "rb")
+    except IOError:
+        return None
+    try:
+        index = cPickle.load(f)
+    finally:
+        f.close()
+    if index.get('version') != TIME_INDEX_VERSION or len(index['entries']) == 0:
+        return None
+    return index['entries']
+    
+def window_range(entries, start, end):
+    # (offset, headers) of the entry to start reading at, and offset 
+    # to stop at or None, for the window (start, end) in seconds from
+    # the first packet. One more entry on both sides, timestamps may
+    # be slightly out of order.
+    first_ts = entries[0][0]
+    stamps = [ts - first_ts for (ts, offset, headers) in entries]
+    i = max(bisect.bisect_left(stamps, start) - 2, 0)
+    j = bisect.bisect_right(stamps, end) + 1
+    stop = None
+    if j < len(entries):
+        stop = entries[j][1]
+    return (entries[i][1], entries[i][2], stop)
+
+# Write the packets of several conversations into their own files
+# in one pass over the capture.
+# Input: conns, dict of outfilename -> conversation, an item of the
+# list given by ExtractConversations or GetAllTCPConns/GetAllUDPConns
+# window: optional (start, end) in seconds from the first packet, 
+# only the packets in it are written. With the entries of the time
+# index, the reading starts and stops near the window, otherwise the
+# whole capture is read.
+# At most SPLIT_OPEN_FILES files are open, the least recently written
+# one is closed to open another one.
+def SplitConversations(filename, conns, window=None, time_index=None):
+    reader = CaptureReader(filename)
+
+    writers = dict()
+    # writers with an open file, least recently written first
+    opened = collections.OrderedDict()
+    last = None
+    for (outfilename, conn) in conns.items():
+        if conn['type'] == 'TCP':
+            proto = IPPROTO_TCP
+        else:
+            proto = IPPROTO_UDP
+        tuple5 = (proto,
+            socket.inet_aton(conn['src_ip']), int(conn['src_port']),
+            socket.inet_aton(conn['dest_ip']), int(conn['dest_port']))
+        key = reader.conversation_key(tuple5)
+        writers[key] = SplitWriter(reader, outfilename)
+
+    offset = None
+    headers = ()
+    stop = None
+    first_ts = None
+    if window is not None and time_index is not None:
+        (offset, headers, stop) = window_range(time_index, window[0], window[1])
+        first_ts = time_index[0][0]
+
+    try:
+        for (ts, wirelen, linktype, data_offset, caplen, rec_offset, rec_end) in reader.records(offset, headers):
+            if window is not None:
+                if stop is not None and rec_offset >= stop:
+                    break
+                if first_ts is None:
+                    first_ts = ts
+                if not window[0] <= ts - first_ts <= window[1]:
+                    continue
+            
+            tuple5 = reader.five_tuple(linktype, data_offset, caplen)
+            if tuple5 is None:
+                continue
+
+            writer = writers.get(reader.conversation_key(tuple5))
+            if writer is None:
+                continue
+            if writer is not last:
+                if opened.pop(writer, None) is None and len(opened) >= SPLIT_OPEN_FILES:
+                    (oldest, x) = opened.popitem(last=False)
+                    oldest.suspend()
+                opened[writer] = True
+                last = writer
+            writer.write(rec_offset, rec_end)
+
+        for writer in writers.values():
+            writer.close()
+    except:
+        # a link type found late in a pcapng, tshark does it then
+        for writer in writers.values():
+            writer.abort()
+        raise
+    finally:
+        for writer in writers.values():
+            writer.suspend()
+        reader.close()
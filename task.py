@@ -1,4 +1,6 @@
 import threading
+import multiprocessing
+import collections
 import re
 
 import cPickle
@@ -9,15 +11,28 @@ import os.path
 from uuid import uuid4
 
 from config import GlobalConfig
+from metrics import *
 from analysis import *
 from command import *
+from pcapreader import *
+from cache import get_pickle_cache
+from connstore import *
+from uploads import UploadBroken, is_uploading, wait_for_upload, drop_upload, \
+    drop_duplicate_files
+from usage import get_usage_index
 
 __all__ = [
     'OK',
     'RUNNING',
     'NOT_FOUND',
+    'PRIORITY_INTERACTIVE',
+    'PRIORITY_BULK',
+    'PRIORITY_PREFETCH',
     'TaskExtractCapture',
+    'TaskSplitCapture',
+    'TaskTriageCapture',
     'TaskAnalyzeConnection',
+    'conn_result_name',
     'get_task_manager'
  
 ]
@@ -28,54 +43,238 @@ OK = 'ok'
 RUNNING = 'running'
 NOT_FOUND = 'not_found'
 FAILED = 'failed'
+
+# finished statuses kept in memory, the oldest ones are found again
+# by the matchers when asked
+DONE_INDEX_SIZE = 10000
+
+# task priorities, lower value runs first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITY_PREFETCH = 2
+
 task_manager = None
 
 def get_task_manager():
     global task_manager
     return task_manager
 
+def get_file_size(filename):
+    try:
+        return os.path.getsize(filename)
+    except os.error:
+        return 0L
+
+def conn_result_name(index, window=None):
+    # name of the files of a connection analysis (<name>.cap, .bin,
+    # .done): the index, and the time window in ms if there is one,
+    # e.g. 3.w1500-31500
+    if window is None:
+        return str(index)
+    return "%d.w%d-%d" % (index, round(window[0] * 1000), round(window[1] * 1000))
+
+def get_conn_cap_size(conn):
+    # size of the capture of one connection, with pcap headers
+    return long(conn['tbytes']) + 16L * long(conn['tframes']) + 24L
+
+# Metrics of the task queue, labelled by task class
+TASK_BUCKETS = [0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800]
+task_wait_seconds = Histogram('npa_task_queue_wait_seconds',
+    'Time from post to start of tasks', ('task',), TASK_BUCKETS)
+task_seconds = Histogram('npa_task_seconds',
+    'Run time of tasks', ('task', 'result'), TASK_BUCKETS)
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE : 'interactive',
+    PRIORITY_BULK : 'bulk',
+    PRIORITY_PREFETCH : 'prefetch',
+}
+
+def count_tasks(running):
+    # (priority name,) -> number of waiting or running tasks
+    task_manager = get_task_manager()
+    counts = dict([((name,), 0) for name in PRIORITY_NAMES.values()])
+    with task_manager.get_lock():
+        for task in task_manager.task_list:
+            if (task in task_manager.running_list) == running:
+                key = (PRIORITY_NAMES.get(task.priority, str(task.priority)),)
+                counts[key] = counts.get(key, 0) + 1
+    return counts.items()
+
+Gauge('npa_task_queue_depth', 'Tasks waiting to run', ('priority',),
+    collect=lambda: count_tasks(False))
+Gauge('npa_tasks_running', 'Tasks running', ('priority',),
+    collect=lambda: count_tasks(True))
+Gauge('npa_task_memory_in_use_bytes', 'Memory budget taken by running tasks',
+    collect=lambda: [((), get_task_manager().memory_in_use)])
 
 class TaskManager:
     def __init__(self):
         self.task_lock = threading.RLock()
-        # task_list and matcher must be 
-        # accessed under lock
+        # wake up runners when a task is posted
+        self.task_cond = threading.Condition(self.task_lock)
+        # task_list, running_list and matcher must be 
+        # changed under lock
         self.task_list = []
+        self.running_list = []
         self.task_matcher = []
         
+        # Every status change of a task takes the next number of
+        # status_seq as the version of the task, and wakes up the
+        # requests waiting for a change of this task, see wait_status.
+        # A task not in task_list has version 0.
+        # status_conds: key -> [condition, waiting requests], while
+        # requests wait for the task
+        self.status_lock = threading.Lock()
+        self.status_conds = dict()
+        self.status_seq = 0L
+        
+        # key -> task for the tasks in task_list, and key -> status
+        # of finished tasks found by matchers. Both are changed under
+        # lock but read without it, a single dict lookup is atomic.
+        self.task_index = dict()
+        self.done_index = collections.OrderedDict()
+        
+        # number of runners, 0 means one per core
+        self.workers = conf.get('task_workers')
+        if self.workers <= 0:
+            self.workers = multiprocessing.cpu_count()
+        # runners for prefetch tasks, the others are kept for 
+        # the tasks somebody waits for
+        self.prefetch_workers = conf.get('prefetch_workers')
+        if self.prefetch_workers <= 0:
+            self.prefetch_workers = max(self.workers // 2, 1)
+        
+        # tasks are weighted by the size of the file they read,
+        # a new task is started only if the running ones leave 
+        # enough room. A task bigger than the budget still runs 
+        # when nothing else is running. Once the next task has
+        # waited task_max_wait_in_second for room, no other one
+        # starts before it.
+        self.memory_budget = conf.get('task_memory_budget_in_mb') * 1024L * 1024L
+        self.memory_in_use = 0L
+        self.max_wait = conf.get('task_max_wait_in_second')
+        
+        # owner -> sequence number of the last task picked for it
+        self.owner_picked = dict()
+        self.pick_count = 0L
+        
     def post_task(self, task):
+        # weighted once, not for each pick under lock
+        task.memory_cost = task.get_memory_cost()
         with self.task_lock:
             task_key = task.get_key()
             task_status = self.query_task(task_key)
+            # waiting with a lower priority (prefetch), somebody
+            # asks for it now
+            queued = self.task_index.get(task_key)
+            if queued is not None and task.priority < queued.priority:
+                queued.priority = task.priority
+                self.task_cond.notify()
             # insert only if it is not found
             if task_status['status'] == NOT_FOUND:
+                task.posted = time.time()
                 self.task_list.append(task)
+                self.task_index[task_key] = task
+                self.task_cond.notify()
+                self.status_changed(task_key, task)
         
         return task_key
         
     def query_task(self, task_key):    
-        result = None
+        # Lock free, so polling never waits for the runners
+        
+        # find in list
+        task = self.task_index.get(task_key)
+        if task is not None:
+            return task.get_status()
+        
+        # finished before
+        result = self.done_index.get(task_key)
+        if result is not None:
+            return copy.deepcopy(result)
+        
+        #not found in list, look in directory
+        for tm in self.task_matcher:
+            result = tm(task_key)
+            if result:
+                if result['status'] == OK:
+                    # done file never goes away unless the capture
+                    # is deleted, see forget_capture
+                    with self.task_lock:
+                        self.done_index[task_key] = copy.deepcopy(result)
+                        while len(self.done_index) > DONE_INDEX_SIZE:
+                            self.done_index.popitem(last=False)
+                return result
+                
+        # not found in list, not found by matcher
+        result = {
+            'status' : NOT_FOUND,
+            'message' : ["Can't find task"],
+            'progress' : 0
+            }
+        return result            
+        
+    def is_busy(self, uuid):
+        # True while a task of the capture is running
         with self.task_lock:
-            # find in list
-            for task in self.task_list:
-                if task.get_key() == task_key:
-                    # found it
-                    result = task.get_status()    
-                    break
-            else:
-                #not found in list, look in directory
-                for tm in self.task_matcher:
-                    result = tm(task_key)
-                    if result:
+            for task in self.running_list:
+                if task.uuid == uuid:
+                    return True
+        return False
+        
+    def busy_captures(self):
+        # uuids of the captures with a running task
+        with self.task_lock:
+            return set([task.uuid for task in self.running_list])
+        
+    def status_changed(self, task_key, task):
+        # task is None when it left task_list
+        with self.status_lock:
+            self.status_seq += 1
+            if task is not None:
+                task.version = self.status_seq
+            entry = self.status_conds.get(task_key)
+            if entry is not None:
+                entry[0].notify_all()
+            
+    def get_status_version(self, task_key):
+        task = self.task_index.get(task_key)
+        if task is None:
+            return 0L
+        return task.version
+        
+    def wait_status(self, task_key, version, timeout):
+        # Wait until the version of the task is not version any more, 
+        # at most timeout seconds. Returns (status, version), the 
+        # status is at least as new as the version.
+        deadline = time.time() + timeout
+        with self.status_lock:
+            entry = self.status_conds.get(task_key)
+            if entry is None:
+                entry = [threading.Condition(self.status_lock), 0]
+                self.status_conds[task_key] = entry
+            entry[1] += 1
+            try:
+                while True:
+                    current = self.get_status_version(task_key)
+                    left = deadline - time.time()
+                    if current != version or left <= 0:
                         break
-                else:
-                    # not found in list, not found by matcher
-                    result = {
-                        'status' : NOT_FOUND,
-                        'message' : ["Can't find task"],
-                        'progress' : 0
-                        }
-        return result            
+                    entry[0].wait(left)
+            finally:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.status_conds[task_key]
+        return (self.query_task(task_key), current)
+        
+    def forget_capture(self, uuid):
+        # called before a capture is deleted, and after it is gone
+        # in case it was asked for meanwhile
+        with self.task_lock:
+            for key in self.done_index.keys():
+                if uuid in key:
+                    del self.done_index[key]
                 
     def register_matcher(self, method):
         with self.task_lock:
@@ -86,29 +285,118 @@ class TaskManager:
         
     def monitor(self):
         print "Enter monitor thread"
-        print "Start runner thread"
+        print "Start %d runner threads" % self.workers
+        runners = [None] * self.workers
         while True:
-            runner = threading.Thread(target=self.runner)
-            runner.start()
-            runner.join()
-            print "Runner thread died, restart thread again"
+            for i in range(self.workers):
+                if runners[i] is not None and runners[i].is_alive():
+                    continue
+                if runners[i] is not None:
+                    print "Runner thread died, restart thread again"
+                runners[i] = threading.Thread(target=self.runner)
+                runners[i].start()
+            time.sleep(1)
         
     def runner(self):
         while True:
             task = None
             with self.task_lock:
-                if len(self.task_list) > 0:
-                    task = self.task_list[0]
+                task = self.pick_task()
+                if task is None:
+                    # Nothing to do, wait for a new task
+                    self.task_cond.wait(1)
             
             if task:
                 # run task and remove self
-                task.run()
-                with self.task_lock:
-                    del(self.task_list[0])
-            else:
-                # Nothing to do so sleep 1 s
-                time.sleep(1)
+                started = time.time()
+                result = 'error'
+                try:
+                    task.run()
+                    if task.get_status()['status'] == FAILED:
+                        result = 'failed'
+                    else:
+                        result = 'done'
+                finally:
+                    task_seconds.observe((task.__class__.__name__, result), 
+                        time.time() - started)
+                    self.finish_task(task)
+                    # account the files it wrote
+                    get_usage_index().update(task.uuid)
+                
+    def pick_task(self):
+        # must be called under lock
+        # returns the waiting task that fits into the budget with
+        #   1. the highest priority (lowest value)
+        #   2. the owner with the fewest running tasks, then the
+        #      owner served least recently, so one owner can't 
+        #      take all runners while others wait
+        #   3. the earliest post
+        # or None while the first of them by this order does not fit
+        # and has waited longer than max_wait
+        running = dict()
+        prefetching = 0
+        for task in self.running_list:
+            owner = task.get_owner()
+            running[owner] = running.get(owner, 0) + 1
+            if task.priority == PRIORITY_PREFETCH:
+                prefetching += 1
+            
+        now = time.time()
+        found = None
+        found_rank = None
+        first = None
+        first_rank = None
+        for (seq, task) in enumerate(self.task_list):
+            if task in self.running_list:
+                continue
+            if (task.priority == PRIORITY_PREFETCH and 
+                prefetching >= self.prefetch_workers):
+                continue
+            owner = task.get_owner()
+            rank = (task.priority, running.get(owner, 0), 
+                self.owner_picked.get(owner, -1), seq)
+            if first is None or rank < first_rank:
+                first = task
+                first_rank = rank
+            if (len(self.running_list) > 0 and 
+                self.memory_in_use + task.memory_cost > self.memory_budget):
+                continue
+            if found is None or rank < found_rank:
+                found = task
+                found_rank = rank
                 
+        if (found is not first and first.posted is not None and
+            now - first.posted > self.max_wait):
+            # keep the room freed by the running tasks for it
+            found = None
+                
+        if found is not None:
+            self.memory_in_use += found.memory_cost
+            self.running_list.append(found)
+            if found.posted is not None:
+                task_wait_seconds.observe((found.__class__.__name__,), 
+                    now - found.posted)
+            self.owner_picked[found.get_owner()] = self.pick_count
+            self.pick_count += 1
+        return found
+        
+    def finish_task(self, task):
+        with self.task_lock:
+            self.running_list.remove(task)
+            self.memory_in_use -= task.memory_cost
+            self.task_list.remove(task)
+            del self.task_index[task.get_key()]
+            # now found by the matchers
+            self.status_changed(task.get_key(), None)
+            # forget owners having nothing left
+            owner = task.get_owner()
+            for t in self.task_list:
+                if t.get_owner() == owner:
+                    break
+            else:
+                self.owner_picked.pop(owner, None)
+            # budget is freed, others may start
+            self.task_cond.notify_all()
                 
     def start(self):
         t = threading.Thread(target=self.monitor)
@@ -120,14 +408,22 @@ task_manager = TaskManager()
         
 class TaskBase:
     def __init__(self):
-        # cached_status must be accessed 
-        # under TaskManager's lock in normal case
+        # cached_status is only replaced by put_status
         self.cached_status = {
             'status' : RUNNING,
             'message' : [],
             'progress' : 0
             }
         self.running = False
+        self.memory_cost = 0L
+        self.priority = PRIORITY_BULK
+        # address of the client asking for the task, if any
+        self.client = None
+        # time of post, for the queue metrics
+        self.posted = None
+        # see TaskManager.status_changed
+        self.version = 0L
+        
     def post(self):
         get_task_manager().post_task(self)
     
@@ -148,20 +444,27 @@ class TaskBase:
     def get_key(self):
         raise Exception("Need to implement this")
         
+    def get_memory_cost(self):
+        # estimated memory used when running the task
+        return 0L
+        
+    def get_owner(self):
+        # runners are shared fairly between owners
+        if conf.get('task_fair_share') == 'client' and self.client:
+            return self.client
+        return self.uuid
+        
     def get_status(self):
         raise Exception("Need to implement this")
         
     def get_status(self):
-        result =  None
-        with get_task_manager().get_lock():
-            result = copy.deepcopy(self.cached_status)
-        
-        return result
+        # cached_status is replaced as a whole and never changed
+        # in place, so it can be read without lock
+        return copy.deepcopy(self.cached_status)
         
     def put_status(self, status):
-        with get_task_manager().get_lock():
-            self.cached_status = copy.deepcopy(status)
-        pass
+        self.cached_status = copy.deepcopy(status)
+        get_task_manager().status_changed(self.get_key(), self)
         
 class TaskExtractCapture(TaskBase):
     def __init__(self, uuid):
@@ -192,7 +495,11 @@ class TaskExtractCapture(TaskBase):
             return
         
         main_bin_file = save_dir + uuid + "\\main.bin"
+        main_conns_file = save_dir + uuid + "\\main.conns"
         main_done_file = save_dir + uuid + "\\main.done" 
+        main_part_file = save_dir + uuid + "\\main.part"
+        main_tidx_file = save_dir + uuid + "\\main.tidx"
+        main_link_file = save_dir + uuid + "\\main.link"
     
         conns = None
     
@@ -222,19 +529,69 @@ class TaskExtractCapture(TaskBase):
         
         status = {
                 'status' : RUNNING,
-                'message' : ["Extract TCP connections"],
+                'message' : [],
                 'progress' : 10
             }
-        self.put_status(status)
-        
-        tcps = GetAllTCPConns(params).execute()
-        conn_list.extend(tcps)
+            
+        native = None
+        time_index = list()
+        stale_after = conf.get('upload_stale_in_second')
+        try:
+            if conf.get('native_extract'):
+                status['message'].append("Extract TCP and UDP connections")
+                self.put_status(status)
+                
+                # read the capture while it is uploaded
+                growing = lambda: is_uploading(main_part_file, main_cap, 
+                    stale_after)
+                try:
+                    native = ExtractConversations(main_cap, growing, time_index)
+                except CaptureFormatError:
+                    # not a format we can read, let tshark do it
+                    native = None
+                    
+            if not native:
+                # tshark needs the whole file
+                wait_for_upload(main_part_file, main_cap, stale_after)
+        except UploadBroken, e:
+            # the capture is closed by now, what is left can go
+            drop_upload(main_part_file, main_cap)
+            status['message'].append(str(e))
+            status['status'] = FAILED
+            self.put_status(status)
+            return
+            
+        if os.path.exists(main_link_file):
+            # uploaded before, the other capture has the results.
+            # main.cap is closed now, what could not be removed goes
+            drop_duplicate_files(save_dir + uuid)
+            get_usage_index().update(uuid)
+            status['progress'] = 100
+            status['status'] = OK
+            self.put_status(status)
+            return
+            
+        if not os.path.exists(main_cap):
+            # upload broken, the partial capture is gone
+            status['status'] = FAILED
+            self.put_status(status)
+            return
         
-        status['message'].append("Extract UDP connections")
-        status['progress'] = 50
-        self.put_status(status)
-        udps = GetAllUDPConns(params).execute()
-        conn_list.extend(udps)
+        if native:
+            (tcps, udps) = native
+            conn_list.extend(tcps)
+            conn_list.extend(udps)
+        else:
+            status['message'].append("Extract TCP connections")
+            self.put_status(status)
+            
+            # rows are taken while tshark prints them
+            conn_list.extend(GetAllTCPConns(params).rows())
+            
+            status['message'].append("Extract UDP connections")
+            status['progress'] = 50
+            self.put_status(status)
+            conn_list.extend(GetAllUDPConns(params).rows())
         
         conns['conn_list'] = conn_list
         
@@ -247,6 +604,14 @@ class TaskExtractCapture(TaskBase):
             cPickle.dump(conns, f)
         except:
             f.close()
+        get_pickle_cache().invalidate(main_bin_file)
+        
+        # typed copy for random access by index
+        WriteConnectionStore(main_conns_file, conn_list)
+        
+        # time windows are cut from main.cap through it
+        if native and len(time_index) > 0:
+            WriteTimeIndex(main_tidx_file, time_index)
             
         status['message'].append("Save Analysis Result")
         status['progress'] = 95
@@ -256,10 +621,29 @@ class TaskExtractCapture(TaskBase):
         f = open(main_done_file, "wb")
         f.close()
         
+        # count the TCP analysis of all connections for the table
+        if conf.get('triage'):
+            task = TaskTriageCapture(uuid)
+            task.client = self.client
+            task.post()
+        
+        # write files of single connections in background, 
+        # then analyze some of them ahead
+        if conf.get('split_top_n') >= 0:
+            task = TaskSplitCapture(uuid)
+            task.client = self.client
+            task.post()
+        else:
+            post_prefetch(uuid, self.client)
+        
         status['message'].append("Save log")
         status['progress'] = 100
         self.put_status(status)
             
+    def get_memory_cost(self):
+        main_cap = conf.get('save_dir') + self.uuid + "\\main.cap"
+        return get_file_size(main_cap)
+        
     def get_key(self):
         return "TaskExtractCapture/%s" % (self.uuid,)
         
@@ -287,22 +671,296 @@ class TaskExtractCapture(TaskBase):
         # General file names
         main_done_file = save_dir + uuid + "\\main.done"
         
-        # Find done file under lock
-        with get_task_manager().get_lock():
-            if os.path.exists(main_done_file):
-                found = {
-                    'status' : OK,
-                    'message' : [],
-                    'progress' : 100
-                    }
+        if os.path.exists(main_done_file):
+            found = {
+                'status' : OK,
+                'message' : [],
+                'progress' : 100
+                }
         return found
         
     
+# Write the files of single connections (<index>.cap) for the 
+# biggest connections in one pass over main.cap, so that 
+# TaskAnalyzeConnection does not need to filter main.cap again
+class TaskSplitCapture(TaskBase):
+    def __init__(self, uuid):
+        TaskBase.__init__(self)
+        self.uuid = uuid
+        # only speeds up later analysis
+        self.priority = PRIORITY_PREFETCH
+        
+    def run_internal(self):
+        uuid = self.uuid
+        
+        save_dir = conf.get('save_dir')
+        
+        main_cap = save_dir + uuid + "\\main.cap"
+        main_bin_file = save_dir + uuid + "\\main.bin"
+        main_conns_file = save_dir + uuid + "\\main.conns"
+        split_done_file = save_dir + uuid + "\\split.done"
+        
+        if not os.path.exists(main_cap) or not os.path.exists(main_bin_file):
+            status = {
+                'status' : FAILED,
+                'message' : [],
+                'progress' : 0
+            }
+            
+            self.put_status(status)
+            # no more to do, bail out
+            return
+            
+        status = {
+                'status' : RUNNING,
+                'message' : ["Load all connections"],
+                'progress' : 5
+            }
+        self.put_status(status)
+        
+        store = OpenConnectionStore(main_conns_file, main_bin_file)
+        try:
+            # pick the biggest connections, 0 means all
+            tbytes = store.get_column('tbytes')
+            indexes = range(len(store))
+            indexes.sort(key=lambda i: tbytes[i], reverse=True)
+            top_n = conf.get('split_top_n')
+            if top_n > 0:
+                indexes = indexes[:top_n]
+                
+            targets = dict()
+            for index in indexes:
+                conns_single_cap = save_dir + uuid + "\\" + str(index) + ".cap"
+                if not os.path.exists(conns_single_cap):
+                    targets[conns_single_cap] = store[index]
+        finally:
+            store.close()
+        
+        status['message'].append("Split %d connections" % len(targets))
+        status['progress'] = 10
+        self.put_status(status)
+        
+        reserved = sum([get_conn_cap_size(c) for c in targets.values()])
+        get_usage_index().reserve(uuid, reserved)
+        try:
+            SplitConversations(main_cap, targets)
+        except CaptureFormatError:
+            # leave it to TaskAnalyzeConnection
+            pass
+        finally:
+            get_usage_index().update(uuid)
+            get_usage_index().release(uuid, reserved)
+        
+        f = open(split_done_file, "wb")
+        f.close()
+        
+        post_prefetch(uuid, self.client)
+        
+        status['message'].append("Save log")
+        status['progress'] = 100
+        self.put_status(status)
+        
+    def get_memory_cost(self):
+        main_cap = conf.get('save_dir') + self.uuid + "\\main.cap"
+        return get_file_size(main_cap)
+        
+    def get_key(self):
+        return "TaskSplitCapture/%s" % (self.uuid,)
+        
+    @staticmethod
+    def make_key(uuid):
+        return "TaskSplitCapture/%s" % (uuid,)
+    
+    @staticmethod
+    def matcher(key):
+        found = None
+        uuid = None
+        pat = re.compile('TaskSplitCapture/(?P<uuid>[\w-]{36})')
+        m = pat.match(key)
+        if not m:
+            return None
+        else:
+            d = m.groupdict()
+            uuid = d['uuid']
+        
+        # Now look for done file
+        conf = GlobalConfig()
+        
+        save_dir = conf.get('save_dir')
+
+        # General file names
+        split_done_file = save_dir + uuid + "\\split.done"
+        
+        if os.path.exists(split_done_file):
+            found = {
+                'status' : OK,
+                'message' : [],
+                'progress' : 100
+                }
+        return found
+        
+    
+# tshark filter of each counter of TRIAGE_COUNTERS, same as the 
+# analysis of a single connection (TCPRetrans, TCPZeroWin, ...)
+TRIAGE_FILTERS = {
+    'retrans' : "tcp.analysis.retransmission",
+    'zerowin' : "tcp.analysis.zero_window",
+    'sack' : "tcp.option_kind==5",
+    'delayack' : "tcp.analysis.ack_rtt >0.19 and tcp.len==0",
+}
+
+# Count retransmissions, zero windows, SACKs and delayed ACKs of all 
+# connections in one pass over main.cap (one tshark run in batch 
+# mode, conversations of the matching packets), so the connection 
+# table can be sorted by them. Written to main.triage.
+class TaskTriageCapture(TaskBase):
+    def __init__(self, uuid):
+        TaskBase.__init__(self)
+        self.uuid = uuid
+        
+    def run_internal(self):
+        uuid = self.uuid
+        
+        save_dir = conf.get('save_dir')
+        
+        main_cap = save_dir + uuid + "\\main.cap"
+        main_bin_file = save_dir + uuid + "\\main.bin"
+        main_conns_file = save_dir + uuid + "\\main.conns"
+        main_triage_file = save_dir + uuid + "\\main.triage"
+        
+        if not os.path.exists(main_cap) or not os.path.exists(main_bin_file):
+            status = {
+                'status' : FAILED,
+                'message' : [],
+                'progress' : 0
+            }
+            
+            self.put_status(status)
+            # no more to do, bail out
+            return
+            
+        if os.path.exists(main_triage_file):
+            # posted again before the first one was done
+            return
+            
+        status = {
+                'status' : RUNNING,
+                'message' : ["Count TCP analysis of all connections"],
+                'progress' : 10
+            }
+        self.put_status(status)
+        
+        batch = CommandBatch()
+        commands = dict()
+        for name in TRIAGE_COUNTERS:
+            commands[name] = batch.add(TCPConvCount({
+                'filename' : main_cap,
+                'filter' : TRIAGE_FILTERS[name],
+            }))
+        batch.execute()
+        
+        status['message'].append("Save triage")
+        status['progress'] = 90
+        self.put_status(status)
+        
+        counts = dict([(name, command.get_parsed_output()) 
+            for (name, command) in commands.items()])
+        store = OpenConnectionStore(main_conns_file, main_bin_file)
+        try:
+            WriteTriage(main_triage_file, store, counts)
+        finally:
+            store.close()
+        
+        status['progress'] = 100
+        self.put_status(status)
+        
+    def get_memory_cost(self):
+        main_cap = conf.get('save_dir') + self.uuid + "\\main.cap"
+        return get_file_size(main_cap)
+        
+    def get_key(self):
+        return "TaskTriageCapture/%s" % (self.uuid,)
+        
+    @staticmethod
+    def make_key(uuid):
+        return "TaskTriageCapture/%s" % (uuid,)
+    
+    @staticmethod
+    def matcher(key):
+        found = None
+        uuid = None
+        pat = re.compile('TaskTriageCapture/(?P<uuid>[\w-]{36})')
+        m = pat.match(key)
+        if not m:
+            return None
+        else:
+            d = m.groupdict()
+            uuid = d['uuid']
+        
+        save_dir = conf.get('save_dir')
+
+        # the triage is the done file
+        main_triage_file = save_dir + uuid + "\\main.triage"
+        
+        if os.path.exists(main_triage_file):
+            found = {
+                'status' : OK,
+                'message' : [],
+                'progress' : 100
+                }
+        return found
+        
+    
+# Post TaskAnalyzeConnection for the connections most likely to be
+# clicked, before they are: the biggest ones by prefetch_sort, and
+# the biggest ones on storage ports. They run with PRIORITY_PREFETCH
+# on at most prefetch_workers runners, a click raises the priority.
+def post_prefetch(uuid, client):
+    top_n = conf.get('prefetch_top_n')
+    if top_n <= 0:
+        return
+        
+    save_dir = conf.get('save_dir')
+    main_bin_file = save_dir + uuid + "\\main.bin"
+    main_conns_file = save_dir + uuid + "\\main.conns"
+    
+    sort = conf.get('prefetch_sort')
+    store = OpenConnectionStore(main_conns_file, main_bin_file)
+    try:
+        # ascending order, the biggest at the end
+        count = len(store)
+        indexes = list(reversed(store.get_column('order_' + sort, 
+            max(count - top_n, 0))))
+        
+        storage = set()
+        for port in conf.get('prefetch_ports'):
+            storage.update(store.lookup('src_port', port))
+            storage.update(store.lookup('dest_port', port))
+        column = SORT_KEYS[sort]
+        storage = sorted(storage, key=lambda i: store.get_value(column, i), 
+            reverse=True)
+        for index in storage[:top_n]:
+            if index not in indexes:
+                indexes.append(index)
+    finally:
+        store.close()
+        
+    for index in indexes:
+        task = TaskAnalyzeConnection(uuid, index)
+        task.priority = PRIORITY_PREFETCH
+        task.client = client
+        task.post()
+    
+# window: optional (start, end) in seconds from the first packet of
+# the capture, the analyses then only see the packets in it
 class TaskAnalyzeConnection(TaskBase):
-    def __init__(self, uuid, index):
+    def __init__(self, uuid, index, window=None):
         TaskBase.__init__(self)
         self.uuid = uuid
         self.index = index
+        self.window = window
+        # somebody is waiting on the page
+        self.priority = PRIORITY_INTERACTIVE
         
     def run_internal(self):
         
@@ -310,15 +968,17 @@ class TaskAnalyzeConnection(TaskBase):
         
         uuid = self.uuid
         index = self.index
+        name = conn_result_name(index, self.window)
 
         save_dir = conf.get('save_dir')
     
         # General file names
         main_cap = save_dir + uuid + "\\main.cap"
         main_bin_file = save_dir + uuid + "\\main.bin"
-        conns_single_cap = save_dir + uuid + "\\" + str(index) + ".cap"
-        conns_single_bin = save_dir + uuid + "\\" + str(index) + ".bin"
-        conns_single_done = save_dir + uuid + "\\" + str(index) + ".done"
+        main_conns_file = save_dir + uuid + "\\main.conns"
+        conns_single_cap = save_dir + uuid + "\\" + name + ".cap"
+        conns_single_bin = save_dir + uuid + "\\" + name + ".bin"
+        conns_single_done = save_dir + uuid + "\\" + name + ".done"
     
         # Not found
         if not os.path.exists(main_cap):
@@ -340,7 +1000,7 @@ class TaskAnalyzeConnection(TaskBase):
         self.put_status(status)
         
         # load connections
-        conns = None
+        conn = None
         if not os.path.exists(main_bin_file):
             # at this point, we should have already generate this file
             # otherwise it is error
@@ -354,18 +1014,20 @@ class TaskAnalyzeConnection(TaskBase):
             # no more to do, bail out
             return
         else:
-            f = open(main_bin_file, "rb")
+            store = OpenConnectionStore(main_conns_file, main_bin_file)
             try:
-                conns = cPickle.load(f)
-            except:
-                f.close()
+                # check index out of bound
+                if index < len(store):
+                    conn = store[index]
+            finally:
+                store.close()
     
         status['message'].append("Load single connection")
         status['progress'] = 10
         self.put_status(status)
                 
         # check index out of bound
-        if index >= len(conns['conn_list']):
+        if conn is None:
             status = {
                 'status' : FAILED,
                 'message' : [],
@@ -376,8 +1038,6 @@ class TaskAnalyzeConnection(TaskBase):
             # no more to do, bail out
             return
     
-        conn = conns['conn_list'][index]
-        
         # filter single connection if not exists
         if not os.path.exists(conns_single_cap):
             if conn['type'] == 'TCP':
@@ -387,8 +1047,21 @@ class TaskAnalyzeConnection(TaskBase):
             params = dict(conn)
             params['filename'] = main_cap
             params['outfilename'] = conns_single_cap
+            if self.window is not None:
+                (params['window_start'], params['window_end']) = self.window
 
-            klass(params).execute()
+            reserved = get_conn_cap_size(conn)
+            get_usage_index().reserve(uuid, reserved)
+            try:
+                if self.window is None or not self.cut_window(conn, conns_single_cap):
+                    klass(params).execute()
+            finally:
+                get_usage_index().update(uuid)
+                get_usage_index().release(uuid, reserved)
+        else:
+            # used, the space monitor deletes the least recently 
+            # used ones first
+            os.utime(conns_single_cap, None)
             
         # Now begin to analyze singe connection
         # Note: All ports are in string
@@ -400,6 +1073,7 @@ class TaskAnalyzeConnection(TaskBase):
         env = dict()
         env['conn'] = conn
         env['index'] = index
+        env['window'] = self.window
         env['filename'] = conns_single_cap
 
         result.update(env)
@@ -410,30 +1084,48 @@ class TaskAnalyzeConnection(TaskBase):
         self.put_status(status)
         # Layout of result
         # <dict>[analysis_typename] for each
+        analyses = dict()
+        general = GeneralAnalysis(env)
+        batch = CommandBatch()
+        
+        # The protocol check and the capinfos run of the general 
+        # analysis only need the file, run them together
+        params = {
+            'filename' : env['filename'],
+        }
+        check = None
+        if (conn['src_port'] == '3260' or conn['dest_port'] == '3260'):
+            pass
+        elif (conn['src_port'] == '139' or conn['dest_port'] == '139' or conn['src_port'] == '445' or conn['dest_port'] == '445'):
+            check = SMBType(params)
+        elif (conn['src_port'] == '2049' or conn['dest_port'] == '2049'):
+            check = NFSType(params)
+            
+        jobs = [lambda: general.prepare(batch)]
+        if check is not None:
+            jobs.append(check.execute)
+        run_parallel(jobs, conf.get('analysis_parallelism'))
+        
         if (conn['src_port'] == '3260' or conn['dest_port'] == '3260'):
             # iSCSI
             result['show_type'] = 'iscsi' 
             
-            result['general'] = GeneralAnalysis(env).analyze()
-            result['iscsi'] = iSCSIAnalysis(env).analyze()
-            result['tcp'] = TCPAnalysis(env).analyze()
+            analyses['general'] = general
+            analyses['iscsi'] = iSCSIAnalysis(env)
+            analyses['tcp'] = TCPAnalysis(env)
             result['title'] = 'iSCSI' 
         
         elif (conn['src_port'] == '139' or conn['dest_port'] == '139' or conn['src_port'] == '445' or conn['dest_port'] == '445'):
 
-            params = {
-                'filename' : env['filename'],
-            }
-            
-            check_smb = SMBType(params).execute()
+            check_smb = check.get_parsed_output()
             
             if check_smb[0]['smbf'] != '0':
                 # is SMB
                 result['show_type'] = 'smb' 
             
-                result['general'] = GeneralAnalysis(env).analyze()
-                result['smb'] = SMBAnalysis(env).analyze()
-                result['tcp'] = TCPAnalysis(env).analyze()
+                analyses['general'] = general
+                analyses['smb'] = SMBAnalysis(env)
+                analyses['tcp'] = TCPAnalysis(env)
                 
                 result['title'] = 'SMB' 
 
@@ -441,30 +1133,26 @@ class TaskAnalyzeConnection(TaskBase):
                 # is SMB2
                 result['show_type'] = 'smb2'
             
-                result['general'] = GeneralAnalysis(env).analyze()
-                result['smb2'] = SMB2Analysis(env).analyze()
-                result['tcp'] = TCPAnalysis(env).analyze()
+                analyses['general'] = general
+                analyses['smb2'] = SMB2Analysis(env)
+                analyses['tcp'] = TCPAnalysis(env)
                 
                 result['title'] = 'SMB2' 
                 
         elif (conn['src_port'] == '2049' or conn['dest_port'] == '2049'):
-            params = {
-                'filename' : env['filename'],
-            }
-            
-            check_nfs = NFSType(params).execute()
+            check_nfs = check.get_parsed_output()
             
             if check_nfs[0]['nfsv3f'] != '0':
                 # is NFSV3
                 result['show_type'] = 'nfsv3'
             
-                result['general'] = GeneralAnalysis(env).analyze()
-                result['nfsv3'] = NFSV3Analysis(env).analyze()
+                analyses['general'] = general
+                analyses['nfsv3'] = NFSV3Analysis(env)
                 
                 if result['conn']['type'] == 'TCP':
-                    result['tcp'] = TCPAnalysis(env).analyze()
+                    analyses['tcp'] = TCPAnalysis(env)
                 else:
-                    result['udp'] = UDPAnalysis(env).analyze()
+                    analyses['udp'] = UDPAnalysis(env)
                     
                 result['title'] = 'NFS v3'     
                 
@@ -472,32 +1160,43 @@ class TaskAnalyzeConnection(TaskBase):
                 # is NFSV4
                 result['show_type'] = 'nfsv4'
             
-                result['general'] = GeneralAnalysis(env).analyze()
-                result['nfsv4'] = NFSV4Analysis(env).analyze()
+                analyses['general'] = general
+                analyses['nfsv4'] = NFSV4Analysis(env)
                 if result['conn']['type'] == 'TCP':
-                    result['tcp'] = TCPAnalysis(env).analyze()
+                    analyses['tcp'] = TCPAnalysis(env)
                 else:
-                    result['udp'] = UDPAnalysis(env).analyze()
+                    analyses['udp'] = UDPAnalysis(env)
                 
                 result['title'] = 'NFS v4'     
         else:
-            result['general'] = GeneralAnalysis(env).analyze()
+            analyses['general'] = general
                 
             if result['conn']['type'] == 'TCP':
                 result['show_type'] = 'general_tcp'
-                result['tcp'] = TCPAnalysis(env).analyze()
+                analyses['tcp'] = TCPAnalysis(env)
                 
                 result['title'] = 'TCP General'     
             else:
-                result['udp'] = UDPAnalysis(env).analyze()
+                analyses['udp'] = UDPAnalysis(env)
                 result['show_type'] = 'general_udp'
                 result['title'] = 'UDP General'     
         
+        # Run the commands of all analyses together, in batch mode
+        # the connection file is dissected once for all of them,
+        # otherwise independent commands run concurrently
+        for analysis in analyses.values():
+            analysis.prepare(batch)
+        batch.execute()
+        
+        for (name, analysis) in analyses.items():
+            result[name] = analysis.analyze()
+        
         f = open(conns_single_bin, "wb")
         try:
             cPickle.dump(result, f)
         except:
             f.close()     
+        get_pickle_cache().invalidate(conns_single_bin)
         
         # write done file of connection           
         f = open(conns_single_done, "wb")
@@ -507,26 +1206,51 @@ class TaskAnalyzeConnection(TaskBase):
         status['progress'] = 100
         self.put_status(status)
         
+    def cut_window(self, conn, outfilename):
+        # write the packets of the connection in the window, reading 
+        # main.cap from the place given by its time index. Returns 
+        # False if the format can't be read, tshark filters it then.
+        save_dir = conf.get('save_dir')
+        main_cap = save_dir + self.uuid + "\\main.cap"
+        time_index = LoadTimeIndex(save_dir + self.uuid + "\\main.tidx")
+        try:
+            SplitConversations(main_cap, {outfilename : conn}, 
+                self.window, time_index)
+        except CaptureFormatError:
+            return False
+        return True
+        
+    def get_memory_cost(self):
+        # main.cap is read if the connection is not split yet
+        save_dir = conf.get('save_dir')
+        name = conn_result_name(self.index, self.window)
+        conns_single_cap = save_dir + self.uuid + "\\" + name + ".cap"
+        if os.path.exists(conns_single_cap):
+            return get_file_size(conns_single_cap)
+        return get_file_size(save_dir + self.uuid + "\\main.cap")
+        
     def get_key(self):
-        return "TaskAnalyzeConnection/%s/%d" % (self.uuid, self.index)     
+        return "TaskAnalyzeConnection/%s/%s" % (self.uuid, 
+            conn_result_name(self.index, self.window))
 
     @staticmethod
-    def make_key(uuid, index):
-        return "TaskAnalyzeConnection/%s/%d" % (uuid, index)     
+    def make_key(uuid, index, window=None):
+        return "TaskAnalyzeConnection/%s/%s" % (uuid, 
+            conn_result_name(index, window))
     
     @staticmethod    
     def matcher(key):
         found = None
         uuid = None
-        index = -1
-        pat = re.compile('TaskAnalyzeConnection/(?P<uuid>[\w-]{36})/(?P<index>\d+)')
+        name = None
+        pat = re.compile('TaskAnalyzeConnection/(?P<uuid>[\w-]{36})/(?P<name>\d+(\.w\d+-\d+)?)$')
         m = pat.match(key)
         if not m:
             return None
         else:
             d = m.groupdict()
             uuid = d['uuid']
-            index = int(d['index'])
+            name = d['name']
             
         # Now look for done file
         conf = GlobalConfig()
@@ -534,9 +1258,8 @@ class TaskAnalyzeConnection(TaskBase):
         save_dir = conf.get('save_dir')
 
         # General file names
-        conn_done_file = "%s%s\\%d.done" % (save_dir, uuid, index)
+        conn_done_file = "%s%s\\%s.done" % (save_dir, uuid, name)
         
-        # Find done file under lock
         if os.path.exists(conn_done_file):
             found = {
                 'status' : OK,
@@ -546,6 +1269,8 @@ class TaskAnalyzeConnection(TaskBase):
         return found        
 
 get_task_manager().register_matcher(TaskExtractCapture.matcher)
+get_task_manager().register_matcher(TaskSplitCapture.matcher)
+get_task_manager().register_matcher(TaskTriageCapture.matcher)
 get_task_manager().register_matcher(TaskAnalyzeConnection.matcher)
 
 
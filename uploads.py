@@ -0,0 +1,376 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from atomicfile import write_file
+
+__all__ = [
+    'CaptureWriter',
+    'UploadSession',
+    'UploadBroken',
+    'is_uploading',
+    'drop_upload',
+    'wait_for_upload',
+    'deduplicate_capture',
+    'drop_duplicate_files',
+    'resolve_capture',
+    'forget_capture_hash',
+]
+
+# seconds between two checks of an upload in progress
+UPLOAD_POLL_INTERVAL = 0.5
+
+# bytes read from a request or a file at a time
+COPY_BUFFER = 1024 * 1024
+
+# Write an uploaded capture in place while the request body is read.
+# Used as the stream of the file part by the form parser, so only one
+# chunk of the body is in memory at a time.
+#
+# While it is written
+#   marker_file exists, readers of cap_file wait for more data
+# When finished
+#   hash_file has the sha1 of cap_file (hex)
+# When ended
+#   marker_file is removed, readers stop at the end of cap_file
+# When aborted
+#   marker_file is not empty any more, readers stop with UploadBroken
+#   and remove what is left, see drop_upload
+class CaptureWriter:
+    def __init__(self, cap_file, marker_file, hash_file):
+        self.cap_file = cap_file
+        self.marker_file = marker_file
+        self.hash_file = hash_file
+        self.sha1 = hashlib.sha1()
+        self.size = 0L
+
+        # marker first, a reader must never see a complete looking file
+        f = open(marker_file, "wb")
+        f.close()
+        self.f = open(cap_file, "wb")
+
+    def write(self, data):
+        self.f.write(data)
+        self.sha1.update(data)
+        self.size += len(data)
+
+    def seek(self, offset, whence=0):
+        # the form parser rewinds the stream for reading when the part
+        # is done, nothing is read back from here
+        pass
+
+    def finish(self):
+        self.f.close()
+
+        f = open(self.hash_file, "wb")
+        try:
+            f.write(self.sha1.hexdigest())
+        finally:
+            f.close()
+
+    def end(self):
+        # the end is told after the last write
+        if os.path.exists(self.marker_file):
+            os.remove(self.marker_file)
+
+    def abort(self):
+        # broken upload, drop the partial capture.
+        # readers are told first: on Windows the file can't be removed
+        # while the extraction has it mapped, it is then removed by
+        # the extraction when it stops
+        self.f.close()
+        f = open(self.marker_file, "wb")
+        try:
+            f.write("abort")
+        finally:
+            f.close()
+        drop_upload(self.marker_file, self.cap_file)
+
+class UploadBroken(Exception):
+    pass
+
+def is_uploading(marker_file, cap_file=None, stale_after=None):
+    # Raises UploadBroken if the upload was aborted, or if neither
+    # marker_file nor cap_file changed for stale_after seconds: the
+    # server stopped during the upload and left the marker behind.
+    try:
+        marker = os.stat(marker_file)
+    except OSError:
+        return False
+    if marker.st_size > 0:
+        raise UploadBroken("Upload aborted")
+
+    if stale_after is not None:
+        last = marker.st_mtime
+        if cap_file is not None:
+            try:
+                last = max(last, os.stat(cap_file).st_mtime)
+            except OSError:
+                pass
+        if time.time() - last > stale_after:
+            raise UploadBroken("Upload stalled")
+    return True
+
+def wait_for_upload(marker_file, cap_file=None, stale_after=None):
+    # raises UploadBroken, see is_uploading
+    while is_uploading(marker_file, cap_file, stale_after):
+        time.sleep(UPLOAD_POLL_INTERVAL)
+
+def drop_upload(marker_file, cap_file):
+    # remove a broken upload, the marker last so that readers don't 
+    # take the partial capture for a complete one.
+    # Returns False if the capture is still open by a reader.
+    try:
+        if os.path.exists(cap_file):
+            os.remove(cap_file)
+    except os.error:
+        return False
+    try:
+        os.remove(marker_file)
+    except os.error:
+        pass
+    return True
+
+# Upload of a capture in numbered chunks, over several requests.
+# Chunks can come in any order and more than one at a time, a chunk
+# sent again replaces the previous one.
+#
+# Files in the capture directory while the upload is open
+#   main.upload: the capture, full size from the start, each chunk
+#       is written at its own offset
+#   main.session: size and chunk size (json)
+#   main.chunks: one byte per chunk, set when the chunk is committed
+#   main.upload.*.chunk: a chunk being received, copied into 
+#       main.upload once its sha1 is right
+# On finalize main.upload becomes main.cap, and main.sha1 is written.
+# Everything is in files, an upload goes on after a restart.
+class UploadSession:
+    def __init__(self, directory):
+        self.data_file = directory + "\\main.upload"
+        self.session_file = directory + "\\main.session"
+        self.chunks_file = directory + "\\main.chunks"
+        self.size = None
+        self.chunk_size = None
+        self.chunks = None
+        # of the whole capture, set by finalize
+        self.sha1 = None
+
+    def create(self, size, chunk_size):
+        self.size = size
+        self.chunk_size = chunk_size
+        self.chunks = (size + chunk_size - 1) // chunk_size
+
+        f = open(self.data_file, "wb")
+        try:
+            f.truncate(size)
+        finally:
+            f.close()
+            
+        f = open(self.chunks_file, "wb")
+        try:
+            f.write("\0" * self.chunks)
+        finally:
+            f.close()
+
+        # written last, the session is open once this file is there
+        f = open(self.session_file, "wb")
+        try:
+            json.dump(dict(size=size, chunk_size=chunk_size), f)
+        finally:
+            f.close()
+
+    def load(self):
+        # returns False if there is no open upload
+        try:
+            f = open(self.session_file, "rb")
+        except IOError:
+            return False
+        try:
+            session = json.load(f)
+        finally:
+            f.close()
+
+        self.size = session['size']
+        self.chunk_size = session['chunk_size']
+        self.chunks = (self.size + self.chunk_size - 1) // self.chunk_size
+        return True
+
+    def chunk_range(self, index):
+        # returns (offset, length) of chunk index in the capture
+        offset = index * self.chunk_size
+        return (offset, min(self.chunk_size, self.size - offset))
+
+    def write_chunk(self, index, stream, sha1):
+        # copy the chunk from stream, then commit it if its sha1 (hex)
+        # is right. Returns False if the data is short or wrong, the
+        # capture is then left as it was.
+        (offset, length) = self.chunk_range(index)
+        digest = hashlib.sha1()
+        left = length
+
+        (fd, chunk_file) = tempfile.mkstemp(
+            prefix=os.path.basename(self.data_file) + ".", suffix=".chunk",
+            dir=os.path.dirname(self.data_file) or ".")
+        try:
+            f = os.fdopen(fd, "w+b")
+            try:
+                while left > 0:
+                    data = stream.read(min(left, COPY_BUFFER))
+                    if not data:
+                        break
+                    f.write(data)
+                    digest.update(data)
+                    left -= len(data)
+
+                if left > 0 or digest.hexdigest() != sha1.lower():
+                    return False
+
+                # not committed while it is copied, a stop in between
+                # must not leave a committed chunk with other data
+                self.set_committed(index, "\0")
+                f.seek(0)
+                out = open(self.data_file, "r+b")
+                try:
+                    out.seek(offset)
+                    shutil.copyfileobj(f, out, COPY_BUFFER)
+                finally:
+                    out.close()
+            finally:
+                f.close()
+        finally:
+            os.remove(chunk_file)
+
+        self.set_committed(index, "\1")
+        return True
+
+    def set_committed(self, index, flag):
+        f = open(self.chunks_file, "r+b")
+        try:
+            f.seek(index)
+            f.write(flag)
+        finally:
+            f.close()
+
+    def committed(self):
+        # list of committed chunk numbers
+        f = open(self.chunks_file, "rb")
+        try:
+            flags = f.read()
+        finally:
+            f.close()
+        return [i for i in range(self.chunks) if flags[i:i + 1] == "\1"]
+
+    def finalize(self, cap_file, hash_file):
+        # returns False if some chunks are missing
+        if len(self.committed()) != self.chunks:
+            return False
+
+        digest = hashlib.sha1()
+        f = open(self.data_file, "rb")
+        try:
+            while True:
+                data = f.read(COPY_BUFFER)
+                if not data:
+                    break
+                digest.update(data)
+        finally:
+            f.close()
+
+        self.sha1 = digest.hexdigest()
+        f = open(hash_file, "wb")
+        try:
+            f.write(self.sha1)
+        finally:
+            f.close()
+
+        os.rename(self.data_file, cap_file)
+        os.remove(self.session_file)
+        os.remove(self.chunks_file)
+        return True
+
+# Captures are indexed by the sha1 of main.cap, so the same file
+# uploaded again is not stored nor analyzed twice.
+#   save_dir\sha1\<hex>: uuid of the capture with this content
+#   <uuid>\main.link: uuid of the capture to use instead, the
+#       directory of a duplicate keeps only this file
+def hash_index_file(save_dir, sha1):
+    return save_dir + "sha1\\" + sha1
+
+def read_text(filename):
+    # returns None if the file is not there
+    try:
+        f = open(filename, "rb")
+    except IOError:
+        return None
+    try:
+        return f.read().strip()
+    finally:
+        f.close()
+
+def write_text(filename, text):
+    # the same capture uploaded twice at the same time writes its
+    # hash index entry twice, either uuid does
+    write_file(filename, lambda f: f.write(text))
+
+def find_capture(save_dir, sha1):
+    # uuid of a kept capture with this content, or None
+    uuid = read_text(hash_index_file(save_dir, sha1))
+    if uuid is None:
+        return None
+    # entry of a deleted capture
+    if read_text(save_dir + uuid + "\\main.sha1") != sha1:
+        return None
+    if not os.path.exists(save_dir + uuid + "\\main.cap"):
+        return None
+    return uuid
+
+def deduplicate_capture(save_dir, uuid, sha1):
+    # Call when main.cap of uuid is complete, returns the uuid to use.
+    # If the same content is already there, uuid becomes a link to it
+    # and its own files are removed.
+    found = find_capture(save_dir, sha1)
+    if found is None or found == uuid:
+        if not os.path.exists(save_dir + "sha1"):
+            os.mkdir(save_dir + "sha1")
+        write_text(hash_index_file(save_dir, sha1), uuid)
+        return uuid
+
+    directory = save_dir + uuid
+    write_text(directory + "\\main.link", found)
+    drop_duplicate_files(directory)
+
+    # used again, keep it as long as a new one
+    os.utime(save_dir + found, None)
+    return found
+
+def drop_duplicate_files(directory):
+    # remove all but main.link from the directory of a duplicate. 
+    # Files still open (main.cap mapped by the extraction on Windows)
+    # stay, the extraction calls it again once it has closed them.
+    for name in os.listdir(directory):
+        if name != "main.link":
+            try:
+                os.remove(directory + "\\" + name)
+            except os.error:
+                pass
+
+def resolve_capture(save_dir, uuid):
+    # uuid of the capture holding the files of uuid
+    found = read_text(save_dir + uuid + "\\main.link")
+    if found is None:
+        return uuid
+    return found
+
+def forget_capture_hash(save_dir, uuid):
+    # call before the capture is deleted
+    sha1 = read_text(save_dir + uuid + "\\main.sha1")
+    if sha1 is None:
+        return
+    if read_text(hash_index_file(save_dir, sha1)) == uuid:
+        try:
+            os.remove(hash_index_file(save_dir, sha1))
+        except os.error:
+            pass
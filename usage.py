@@ -0,0 +1,388 @@
+import threading
+import heapq
+import glob
+import time
+import re
+import os
+import cPickle
+
+from config import GlobalConfig
+from metrics import Gauge
+
+__all__ = [
+    'get_usage_index',
+    'capture_dirs',
+]
+
+conf = GlobalConfig()
+
+# seconds between two saves of the index while it changes
+USAGE_SAVE_INTERVAL = 60
+
+USAGE_INDEX_VERSION = 3
+
+# files made again when they are missing: the captures of single
+# connections, <index>.cap, and the rendered pages of their results,
+# <index>.<key>.html.gz, same for time windows (<index>.w<ms>-<ms>)
+DERIVED_PAT = re.compile(r'^\d+(\.w\d+-\d+)?\.(cap|\w+\.html\.gz)$')
+
+usage_index = None
+
+def get_usage_index():
+    global usage_index
+    return usage_index
+
+def capture_dirs(save_dir):
+    # all capture directories, e.g.
+    # 29f33cd3-c1a9-4d12-a336-0f6d76ca100e
+    pat = save_dir + "%s-%s-%s-%s-%s" % (
+        '?' * 8, '?' * 4, '?' * 4, '?' * 4, '?' * 12)
+    return glob.glob(pat)
+
+def scan_capture(directory):
+    # returns ((bytes of all files, mtime of the directory), derived,
+    # others) with derived a dict of name -> (bytes, mtime) of derived
+    # files, others the same for the other files. Raises os.error if
+    # the directory is gone
+    mtime = os.stat(directory).st_mtime
+    size = 0L
+    derived = dict()
+    others = dict()
+    for name in os.listdir(directory):
+        try:
+            stat = os.stat(directory + "\\" + name)
+        except os.error:
+            # removed meanwhile
+            continue
+        size += stat.st_size
+        if DERIVED_PAT.match(name):
+            derived[name] = (stat.st_size, stat.st_mtime)
+        else:
+            others[name] = (stat.st_size, stat.st_mtime)
+    return ((size, mtime), derived, others)
+
+def is_unchanged(directory, record, files):
+    # True if the files of directory are still the ones scanned. 
+    # Names only change with the mtime of the directory, a file 
+    # written in place (upload, output of a command) only with its
+    # own size and mtime.
+    try:
+        if os.stat(directory).st_mtime != record[1]:
+            return False
+        for (name, entry) in files.items():
+            stat = os.stat(directory + "\\" + name)
+            if (stat.st_size, stat.st_mtime) != entry:
+                return False
+    except os.error:
+        return False
+    return True
+
+# Bytes used by each capture, with all its files (main.cap, results,
+# <index>.cap, ...), and the captures in deletion order, so the space
+# monitor never has to look at every directory.
+#
+# A capture is scanned again when its files change: at the end of an
+# upload, after each of its tasks, and it is dropped when deleted.
+# The index is kept in save_dir\usage.idx, on start only directories
+# with another mtime than the saved one, or a file of another size or
+# mtime, are scanned.
+#
+# Derived files are kept in a second heap, by mtime, the time they
+# were last written or used by an analysis. They are the first to go.
+#
+# Space can be reserved for files about to be written (uploads,
+# splits), it counts as used until released. The listener is told
+# when the usage grows, wait is True if the caller needs the room
+# before going on.
+#
+# A resumable upload is held instead: its whole size is reserved
+# until it is settled, its files are not counted meanwhile.
+class UsageIndex:
+    def __init__(self, save_dir):
+        self.save_dir = save_dir
+        self.index_file = save_dir + "usage.idx"
+        self.lock = threading.Lock()
+        # one save at a time
+        self.save_lock = threading.Lock()
+        # uuid -> (bytes, mtime)
+        self.records = dict()
+        self.total = 0L
+        # (mtime, bytes, uuid), oldest first. Entries replaced since
+        # are left in place and skipped when they come up.
+        self.heap = list()
+        # uuid -> name -> (bytes, mtime) of derived files
+        self.derived = dict()
+        # (mtime, bytes, uuid, name), oldest first, same as heap
+        self.derived_heap = list()
+        # uuid -> name -> (bytes, mtime) of the other files, to tell
+        # the changes made while stopped
+        self.others = dict()
+        # uuid -> reserved bytes
+        self.reserved = dict()
+        self.reserved_total = 0L
+        # listener(wait)
+        self.listener = None
+        self.dirty = False
+        self.saved = time.time()
+
+    def put(self, uuid, record, derived, others):
+        # must be called under lock, record None drops the capture
+        old = self.records.pop(uuid, None)
+        if old is not None:
+            self.total -= old[0]
+        old_derived = self.derived.pop(uuid, dict())
+        self.others.pop(uuid, None)
+        if record is not None:
+            self.records[uuid] = record
+            self.total += record[0]
+            heapq.heappush(self.heap, (record[1], record[0], uuid))
+            self.derived[uuid] = derived
+            self.others[uuid] = others
+            for (name, entry) in derived.items():
+                if old_derived.get(name) != entry:
+                    heapq.heappush(self.derived_heap, 
+                        (entry[1], entry[0], uuid, name))
+        self.dirty = True
+
+        # too many replaced entries, rebuild
+        if len(self.heap) > 2 * len(self.records) + 64:
+            self.heap = [(mtime, size, uuid)
+                for (uuid, (size, mtime)) in self.records.items()]
+            heapq.heapify(self.heap)
+        count = sum([len(d) for d in self.derived.values()])
+        if len(self.derived_heap) > 2 * count + 64:
+            self.derived_heap = [(mtime, size, uuid, name)
+                for (uuid, d) in self.derived.items()
+                for (name, (size, mtime)) in d.items()]
+            heapq.heapify(self.derived_heap)
+
+    def update(self, uuid):
+        # call when files of the capture are added, changed or removed
+        try:
+            (record, derived, others) = scan_capture(self.save_dir + uuid)
+        except os.error:
+            (record, derived, others) = (None, None, None)
+        with self.lock:
+            self.put(uuid, record, derived, others)
+        self.notify(False)
+        self.save_if_due()
+
+    def remove(self, uuid):
+        with self.lock:
+            self.put(uuid, None, None, None)
+        self.save_if_due()
+
+    def remove_derived(self, uuid, name):
+        # call when a derived file is deleted, the directory must keep
+        # its mtime
+        with self.lock:
+            record = self.records.get(uuid)
+            derived = dict(self.derived.get(uuid, dict()))
+            entry = derived.pop(name, None)
+            if record is None or entry is None:
+                return
+            self.put(uuid, (record[0] - entry[0], record[1]), derived,
+                self.others.get(uuid, dict()))
+        self.save_if_due()
+
+    def reserve(self, uuid, nbytes, limit=None):
+        # room for nbytes more in uuid, the capture is not deleted
+        # until released. Returns False, nothing reserved, if all the
+        # reservations would be over limit bytes.
+        with self.lock:
+            if limit is not None and self.reserved_total + nbytes > limit:
+                return False
+            self.reserved[uuid] = self.reserved.get(uuid, 0L) + nbytes
+            self.reserved_total += nbytes
+        self.notify(True)
+        return True
+
+    def hold(self, uuid, nbytes):
+        # reserve nbytes for a resumable upload, if not held already
+        # (after a restart): the files of uuid count as reserved, not
+        # as used, until settle
+        with self.lock:
+            if uuid in self.reserved:
+                return
+            self.put(uuid, None, None, None)
+            self.reserved[uuid] = nbytes
+            self.reserved_total += nbytes
+        self.notify(True)
+
+    def settle(self, uuid):
+        # end of a held upload (finalized, aborted, or left by its 
+        # client), its files are counted as used again
+        try:
+            (record, derived, others) = scan_capture(self.save_dir + uuid)
+        except os.error:
+            (record, derived, others) = (None, None, None)
+        with self.lock:
+            nbytes = self.reserved.pop(uuid, None)
+            if nbytes is not None:
+                self.reserved_total -= nbytes
+            self.put(uuid, record, derived, others)
+        self.notify(False)
+        self.save_if_due()
+
+    def release(self, uuid, nbytes):
+        # call when the files are written and updated, or given up
+        with self.lock:
+            left = self.reserved.get(uuid, 0L) - nbytes
+            if left > 0:
+                self.reserved[uuid] = left
+            else:
+                self.reserved.pop(uuid, None)
+            self.reserved_total -= nbytes
+
+    def is_reserved(self, uuid):
+        return uuid in self.reserved
+
+    def get_reserved(self):
+        # [(uuid, bytes)] of the reservations
+        with self.lock:
+            return self.reserved.items()
+
+    def set_listener(self, method):
+        self.listener = method
+
+    def notify(self, wait):
+        if self.listener is not None:
+            self.listener(wait)
+
+    def get_total(self):
+        return self.total
+
+    def get_used(self):
+        # with the space reserved
+        return self.total + self.reserved_total
+
+    def get_size(self, uuid):
+        record = self.records.get(uuid)
+        if record is None:
+            return 0L
+        return record[0]
+
+    def top(self):
+        # must be called under lock
+        while len(self.heap) > 0:
+            (mtime, size, uuid) = self.heap[0]
+            if self.records.get(uuid) == (size, mtime):
+                return (uuid, size, mtime)
+            heapq.heappop(self.heap)
+        return None
+
+    def oldest(self):
+        # (uuid, bytes, mtime) of the capture to delete first, by
+        #   mtime: older first
+        #   size: smaller first
+        # or None if there is none
+        with self.lock:
+            return self.top()
+
+    def take_oldest(self):
+        # same as oldest, and the capture is skipped by the next calls
+        # until given to put_back
+        with self.lock:
+            item = self.top()
+            if item is not None:
+                heapq.heappop(self.heap)
+            return item
+
+    def put_back(self, items):
+        with self.lock:
+            for (uuid, size, mtime) in items:
+                if self.records.get(uuid) == (size, mtime):
+                    heapq.heappush(self.heap, (mtime, size, uuid))
+
+    def take_oldest_derived(self):
+        # (uuid, name, bytes, mtime) of the derived file to delete
+        # first or None, skipped by the next calls until given to
+        # put_back_derived
+        with self.lock:
+            while len(self.derived_heap) > 0:
+                (mtime, size, uuid, name) = heapq.heappop(self.derived_heap)
+                if self.derived.get(uuid, dict()).get(name) == (size, mtime):
+                    return (uuid, name, size, mtime)
+        return None
+
+    def put_back_derived(self, items):
+        with self.lock:
+            for (uuid, name, size, mtime) in items:
+                if self.derived.get(uuid, dict()).get(name) == (size, mtime):
+                    heapq.heappush(self.derived_heap, (mtime, size, uuid, name))
+
+    def load(self):
+        # read the saved index, then scan the directories that are new
+        # or changed since, and drop the ones that are gone
+        saved = dict()
+        try:
+            f = open(self.index_file, "rb")
+        except IOError:
+            pass
+        else:
+            try:
+                saved = cPickle.load(f)
+            except Exception:
+                # broken, scan everything
+                saved = dict()
+            finally:
+                f.close()
+        if saved.get('version') != USAGE_INDEX_VERSION:
+            saved = dict(records=dict(), derived=dict(), others=dict())
+
+        for directory in capture_dirs(self.save_dir):
+            uuid = directory[len(self.save_dir):]
+            if uuid in self.records or uuid in self.reserved:
+                # updated since start, or held
+                continue
+            record = saved['records'].get(uuid)
+            derived = saved['derived'].get(uuid, dict())
+            others = saved['others'].get(uuid, dict())
+            files = dict(derived)
+            files.update(others)
+            try:
+                if record is None or not is_unchanged(directory, record, files):
+                    (record, derived, others) = scan_capture(directory)
+            except os.error:
+                continue
+            with self.lock:
+                if uuid not in self.records and uuid not in self.reserved:
+                    self.put(uuid, record, derived, others)
+
+        self.save()
+
+    def save_if_due(self):
+        if self.dirty and time.time() - self.saved > USAGE_SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                saved = dict(
+                    version=USAGE_INDEX_VERSION,
+                    records=dict(self.records),
+                    derived=dict(self.derived),
+                    others=dict(self.others))
+                self.dirty = False
+                self.saved = time.time()
+
+            # write then rename, a crash never leaves a partial index
+            f = open(self.index_file + ".tmp", "wb")
+            try:
+                cPickle.dump(saved, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            if os.path.exists(self.index_file):
+                os.remove(self.index_file)
+            os.rename(self.index_file + ".tmp", self.index_file)
+
+usage_index = UsageIndex(conf.get('save_dir'))
+
+Gauge('npa_storage_used_bytes', 'Bytes used by all captures',
+    collect=lambda: [((), get_usage_index().get_total())])
+Gauge('npa_storage_reserved_bytes', 'Bytes reserved for files being written',
+    collect=lambda: [((), get_usage_index().reserved_total)])
+Gauge('npa_storage_captures', 'Captures kept',
+    collect=lambda: [((), len(get_usage_index().records))])
@@ -2,19 +2,46 @@ from flask import Flask, request, redirect, url_for, render_template, abort, jso
 import os
 import json
 import glob
-import cPickle
+import socket
+import hashlib
+import re
+import shutil
+import threading
 
+from datetime import datetime
 from uuid import uuid4
+from werkzeug.formparser import parse_form_data, default_stream_factory
+from werkzeug.http import is_resource_modified
 
 from config import GlobalConfig
 
 from command import *
 from analysis import *
 from task import *
+from cache import *
+from connstore import *
+from uploads import *
+from metrics import get_metrics
+from usage import get_usage_index
 
 conf = GlobalConfig()
 app = Flask(__name__)
 
+def get_template_version():
+    # changes with any template, pages made from the same results
+    # look different after an update
+    digest = hashlib.sha1()
+    folder = os.path.join(app.root_path, app.template_folder)
+    for name in sorted(os.listdir(folder)):
+        f = open(os.path.join(folder, name), "rb")
+        try:
+            digest.update(name + "\0" + f.read())
+        finally:
+            f.close()
+    return digest.hexdigest()[:12]
+
+template_version = get_template_version()
+
 @app.route("/favicon.ico")
 def favicon():
     return redirect(url_for("static", filename='img/favicon.ico'))
@@ -29,13 +56,21 @@ def index():
 @app.route("/upload", methods=["POST"])
 def upload():
     """Handle the upload of a file."""
-    form = request.form
-
-    # Is the upload using Ajax, or a direct POST by the form?
-    is_ajax = False
-    if form.get("__ajax", None) == "true":
-        is_ajax = True
-
+    
+    # The capture is written to its place while the body is read,
+    # so the directory is made before the form is parsed
+    error = None
+    
+    # room for the capture before it is written, the body is 
+    # about its size
+    upload_key = str(uuid4())
+    reserved = request.content_length or 0L
+    max_space = conf.get('max_space_in_mb') * 1024 * 1024
+    if reserved > max_space:
+        abort(413)
+    if not get_usage_index().reserve(upload_key, reserved, max_space):
+        return "Not enough space for the capture", 507
+    
     # Target folder for these uploads.
     target = conf.get('save_dir')
     
@@ -43,40 +78,254 @@ def upload():
         try:
             os.mkdir(target)
         except:
-            if is_ajax:
-                return ajax_response(False, "Couldn't create upload directory")
-            else:
-                return "Couldn't create upload directory"
-    
-    upload_key = str(uuid4())
+            error = "Couldn't create upload directory"
     
     target += upload_key
+    if error is None:
+        try:
+            os.mkdir(target)
+        except:
+            error = "Couldn't create upload directory: /Capture/{}".format(upload_key)
+            
+    writers = list()
+    
+    def stream_factory(total_content_length, content_type, filename=None, 
+        content_length=None):
+        if error is not None or len(writers) > 0:
+            # only the first file is the capture
+            return default_stream_factory(total_content_length, 
+                content_type, filename, content_length)
+            
+        writer = CaptureWriter(
+            target + "\\main.cap", 
+            target + "\\main.part", 
+            target + "\\main.sha1")
+        writers.append(writer)
+        
+        # extraction follows the file while it is written
+        task = TaskExtractCapture(upload_key)
+        task.client = request.remote_addr
+        get_task_manager().post_task(task)
+        
+        return writer
+    
     try:
-        os.mkdir(target)
+        (stream, form, files) = parse_form_data(request.environ, 
+            stream_factory=stream_factory)
     except:
+        for writer in writers:
+            writer.abort()
+        get_usage_index().release(upload_key, reserved)
+        raise
+        
+    for writer in writers:
+        writer.finish()
+        
+    uploaded_key = upload_key
+    if len(writers) > 0:
+        # same capture uploaded before, use that one.
+        # before the end of upload, extraction must see the link
+        upload_key = deduplicate_capture(conf.get('save_dir'), upload_key,
+            writers[0].sha1.hexdigest())
+        
+    for writer in writers:
+        writer.end()
+        
+    if len(writers) > 0:
+        # account the capture, or what is left of a duplicate
+        get_usage_index().update(uploaded_key)
+        if upload_key != uploaded_key:
+            get_usage_index().update(upload_key)
+    get_usage_index().release(uploaded_key, reserved)
+
+    # Is the upload using Ajax, or a direct POST by the form?
+    is_ajax = False
+    if form.get("__ajax", None) == "true":
+        is_ajax = True
+
+    if error is not None:
         if is_ajax:
-            return ajax_response(False, "Couldn't create upload directory: /Capture/{}".format(upload_key))
+            return ajax_response(False, error)
         else:
-            return "Couldn't create upload directory: /Capture/{}".format(upload_key)
-
-    for upload in request.files.getlist("file"):
-        filename = upload.filename.rsplit("/")[0]
-        destination = target + "\\main.cap"
-        upload.save(destination)
+            return error
+        
     if is_ajax:
         return ajax_response(True, upload_key)
     else:
         return redirect(url_for("capture_status", uuid=upload_key))
 
+# Resumable upload, in chunks
+#   POST /api/upload (size): open an upload, returns uuid and chunk size
+#   PUT /api/upload/<uuid>/<n>: chunk n, header X-Chunk-SHA1 (hex)
+#   GET /api/upload/<uuid>: committed chunks, to resume
+#   POST /api/upload/<uuid>/finalize: make main.cap and extract it
+#   DELETE /api/upload/<uuid>: give it up
+# The room for the whole capture is held from the start until it is
+# finalized or given up.
+@app.route("/api/upload", methods=["POST"])
+def create_upload():
+    try:
+        size = long(request.values.get('size', 0))
+    except ValueError:
+        abort(400)
+    if size <= 0:
+        abort(400)
+    max_space = conf.get('max_space_in_mb') * 1024 * 1024
+    if size > min(conf.get('upload_max_size_in_mb') * 1024 * 1024, max_space):
+        abort(413)
+        
+    target = conf.get('save_dir')
+    if not os.path.exists(target):
+        os.mkdir(target)
+        
+    # full size from the start
+    upload_key = str(uuid4())
+    if not get_usage_index().reserve(upload_key, size, max_space):
+        return jsonify(status="error", msg="Not enough space"), 507
+        
+    target += upload_key
+    try:
+        os.mkdir(target)
+        session = UploadSession(target)
+        session.create(size, long(conf.get('upload_chunk_in_mb') * 1024 * 1024))
+    except:
+        shutil.rmtree(target, True)
+        get_usage_index().release(upload_key, size)
+        raise
+    
+    return jsonify(
+        uuid=upload_key,
+        size=session.size,
+        chunk_size=session.chunk_size,
+        chunks=session.chunks)
+        
+def load_upload_session(uuid):
+    session = UploadSession(conf.get('save_dir') + uuid)
+    if not session.load():
+        abort(404)
+    # held again after a restart
+    get_usage_index().hold(uuid, session.size)
+    return session
+    
+@app.route("/api/upload/<uuid>", methods=["GET"])
+def upload_status(uuid):
+    session = load_upload_session(uuid)
+    
+    return jsonify(
+        uuid=uuid,
+        size=session.size,
+        chunk_size=session.chunk_size,
+        chunks=session.chunks,
+        committed=session.committed())
+        
+@app.route("/api/upload/<uuid>/<int:index>", methods=["PUT"])
+def upload_chunk(uuid, index):
+    session = load_upload_session(uuid)
+    
+    if index >= session.chunks:
+        abort(404)
+    
+    sha1 = request.headers.get('X-Chunk-SHA1')
+    (offset, length) = session.chunk_range(index)
+    if not sha1 or request.content_length != length:
+        abort(400)
+        
+    if not session.write_chunk(index, request.stream, sha1):
+        return jsonify(status="error", msg="Chunk data does not match"), 400
+        
+    return jsonify(status="ok", index=index)
+    
+# uuid -> [lock, requests using it], one finalize or abort of an 
+# upload at a time
+upload_locks = dict()
+upload_locks_lock = threading.Lock()
+
+def call_locked(uuid, method):
+    with upload_locks_lock:
+        entry = upload_locks.setdefault(uuid, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            return method(uuid)
+    finally:
+        with upload_locks_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del upload_locks[uuid]
+
+@app.route("/api/upload/<uuid>", methods=["DELETE"])
+def abort_upload(uuid):
+    return call_locked(uuid, abort_upload_locked)
+    
+def abort_upload_locked(uuid):
+    load_upload_session(uuid)
+    shutil.rmtree(conf.get('save_dir') + uuid, True)
+    get_usage_index().settle(uuid)
+    return jsonify(status="ok", uuid=uuid)
+    
+@app.route("/api/upload/<uuid>/finalize", methods=["POST"])
+def finalize_upload(uuid):
+    return call_locked(uuid, finalize_upload_locked)
+    
+def finalize_upload_locked(uuid):
+    save_dir = conf.get('save_dir')
+    main_cap = save_dir + uuid + "\\main.cap"
+    main_sha1 = save_dir + uuid + "\\main.sha1"
+    
+    session = UploadSession(save_dir + uuid)
+    if not session.load():
+        found = resolve_capture(save_dir, uuid)
+        if os.path.exists(save_dir + found + "\\main.cap"):
+            # finalized before
+            return jsonify(status="ok", uuid=found)
+        abort(404)
+        
+    if not session.finalize(main_cap, main_sha1):
+        return jsonify(status="error", msg="Chunks are missing",
+            committed=session.committed()), 409
+            
+    found = deduplicate_capture(save_dir, uuid, session.sha1)
+    get_usage_index().settle(uuid)
+    if found != uuid:
+        get_usage_index().update(found)
+        # same capture uploaded before, use that one
+        return jsonify(status="ok", uuid=found)
+    
+    task = TaskExtractCapture(uuid)
+    task.client = request.remote_addr
+    get_task_manager().post_task(task)
+        
+    return jsonify(status="ok", uuid=uuid)
+
 '''
 Dir layout
     main.cap
         primary data file
+    main.part
+        exists while main.cap is uploaded
+    main.sha1
+        sha1 of main.cap, written when the upload is done
+    main.upload, main.session, main.chunks
+        resumable upload in progress, see UploadSession
+    main.link
+        uuid of the same capture uploaded before, the only file
+        of a duplicate upload
     main.bin
         parsed connection list, last should be OK
+    main.conns
+        typed copy of the connection list, see ConnectionStore
+    main.triage
+        TCP analysis counters of all connections, see WriteTriage
+    main.tidx
+        timestamp -> offset index of main.cap, see WriteTimeIndex
     <index>.cap
         filtered file
     <index>.bin
+    <index>.<key>.html.gz
+        rendered page of <index>.bin, gzipped
+    <index>.w<start>-<end>.cap, .bin, .done, .<key>.html.gz
+        same for the packets of a time window, in ms from the 
+        first packet
     
     conns: 
         'global_filename': global cap
@@ -84,44 +333,198 @@ Dir layout
         'conn' : current connection
         
 '''
+def parse_window():
+    # optional time window (start, end) from the arguments of the 
+    # request, in seconds from the first packet, to the ms
+    args = request.args
+    if 'start' not in args and 'end' not in args:
+        return None
+    try:
+        start = round(float(args.get('start', 0)), 3)
+        end = round(float(args['end']), 3)
+    except (KeyError, ValueError):
+        abort(400)
+    if not 0 <= start < end < float('inf'):
+        abort(400)
+    return (start, end)
+    
+def window_args(window):
+    # url arguments of the window, for url_for
+    if window is None:
+        return dict()
+    return dict(start="%.3f" % window[0], end="%.3f" % window[1])
+
+def parse_conn_query(default_limit):
+    # arguments of store.query() from the request:
+    #   offset, limit, sort (bytes, frames, start, duration, and 
+    #   retrans_rate, zerowin once triaged), order (asc, desc), ip, 
+    #   port, proto (tcp, udp), start and end of a time window
+    # Empty ones (as sent by the filter form) are left out.
+    args = dict([(k, v) for (k, v) in request.args.items() if v != ''])
+    query = dict()
+    
+    try:
+        query['offset'] = max(int(args.get('offset', 0)), 0)
+        limit = int(args.get('limit', default_limit))
+        query['limit'] = min(max(limit, 0), conf.get('conn_page_limit'))
+        if 'port' in args:
+            query['port'] = int(args['port'])
+    except ValueError:
+        abort(400)
+    
+    query['sort'] = args.get('sort', 'bytes')
+    if query['sort'] not in SORT_KEYS and query['sort'] not in TRIAGE_SORT_KEYS:
+        abort(400)
+        
+    order = args.get('order', 'desc')
+    if order not in ('asc', 'desc'):
+        abort(400)
+    query['descending'] = (order == 'desc')
+    
+    if 'ip' in args:
+        try:
+            socket.inet_aton(args['ip'])
+        except socket.error:
+            abort(400)
+        query['ip'] = args['ip']
+        
+    if 'proto' in args:
+        query['proto'] = args['proto'].upper()
+        if query['proto'] not in ('TCP', 'UDP'):
+            abort(400)
+    
+    window = parse_window()
+    if window is not None:
+        query['window'] = window
+    
+    return query
+    
+def load_triage(save_dir, uuid):
+    # main.triage, or None until TaskTriageCapture is done. It is 
+    # posted here for captures extracted before.
+    main_triage_file = save_dir + uuid + "\\main.triage"
+    try:
+        return get_pickle_cache().load(main_triage_file)
+    except (os.error, IOError):
+        pass
+    if conf.get('triage'):
+        # not posted again if queued or running
+        task = TaskTriageCapture(uuid)
+        task.client = request.remote_addr
+        get_task_manager().post_task(task)
+    return None
+    
+def open_conn_store(save_dir, uuid, query):
+    # connection store of the capture with the triage attached if
+    # there is one, sorting by a triage key is not found before
+    main_bin_file = save_dir + uuid + "\\main.bin"
+    main_conns_file = save_dir + uuid + "\\main.conns"
+    
+    store = OpenConnectionStore(main_conns_file, main_bin_file)
+    triage = load_triage(save_dir, uuid)
+    if triage is not None:
+        store.set_triage(triage)
+    elif query['sort'] in TRIAGE_SORT_KEYS:
+        store.close()
+        abort(404)
+    return store
+    
+def conn_table_links(uuid, query, total, triage):
+    # urls of the previous/next page and of each sort key,
+    # keeping the filters that are set
+    args = dict([(k, v) for (k, v) in request.args.items() if v != ''])
+    args['sort'] = query['sort']
+    args['order'] = 'desc' if query['descending'] else 'asc'
+    offset = query['offset']
+    limit = query['limit']
+    
+    links = dict()
+    if offset > 0:
+        args['offset'] = max(offset - limit, 0)
+        links['prev'] = url_for('select_connection', uuid=uuid, **args)
+    if limit > 0 and offset + limit < total:
+        args['offset'] = offset + limit
+        links['next'] = url_for('select_connection', uuid=uuid, **args)
+        
+    args['offset'] = 0
+    keys = SORT_KEYS.keys()
+    if triage:
+        keys.extend(TRIAGE_SORT_KEYS.keys())
+    for key in keys:
+        args['sort'] = key
+        if key == query['sort']:
+            # click again to reverse
+            args['order'] = 'asc' if query['descending'] else 'desc'
+        else:
+            args['order'] = 'desc'
+        links[key] = url_for('select_connection', uuid=uuid, **args)
+        
+    return links
+    
 @app.route("/capture/<uuid>")
 def select_connection(uuid):
 
     # Check whether dir exists. If not, create it
     save_dir = conf.get('save_dir')
+    
+    # duplicate upload, show the first one
+    found = resolve_capture(save_dir, uuid)
+    if found != uuid:
+        return redirect(url_for('select_connection', uuid=found))
+        
     main_cap = save_dir + uuid + "\\main.cap"
 
     if not os.path.exists(main_cap):
         abort(404)
     main_bin_file = save_dir + uuid + "\\main.bin"
-    
-    conns = None
+    main_triage_file = save_dir + uuid + "\\main.triage"
     
     key = TaskExtractCapture.make_key(uuid)
 
     task_result = get_task_manager().query_task(key)
 
     if task_result and task_result['status'] == OK:
-        #has the result, so render the page with connection list
-
-        f = open(main_bin_file, "rb")
+        #has the result, so render the page with one page of connections
+        query = parse_conn_query(conf.get('conn_page_size'))
+        
+        # the page gets the triage columns once counted, browsers
+        # must ask again until then
+        files = [main_bin_file]
+        max_age = None
+        if os.path.exists(main_triage_file):
+            files.append(main_triage_file)
+        elif conf.get('triage'):
+            max_age = 0
+        validators = result_validators(files, 
+            template_version + request.query_string)
+        if is_not_modified(validators):
+            return not_modified(validators, max_age)
+        
+        store = open_conn_store(save_dir, uuid, query)
         try:
-            conns = cPickle.load(f)
-        except:
-            f.close()
+            (total, conns) = store.query(**query)
+            triage = store.triage is not None
+        finally:
+            store.close()
 
         title = 'Select Connection'
         
-        return render_template("conn_table.html",
+        return cached_result(render_template("conn_table.html",
             isIndex=False,
             wait=False,
             uuid=uuid,
-            conns=conns['conn_list'],
-            title=title)
+            conns=conns,
+            total=total,
+            query=query,
+            triage=triage,
+            window_args=window_args(query.get('window')),
+            links=conn_table_links(uuid, query, total, triage),
+            title=title), validators, max_age)
         
     else:
         # Post a new task to execute asynchronously
         task = TaskExtractCapture(uuid)
+        task.client = request.remote_addr
         
         get_task_manager().post_task(task)
         
@@ -134,6 +537,57 @@ def select_connection(uuid):
             uuid=uuid,
             title=title)
             
+# Finished results (main.bin, <index>.bin) never change, the pages and
+# data made from them are validated by the files, and the browser 
+# keeps them for result_max_age_in_second.
+
+# rest of the name of a rendered page after <index>. (or the name of
+# a window), <key>.html.gz
+PAGE_KEY_PAT = re.compile(r'^\w+\.html\.gz$')
+
+def result_validators(filenames, extra=""):
+    # returns (etag, last modified) of the result files, the etag
+    # covers extra too (template version, query)
+    digest = hashlib.sha1(extra)
+    mtime = 0
+    for filename in filenames:
+        stat = os.stat(filename)
+        digest.update("%r %d\0" % (stat.st_mtime, stat.st_size))
+        mtime = max(mtime, stat.st_mtime)
+    return (digest.hexdigest()[:24], datetime.utcfromtimestamp(int(mtime)))
+    
+def is_not_modified(validators):
+    (etag, last_modified) = validators
+    return not is_resource_modified(request.environ, etag=etag, 
+        last_modified=last_modified)
+        
+def cached_result(response, validators, max_age=None):
+    # response, or 304 if the browser has it already. max_age in
+    # seconds, result_max_age_in_second by default
+    if isinstance(response, basestring):
+        response = Response(response)
+    if max_age is None:
+        max_age = conf.get('result_max_age_in_second')
+    (etag, last_modified) = validators
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+    
+def gzipped_response(page):
+    # gzipped html as it is, if the client takes it
+    if 'gzip' in request.accept_encodings:
+        response = Response(page, mimetype='text/html')
+        response.content_encoding = 'gzip'
+    else:
+        response = Response(gunzip_page(page), mimetype='text/html')
+    response.vary.add('Accept-Encoding')
+    return response
+    
+def not_modified(validators, max_age=None):
+    return cached_result(Response(status=304), validators, max_age)
+    
 def ajax_response(status, msg):
     status_code = "ok" if status else "error"
     return json.dumps(dict(
@@ -143,60 +597,86 @@ def ajax_response(status, msg):
     
 @app.route("/connection/<uuid>/<int:index>")
 def analyze_connection(uuid, index):
+    # the whole connection, or its packets in the time window given
+    # by start and end
 
     save_dir = conf.get('save_dir')
+    window = parse_window()
+    
+    # duplicate upload, show the first one
+    found = resolve_capture(save_dir, uuid)
+    if found != uuid:
+        return redirect(url_for('analyze_connection', uuid=found, index=index, 
+            **window_args(window)))
     
     # General file names
+    name = conn_result_name(index, window)
     main_cap = save_dir + uuid + "\\main.cap"
     main_bin_file = save_dir + uuid + "\\main.bin"
-    conns_single_cap = save_dir + uuid + "\\" + str(index) + ".cap"
-    conns_single_bin = save_dir + uuid + "\\" + str(index) + ".bin"
-    conns_single_done = save_dir + uuid + "\\" + str(index) + ".done"
+    main_conns_file = save_dir + uuid + "\\main.conns"
+    conns_single_bin = save_dir + uuid + "\\" + name + ".bin"
     
     # Not found
     if not os.path.exists(main_cap):
         abort(404)
     
      # load connections
-    conns = None
+    conn = None
     if not os.path.exists(main_bin_file):
         # at this point, we should have already generate this file
         # otherwise it is error
         abort(404)
     else:
-        f = open(main_bin_file, "rb")
+        store = OpenConnectionStore(main_conns_file, main_bin_file)
         try:
-            conns = cPickle.load(f)
-        except:
-            f.close()
+            # check index out of bound
+            if index < len(store):
+                conn = store[index]
+        finally:
+            store.close()
     
-    # check index out of bound
-    if index >= len(conns['conn_list']):
+    if conn is None:
         abort(404)
-    
-    conn = conns['conn_list'][index]
         
-    key = TaskAnalyzeConnection.make_key(uuid, index)
+    key = TaskAnalyzeConnection.make_key(uuid, index, window)
 
     task_result = get_task_manager().query_task(key)
 
     if task_result and task_result['status'] == OK:
         #has the result, so render the page with connection list
-        result = dict()
-        f = open(conns_single_bin, "rb")
-        try:
-            result = cPickle.load(f)
-        except:
-            f.close()
+        validators = result_validators([conns_single_bin], template_version)
+        if is_not_modified(validators):
+            return not_modified(validators)
             
-        return render_template(
-            'show_connection.html', 
-            wait = False, 
-            **result)
+        # rendered before with the same result and templates
+        page_file = "%s%s\\%s.%s.html.gz" % (save_dir, uuid, name, validators[0])
+        page = load_rendered_page(page_file)
+        if page is None:
+            result = get_pickle_cache().load(conns_single_bin)
+            
+            page = save_rendered_page(page_file, render_template(
+                'show_connection.html', 
+                wait = False, 
+                window_args = window_args(window),
+                **result))
+                
+            # pages of older results or templates, not the ones of
+            # other windows
+            prefix = "%s%s\\%s." % (save_dir, uuid, name)
+            for other in glob.glob(prefix + "*.html.gz"):
+                if other != page_file and PAGE_KEY_PAT.match(other[len(prefix):]):
+                    try:
+                        os.remove(other)
+                    except os.error:
+                        pass
+            get_usage_index().update(uuid)
+            
+        return cached_result(gzipped_response(page), validators)
         
     else:
         # Post a new task to execute asynchronously
-        task = TaskAnalyzeConnection(uuid, index)
+        task = TaskAnalyzeConnection(uuid, index, window)
+        task.client = request.remote_addr
         get_task_manager().post_task(task)
         
         # Render page as waiting
@@ -207,51 +687,52 @@ def analyze_connection(uuid, index):
             wait=True,
             title=title,
             uuid=uuid,
-            index=index)
+            index=index,
+            window_args=window_args(window))
         
 @app.route("/data/<uuid>/<int:index>")
 def generate_data(uuid, index):
 
     save_dir = conf.get('save_dir')
+    uuid = resolve_capture(save_dir, uuid)
+    name = conn_result_name(index, parse_window())
     
     # General file names
     main_cap = save_dir + uuid + "\\main.cap"
     main_bin_file = save_dir + uuid + "\\main.bin"
-    conns_single_cap = save_dir + uuid + "\\" + str(index) + ".cap"
-    conns_single_bin = save_dir + uuid + "\\" + str(index) + ".bin"
+    main_conns_file = save_dir + uuid + "\\main.conns"
+    conns_single_bin = save_dir + uuid + "\\" + name + ".bin"
     
     # Not found
     if not os.path.exists(main_cap):
         abort(404)
     
     # load connections
-    conns = None
+    conn = None
     if not os.path.exists(main_bin_file):
         # at this point, we should have already generate this file
         # otherwise it is error
         abort(404)
     else:
-        f = open(main_bin_file, "rb")
+        store = OpenConnectionStore(main_conns_file, main_bin_file)
         try:
-            conns = cPickle.load(f)
-        except:
-            f.close()
-            
-    # check index out of bound
-    if index >= len(conns['conn_list']):
-        abort(404)
+            # check index out of bound
+            if index < len(store):
+                conn = store[index]
+        finally:
+            store.close()
     
-    conn = conns['conn_list'][index]
+    if conn is None:
+        abort(404)
     
     result = dict()
    
-    
+    validators = None
     if os.path.exists(conns_single_bin):
-        f = open(conns_single_bin, "rb")
-        try:
-            result = cPickle.load(f)
-        except:
-            f.close()
+        validators = result_validators([conns_single_bin])
+        if is_not_modified(validators):
+            return not_modified(validators)
+        result = get_pickle_cache().load(conns_single_bin)
             
     # generate
     # { ticks: <label>,
@@ -271,13 +752,14 @@ def generate_data(uuid, index):
     data['ticks'] = ticklist 
     data['data'] = datalist
     
-    return jsonify(data)
+    return cached_result(jsonify(data), validators)
     
     
 @app.route("/api/capture/<uuid>")
 def capture_status(uuid):   
     
     save_dir = conf.get('save_dir')
+    uuid = resolve_capture(save_dir, uuid)
     main_cap = save_dir + uuid + "\\main.cap"
     
     if not os.path.exists(main_cap):
@@ -285,19 +767,131 @@ def capture_status(uuid):
     
     key = TaskExtractCapture.make_key(uuid)
     
+    return task_status_response(key)
+    
+@app.route("/api/capture/<uuid>/events")
+def capture_events(uuid):
+    
+    save_dir = conf.get('save_dir')
+    uuid = resolve_capture(save_dir, uuid)
+    main_cap = save_dir + uuid + "\\main.cap"
+    
+    if not os.path.exists(main_cap):
+        abort(404)
+        
+    key = TaskExtractCapture.make_key(uuid)
+    
+    return task_status_events(key)
+    
+@app.route("/api/capture/<uuid>/conns")
+def capture_connections(uuid):
+    # one page of the connection list, sorted and filtered,
+    # see parse_conn_query() for the arguments
+    
+    save_dir = conf.get('save_dir')
+    uuid = resolve_capture(save_dir, uuid)
+    main_cap = save_dir + uuid + "\\main.cap"
+    
+    if not os.path.exists(main_cap):
+        abort(404)
+        
+    key = TaskExtractCapture.make_key(uuid)
+    
     task_result = get_task_manager().query_task(key)
     
-    return jsonify(task_result)
+    if not task_result or task_result['status'] != OK:
+        # not extracted yet
+        abort(404)
+    
+    query = parse_conn_query(conf.get('conn_page_size'))
+    
+    store = open_conn_store(save_dir, uuid, query)
+    try:
+        (total, conns) = store.query(**query)
+    finally:
+        store.close()
+        
+    conn_list = list()
+    for (index, conn) in conns:
+        item = dict(conn)
+        item['index'] = index
+        conn_list.append(item)
+        
+    return jsonify(
+        total=total,
+        offset=query['offset'],
+        limit=query['limit'],
+        conns=conn_list)
     
 @app.route("/api/connection/<uuid>/<int:index>")    
 def caconnection_status(uuid, index):   
     
-    key = TaskAnalyzeConnection.make_key(uuid, index)
+    uuid = resolve_capture(conf.get('save_dir'), uuid)
     
-    task_result = get_task_manager().query_task(key)
+    key = TaskAnalyzeConnection.make_key(uuid, index, parse_window())
     
+    return task_status_response(key)
+    
+@app.route("/api/connection/<uuid>/<int:index>/events")
+def connection_events(uuid, index):
+    
+    uuid = resolve_capture(conf.get('save_dir'), uuid)
+    
+    key = TaskAnalyzeConnection.make_key(uuid, index, parse_window())
+    
+    return task_status_events(key)
+    
+# Task status, instead of polling at a fixed interval clients can
+#   long-poll: give the version of the last answer, the request 
+#       waits until the status changed or status_wait_in_second
+#   events: one Server-Sent Event (status) per change, until the 
+#       task is not running any more
+def task_status_response(key):
+    task_manager = get_task_manager()
+    version = request.args.get('version', type=long)
+    
+    if version is None:
+        version = task_manager.get_status_version(key)
+        task_result = task_manager.query_task(key)
+    else:
+        (task_result, version) = task_manager.wait_status(key, version, 
+            conf.get('status_wait_in_second'))
+        
+    task_result['version'] = version
     return jsonify(task_result)
     
+def task_status_events(key):
+    task_manager = get_task_manager()
+    # sent back by the browser when it connects again
+    version = request.headers.get('Last-Event-ID', type=long)
+    timeout = conf.get('status_wait_in_second')
+    
+    def events():
+        last = version
+        while True:
+            if last is None:
+                current = task_manager.get_status_version(key)
+                task_result = task_manager.query_task(key)
+            else:
+                (task_result, current) = task_manager.wait_status(key, last, timeout)
+                if current == last:
+                    # keep the connection alive
+                    yield ": wait\n\n"
+                    continue
+            last = current
+            yield "id: %d\nevent: status\ndata: %s\n\n" % (current, 
+                json.dumps(task_result))
+            if task_result['status'] != RUNNING:
+                return
+    
+    return Response(events(), mimetype="text/event-stream", 
+        headers={'Cache-Control' : 'no-cache', 'X-Accel-Buffering' : 'no'})
+    
+@app.route("/api/metrics")
+def metrics():
+    # Prometheus text format
+    return Response(get_metrics().render(), mimetype="text/plain; version=0.0.4")
+    
 @app.route("/notice")    
 def notice():   
     